@@ -3,22 +3,33 @@ import os
 import nibabel as nib
 from nibabel.processing import resample_from_to
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from scipy.ndimage import binary_fill_holes, binary_dilation
 
-def find_file(directory, substring):
-    for file_name in os.listdir(directory):
+def find_file(directory, substring, file_names=None):
+    for file_name in (os.listdir(directory) if file_names is None else file_names):
         if substring in file_name and (
                 file_name.endswith('.nii') or file_name.endswith('.nii.gz') or file_name.endswith('.mgz')):
             return os.path.join(directory, file_name)
     return None
 
 def load_nifti(file_path):
+    """Load an image and its data in the on-disk dtype (no float64 copy, no copy at all for uncompressed files)."""
     img = nib.load(file_path)
-    data = img.get_fdata()
+    data = np.asanyarray(img.dataobj)
     return img, data
 
+def to_label_map(data):
+    """Return data as a writable int32 label map, rounding it first if it is stored as floats."""
+    if np.issubdtype(data.dtype, np.floating):
+        data = np.rint(data)
+    if data.dtype != np.int32 or not data.flags.writeable:
+        data = data.astype(np.int32)
+    return data
+
 def save_nifti(output_path, data, reference_img):
     new_img = nib.Nifti1Image(data, affine=reference_img.affine, header=reference_img.header)
+    new_img.set_data_dtype(data.dtype)
     nib.save(new_img, output_path)
 
 def resample_to_target(source_img, target_img, interpolation='cubic'):
@@ -34,14 +45,42 @@ def resample_to_target(source_img, target_img, interpolation='cubic'):
 
     return resample_from_to(source_img, (target_shape, target_affine), order=order)
 
-def process_mask(mask_data, fill_holes=True, dilation_iterations=None, save_new_mask=False):
-    closed_mask = binary_fill_holes(mask_data) if fill_holes else mask_data
-    return binary_dilation(closed_mask, iterations=dilation_iterations) if dilation_iterations else closed_mask
-
-def add_extra_label(label_map, mask, extra_label=np.int32(257)):
-    new_label_map = label_map.copy()
-    new_label_map[(mask > 0) & (label_map == 0)] = extra_label
-    return np.round(new_label_map).astype(np.int32)
+def mask_bounding_box(mask_data, pad=0):
+    """Slices of the bounding box of the nonzero voxels of mask_data grown by pad voxels (empty if there are none)."""
+    bbox = []
+    for axis in range(mask_data.ndim):
+        nonzero = np.flatnonzero(mask_data.any(axis=tuple(a for a in range(mask_data.ndim) if a != axis)))
+        if len(nonzero) == 0:
+            return (slice(0, 0),) * mask_data.ndim
+        bbox.append(slice(max(nonzero[0] - pad, 0), min(nonzero[-1] + pad + 1, mask_data.shape[axis])))
+    return tuple(bbox)
+
+def process_mask(mask_data, fill_holes=True, dilation_iterations=None):
+    """
+    Fill the holes of the binary mask_data and dilate it. The morphology only runs on the bounding box of the mask,
+    padded by one voxel more than the dilation can grow it (so that holes are found the same way as on the full
+    volume). Returns the bounding box and the processed mask inside of it.
+    """
+    bbox = mask_bounding_box(mask_data, pad=(dilation_iterations or 0) + 1)
+    processed_mask = mask_data[bbox]
+    if fill_holes:
+        processed_mask = binary_fill_holes(processed_mask)
+    if dilation_iterations:
+        processed_mask = binary_dilation(processed_mask, iterations=dilation_iterations)
+    return bbox, processed_mask
+
+def add_extra_label(label_map, mask, extra_label=np.int32(257), bbox=None):
+    """Set the background voxels of the int32 label_map inside mask (cropped to bbox, if given) to extra_label, in place."""
+    label_map_crop = label_map[bbox] if bbox is not None else label_map
+    label_map_crop[mask & (label_map_crop == 0)] = extra_label
+    return label_map
+
+def mask_image(image_data, bbox, mask):
+    """Masked copy of image_data in its own dtype (float64 is stored as float32), computed on the bounding box only."""
+    masked_dtype = np.float32 if image_data.dtype == np.float64 else image_data.dtype
+    masked_data = np.zeros(image_data.shape, dtype=masked_dtype)
+    masked_data[bbox] = np.where(mask, image_data[bbox], 0)
+    return masked_data
 
 def get_masked_image_filename(input_image_path):
     og_img_filename = os.path.basename(input_image_path)
@@ -56,33 +95,22 @@ def get_masked_image_filename(input_image_path):
     return new_masked_img_filename
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Process MRI images and segmentation maps.")
-    parser.add_argument('-i', '--input_dir', required=True, help="Directory containing input files (label map + mask + input image).")
-    parser.add_argument('-o','--output_dir', help="Directory to save the output files. If not provided, defaults to the input directory.")
-    parser.add_argument('--labelmap', default="aseg", help="Substring to identify the labelmap file (e.g., 'aseg.mgz').")
-    parser.add_argument('--mask', default="mask.mgz", help="Substring to identify the mask file (e.g., 'mask.mgz').")
-    parser.add_argument('--image', default="orig.mgz", help="Substring to identify the input MRI image (e.g., 'orig.mgz').")
-    parser.add_argument('--fill_holes', action='store_true', help="Set flag if you want the holes in the mask to be filled.")
-    parser.add_argument('--dilate-iters', type=int, help="Number of iterations for morphological dilation (default: skipped if not provided). Moreover, if the input image (--image flag) is orig.mgz, the dilation step is ignored no matter the value set here.")
-    parser.add_argument('--save_new_mask', action='store_true', help="Set flag if you want to save the newly modified mask (the original mask is kept intact).")
-    parser.add_argument('--new_label', type=int, default=np.int32(257), help="New label value to be added to the label map (default: 257).")
-    parser.add_argument('--new_labelmap_name', type=str, help="New name for the modified label map. Include the file extension in it (default: 'aseg_mod.nii.gz').")
-    
-    args = parser.parse_args()
-
+def add_extra_cerebral_label(input_dir, output_dir=None, labelmap="aseg", mask="mask.mgz", image="orig.mgz",
+                              fill_holes=False, dilate_iters=None, save_new_mask=False, new_label=np.int32(257),
+                              new_labelmap_name=None):
     # Set output directory
-    output_dir = args.output_dir if args.output_dir else args.input_dir
+    output_dir = output_dir if output_dir else input_dir
     if not os.path.exists(output_dir):
-        os.makedirs(output_dir)    
-        
+        os.makedirs(output_dir, exist_ok=True)
+
     # Locate the labelmap, mask, and input image files
-    labelmap_file = find_file(args.input_dir, args.labelmap)
-    mask_file = find_file(args.input_dir, args.mask)
-    input_file = find_file(args.input_dir, args.image)
+    file_names = os.listdir(input_dir)
+    labelmap_file = find_file(input_dir, labelmap, file_names)
+    mask_file = find_file(input_dir, mask, file_names)
+    input_file = find_file(input_dir, image, file_names)
 
     if not labelmap_file or not mask_file or not input_file:
-        raise FileNotFoundError("Could not find label map, mask, or input file in the specified directory.")
+        raise FileNotFoundError(f"Could not find label map, mask, or input file in {input_dir}.")
 
     print(f"Found labelmap file: {labelmap_file}")
     print(f"Found mask file: {mask_file}")
@@ -94,7 +122,7 @@ def main():
     input_img, input_data = load_nifti(input_file)
 
     # Resample the label map to the input image if necessary
-    if args.image in ['orig.mgz', 'orig.nii.gz']:
+    if image in ['orig.mgz', 'orig.nii.gz']:
         print("Since the input image provided is the 'orig' from FreeSurfer/FastSurfer, no need to resample it to the mask (because it is already).")
     else:
         print("Resampling the input image to the labelmap in order to create a masked/brain extracted version of the input image.")
@@ -104,63 +132,105 @@ def main():
     # Creation of the new label map
 
     # Ensure mask is binary
-    mask_data = (mask_data > 0).astype(np.uint8)
+    mask_data = mask_data > 0
 
-    # Prepare the original label map
+    # Prepare the original label map: rounded and converted/enforced to np.int32 datatype for consistency (once)
+    label_data = to_label_map(label_data)
     unique_raw_labels = np.unique(label_data)
     print("Unique label values in the original label map provided: ", unique_raw_labels)
-    rounded_int_label_map = np.round(label_data).astype(np.int32)
-    #print("Label map (1) rounded and (2) converted/enforced to np.int32 datatype for consistency.")
 
     # Apply morphological operations on the mask
     print("Starting: morphological operations on the original mask.")
-    processed_mask = process_mask(mask_data, fill_holes=args.fill_holes, dilation_iterations=args.dilate_iters)
+    bbox, processed_mask = process_mask(mask_data, fill_holes=fill_holes, dilation_iterations=dilate_iters)
+    del mask_data
     print("Completed: morphological operations on the original mask.")
 
     # Save the new mask if desired
-    if args.save_new_mask:
+    if save_new_mask:
         dir2new_mask = output_dir 
         og_mask_name = os.path.basename(mask_file)
         new_mask_name = og_mask_name.replace(".mgz", "_mod.nii.gz")
         path2new_mask = os.path.join(dir2new_mask, new_mask_name)
-        save_nifti(path2new_mask, processed_mask.astype(np.uint8), mask_img)
+        new_mask = np.zeros(mask_img.shape, dtype=np.uint8)
+        new_mask[bbox] = processed_mask
+        save_nifti(path2new_mask, new_mask, mask_img)
+        del new_mask
         print(f"The new modified mask was saved as {path2new_mask}.")
 
     # Add extra label to the label map
     print("Starting: adding the extra-cerebrum label to the label map.")
-    modified_label_map = add_extra_label(rounded_int_label_map, processed_mask, extra_label=args.new_label)
+    modified_label_map = add_extra_label(label_data, processed_mask, extra_label=new_label, bbox=bbox)
     print("Completed: adding the extra-cerebrum label to the label map.")
 
     # Save the new label map
-    rounded_int_modified_label_map = np.round(modified_label_map).astype(np.int32)
-
     new_affine = label_img.affine
     new_header = label_img.header
     new_header.set_data_dtype(np.int32) # If you wonder, I add many many many issues with precision levels of label maps, so I prefer being safer than sorry.
 
-    if args.new_labelmap_name is None:
+    if new_labelmap_name is None:
         new_labelmap_name = os.path.basename(labelmap_file).replace(".mgz", "_mod.nii.gz")
 
-    new_label_map = nib.Nifti1Image(rounded_int_modified_label_map, affine=new_affine, header=new_header)
+    new_label_map = nib.Nifti1Image(modified_label_map, affine=new_affine, header=new_header)
     label_map_output_path = os.path.join(output_dir, new_labelmap_name)
     nib.save(new_label_map, label_map_output_path)
     print(f"Modified label map saved as: {label_map_output_path}")
+    del modified_label_map, label_data, new_label_map
 
-    if 'orig' in args.image:
+    if 'orig' in image:
         print("Starting: masking the input image.")
-        input_masked_data = input_data * processed_mask
+        input_masked_data = mask_image(input_data, bbox, processed_mask)
         input_masked_output = os.path.join(output_dir, get_masked_image_filename(input_file))
-        save_nifti(input_masked_output, input_masked_data.astype(np.float32), input_img)
+        save_nifti(input_masked_output, input_masked_data, input_img)
         print(f"Masked input image saved as: {input_masked_output}")
     else:
         print("Starting: masking the resampled input image.")
-        resampled_input_data = resampled_input_img.get_fdata()
-        input_masked_data = resampled_input_data * processed_mask
+        resampled_input_data = np.asanyarray(resampled_input_img.dataobj)
+        input_masked_data = mask_image(resampled_input_data, bbox, processed_mask)
         input_masked_output = os.path.join(output_dir, get_masked_image_filename(input_file))
-        save_nifti(input_masked_path, input_masked_data.astype(np.float32), resampled_input_img)
-        print(f"Masked input image saved as: {input_masked_path}")
+        save_nifti(input_masked_output, input_masked_data, resampled_input_img)
+        print(f"Masked input image saved as: {input_masked_output}")
 
     print("Done! :)")
 
+
+def main():
+    parser = argparse.ArgumentParser(description="Process MRI images and segmentation maps.")
+    parser.add_argument('-i', '--input_dir', required=True, help="Directory containing input files (label map + mask + input image).")
+    parser.add_argument('-o','--output_dir', help="Directory to save the output files. If not provided, defaults to the input directory.")
+    parser.add_argument('--labelmap', default="aseg", help="Substring to identify the labelmap file (e.g., 'aseg.mgz').")
+    parser.add_argument('--mask', default="mask.mgz", help="Substring to identify the mask file (e.g., 'mask.mgz').")
+    parser.add_argument('--image', default="orig.mgz", help="Substring to identify the input MRI image (e.g., 'orig.mgz').")
+    parser.add_argument('--fill_holes', action='store_true', help="Set flag if you want the holes in the mask to be filled.")
+    parser.add_argument('--dilate-iters', type=int, help="Number of iterations for morphological dilation (default: skipped if not provided). Moreover, if the input image (--image flag) is orig.mgz, the dilation step is ignored no matter the value set here.")
+    parser.add_argument('--save_new_mask', action='store_true', help="Set flag if you want to save the newly modified mask (the original mask is kept intact).")
+    parser.add_argument('--new_label', type=int, default=np.int32(257), help="New label value to be added to the label map (default: 257).")
+    parser.add_argument('--new_labelmap_name', type=str, help="New name for the modified label map. Include the file extension in it (default: 'aseg_mod.nii.gz').")
+    parser.add_argument('--subjects', action='store_true', help="Set flag if the input directory contains one sub-directory per subject (each with its label map, mask and input image). The outputs are saved in a sub-directory of the same name in the output directory.")
+    parser.add_argument('--np', type=int, default=1, help="With --subjects: number of subjects processed in parallel (default: 1).")
+    
+    args = parser.parse_args()
+
+    kwargs = dict(labelmap=args.labelmap, mask=args.mask, image=args.image, fill_holes=args.fill_holes,
+                  dilate_iters=args.dilate_iters, save_new_mask=args.save_new_mask, new_label=args.new_label,
+                  new_labelmap_name=args.new_labelmap_name)
+
+    if not args.subjects:
+        add_extra_cerebral_label(args.input_dir, args.output_dir, **kwargs)
+        return
+
+    output_dir = args.output_dir if args.output_dir else args.input_dir
+    subjects = sorted(entry.name for entry in os.scandir(args.input_dir) if entry.is_dir())
+    jobs = [(os.path.join(args.input_dir, subject), os.path.join(output_dir, subject)) for subject in subjects]
+    if args.np <= 1:
+        for subject_input_dir, subject_output_dir in jobs:
+            add_extra_cerebral_label(subject_input_dir, subject_output_dir, **kwargs)
+    else:
+        with ProcessPoolExecutor(max_workers=args.np) as executor:
+            futures = {executor.submit(add_extra_cerebral_label, subject_input_dir, subject_output_dir, **kwargs):
+                           subject_input_dir for subject_input_dir, subject_output_dir in jobs}
+            for future in as_completed(futures):
+                future.result()
+                print(f"Subject done: {futures[future]}")
+
 if __name__ == "__main__":
     main()
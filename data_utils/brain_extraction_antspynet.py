@@ -20,28 +20,125 @@
 
 import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # Suppress INFO, WARNING, and ERROR logs from TensorFlow
+import sys
 import ants
-import antspynet
 import argparse
-import numpy as np
-from scipy.ndimage import label
-from skimage.morphology import binary_closing, ball, binary_dilation
-
-
-def brain_extraction(input_folder, output_folder=None, modality="t1", skip_morpho=False, mask_folder=None, dilation_voxels=0, rename=False):
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from data_utils.mask_refinement import refine_mask
+from data_utils.rename_files_nnunet_convention import build_sub_id_index, match_mask_to_image
+
+
+@contextmanager
+def warm_antspynet_models():
+    """
+    Build each network antspynet asks for and load its weights only once while the context is active.
+
+    antspynet.brain_extraction builds its U-Net (and the TensorFlow graph) from scratch on every call and then loads
+    the pretrained weights into it. Inside this context, later calls get the already built model back, and loading
+    the weights file that is already in the model is skipped, so the traced predict function of the model is reused.
+    """
+    import antspynet.architectures
+
+    original = antspynet.architectures.create_unet_model_3d
+    models = {}
+
+    def skip_reloading_weights(model):
+        original_load_weights = model.load_weights
+        loaded_weights = [None]
+
+        def load_weights(filepath, *args, **kwargs):
+            # The same architecture may be used with different weights (e.g. for another modality)
+            key = (os.path.abspath(os.fspath(filepath)), repr(args), repr(sorted(kwargs.items())))
+            if loaded_weights[0] != key:
+                loaded_weights[0] = None
+                result = original_load_weights(filepath, *args, **kwargs)
+                loaded_weights[0] = key
+                return result
+
+        model.load_weights = load_weights
+        return model
+
+    def create_unet_model_3d(*args, **kwargs):
+        key = repr((args, sorted(kwargs.items())))
+        if key not in models:
+            models[key] = skip_reloading_weights(original(*args, **kwargs))
+        return models[key]
+
+    # brain_extraction may look the constructor up in any of these namespaces
+    modules = [module for module in (antspynet, antspynet.architectures,
+                                     sys.modules.get("antspynet.utilities.brain_extraction"))
+               if module is not None and getattr(module, "create_unet_model_3d", None) is original]
+    for module in modules:
+        module.create_unet_model_3d = create_unet_model_3d
+    try:
+        yield
+    finally:
+        for module in modules:
+            module.create_unet_model_3d = original
+
+
+def prefetch_images(io_pool, paths, depth):
+    """Yield the images at paths in order, while the next `depth` images are already read on io_pool."""
+    paths = iter(paths)
+    reads = deque(io_pool.submit(ants.image_read, path) for path in itertools.islice(paths, depth))
+    while reads:
+        image = reads.popleft().result()
+        reads.extend(io_pool.submit(ants.image_read, path) for path in itertools.islice(paths, 1))
+        yield image
+
+
+def mask_and_save(input_path, mask_path, output_path, mask_output_path, dilation_voxels=0):
+    """Refine the mask at mask_path, apply it to the image at input_path and save both. Returns a message."""
+    # Load the image
+    image = ants.image_read(input_path)
+
+    # Load the mask
+    mask = ants.image_read(mask_path)
+
+    # Threshold the mask to keep values greater than 0.01 and clean it up
+    dilated_mask = refine_mask(mask.numpy() > 0.01, dilation_voxels)
+
+    # Apply the mask to the original image
+    masked_image = image * dilated_mask
+
+    # Save the modified mask and the brain-extracted and masked image
+    modified_mask = ants.from_numpy(dilated_mask, origin=image.origin, spacing=image.spacing,
+                                    direction=image.direction)
+    ants.image_write(modified_mask, mask_output_path)
+    ants.image_write(masked_image, output_path)
+    return (f"Brain extraction and masking completed for {os.path.basename(input_path)}, saved to {output_path}\n"
+            f"Modified mask saved to {mask_output_path}")
+
+
+def brain_extraction(input_folder, output_folder=None, modality="t1", skip_morpho=False, mask_folder=None, dilation_voxels=0, rename=False,
+                     io_threads=2, num_processes=1, start_substring=None, end_substring=None):
     if output_folder is None:
         output_folder = input_folder
 
     # Ensure the output folder exists
     os.makedirs(output_folder, exist_ok=True)
 
+    # Masks are refined in num_processes worker processes. They are spawned rather than forked, because forking a
+    # process that has already initialized TensorFlow (and its threads) can deadlock the children. The workers only
+    # import this module and data_utils.mask_refinement, not TensorFlow
+    refine_pool = ProcessPoolExecutor(max_workers=num_processes, mp_context=multiprocessing.get_context("spawn")) \
+        if num_processes > 1 else None
+
     if mask_folder:
-        # Use existing masks and perform brain extraction
-        for mask_filename in os.listdir(mask_folder):
+        # Use existing masks and perform brain extraction. The input folder is listed once and indexed by subject ID.
+        input_filenames = [entry.name for entry in os.scandir(input_folder)
+                           if entry.name.endswith(".nii") or entry.name.endswith(".nii.gz")]
+        input_index = build_sub_id_index(input_filenames, start_substring, end_substring)
+        futures = []
+        for mask_filename in sorted(os.listdir(mask_folder)):
             if mask_filename.endswith(".nii") or mask_filename.endswith(".nii.gz"):
-                # Remove 'mask' from the mask filename to find the corresponding image filename
-                subject_id = mask_filename.replace('mask', '')
-                input_filename = next((f for f in os.listdir(input_folder) if subject_id in f), None)
+                input_filename = match_mask_to_image(mask_filename, input_index, input_filenames,
+                                                     start_substring, end_substring)
 
                 if input_filename:
                     input_path = os.path.join(input_folder, input_filename)
@@ -57,47 +154,44 @@ def brain_extraction(input_folder, output_folder=None, modality="t1", skip_morph
                     output_path = os.path.join(output_folder, new_output_name)
                     mask_output_path = os.path.join(output_folder, new_mask_name)
 
-                    # Load the image
-                    image = ants.image_read(input_path)
-
-                    # Load the mask
-                    mask = ants.image_read(mask_path)
-
-                    # Threshold the mask to keep values greater than 0.01
-                    binary_mask = mask.numpy() > 0.01
-
-                    # Keep only the largest connected component in the mask
-                    labeled_mask, num_features = label(binary_mask)
-                    sizes = np.bincount(labeled_mask.ravel())
-                    sizes[0] = 0  # Ignore background
-                    largest_label = sizes.argmax()
-                    largest_component_mask = labeled_mask == largest_label
-
-                    # Apply morphological operations on the mask
-                    selem = ball(5)  # Use a 3D structuring element
-                    closed_mask = binary_closing(largest_component_mask, selem)
-                    if dilation_voxels > 0:
-                        dilated_mask = binary_dilation(closed_mask, ball(dilation_voxels))
+                    if refine_pool is None:
+                        print(mask_and_save(input_path, mask_path, output_path, mask_output_path, dilation_voxels))
                     else:
-                        dilated_mask = closed_mask
-
-                    # Apply the mask to the original image
-                    masked_image = image * dilated_mask
-
-                    # Save the modified mask and the brain-extracted and masked image
-                    modified_mask = ants.from_numpy(dilated_mask, origin=image.origin, spacing=image.spacing,
-                                                    direction=image.direction)
-                    ants.image_write(modified_mask, mask_output_path)
-                    ants.image_write(masked_image, output_path)
-                    print(f"Brain extraction and masking completed for {input_filename}, saved to {output_path}")
-                    print(f"Modified mask saved to {mask_output_path}")
-                else:
-                    print(f"No matching image found for mask {mask_filename}")
+                        futures.append(refine_pool.submit(mask_and_save, input_path, mask_path, output_path,
+                                                          mask_output_path, dilation_voxels))
+        for future in as_completed(futures):
+            print(future.result())
     else:
-        # Iterate over all files in the input folder
-        for filename in os.listdir(input_folder):
-            if filename.endswith(".nii") or filename.endswith(".nii.gz"):
-                input_path = os.path.join(input_folder, filename)
+        filenames = [filename for filename in os.listdir(input_folder)
+                     if filename.endswith(".nii") or filename.endswith(".nii.gz")]
+        input_paths = [os.path.join(input_folder, filename) for filename in filenames]
+
+        # antspynet (and TensorFlow) is only imported here, so that the refine_pool workers do not import it
+        import antspynet
+
+        # The extraction network is built and its weights are loaded once for all images. Images are read ahead and written in the background
+        # on io_threads threads, so that the (CPU) forward passes run back to back. The masks of the previous images
+        # are refined on refine_pool meanwhile.
+        with warm_antspynet_models(), ThreadPoolExecutor(max_workers=max(1, io_threads)) as io_pool:
+            writes = []
+            pending_masks = deque()
+
+            def save_refined(refined_future, image, filename, output_path, mask_output_path):
+                dilated_mask = refined_future.result() if refine_pool is not None else refined_future
+
+                # Apply the mask to the original image
+                masked_image = image * dilated_mask
+
+                # Save the modified mask and the brain-extracted and masked image
+                modified_mask = ants.from_numpy(dilated_mask, origin=image.origin, spacing=image.spacing,
+                                                direction=image.direction)
+                writes.append(io_pool.submit(ants.image_write, modified_mask, mask_output_path))
+                writes.append(io_pool.submit(ants.image_write, masked_image, output_path))
+                print(f"Brain extraction and masking completed for {filename}, saved to {output_path}")
+                print(f"Mask saved to {mask_output_path}")
+
+            for filename, input_path, image in zip(filenames, input_paths,
+                                                   prefetch_images(io_pool, input_paths, max(1, io_threads))):
                 input_basename = os.path.basename(input_path)
 
                 if rename:
@@ -113,9 +207,6 @@ def brain_extraction(input_folder, output_folder=None, modality="t1", skip_morph
                 new_mask_name = 'mask_' + input_basename
                 mask_output_path = os.path.join(output_folder, new_mask_name)
 
-                # Load the image
-                image = ants.image_read(input_path)
-
                 # Perform brain extraction to create the initial mask
                 initial_mask = antspynet.brain_extraction(image, modality=modality)
 
@@ -126,38 +217,30 @@ def brain_extraction(input_folder, output_folder=None, modality="t1", skip_morph
                     # Apply the mask to the original image
                     masked_image = image * binary_mask
 
-                    ants.image_write(masked_image, output_path)
+                    writes.append(io_pool.submit(ants.image_write, masked_image, output_path))
                     print(f"Brain extraction completed for {filename}, saved to {output_path}")
 
                 else:
-                    # Convert the brain-extracted image to a binary mask
+                    # Convert the brain-extracted image to a binary mask and clean it up
                     binary_mask = initial_mask.numpy() > 0.01
-
-                    # Keep only the largest connected component in the mask
-                    labeled_mask, num_features = label(binary_mask)
-                    sizes = np.bincount(labeled_mask.ravel())
-                    sizes[0] = 0  # Ignore background
-                    largest_label = sizes.argmax()
-                    largest_component_mask = labeled_mask == largest_label
-
-                    # Apply morphological operations on the mask
-                    selem = ball(5)  # Use a 3D structuring element
-                    closed_mask = binary_closing(largest_component_mask, selem)
-                    if dilation_voxels > 0:
-                        dilated_mask = binary_dilation(closed_mask, ball(dilation_voxels))
+                    if refine_pool is None:
+                        refined = refine_mask(binary_mask, dilation_voxels)
                     else:
-                        dilated_mask = closed_mask
+                        refined = refine_pool.submit(refine_mask, binary_mask, dilation_voxels)
+                    pending_masks.append((refined, image, filename, output_path, mask_output_path))
+                    # Bound the number of images kept in memory
+                    while len(pending_masks) > num_processes:
+                        save_refined(*pending_masks.popleft())
 
-                    # Apply the mask to the original image
-                    masked_image = image * dilated_mask
+            while pending_masks:
+                save_refined(*pending_masks.popleft())
+
+            # Surface write errors
+            for write in writes:
+                write.result()
 
-                    # Save the modified mask and the brain-extracted and masked image
-                    modified_mask = ants.from_numpy(dilated_mask, origin=image.origin, spacing=image.spacing,
-                                                    direction=image.direction)
-                    ants.image_write(modified_mask, mask_output_path)
-                    ants.image_write(masked_image, output_path)
-                    print(f"Brain extraction and masking completed for {filename}, saved to {output_path}")
-                    print(f"Mask saved to {mask_output_path}")
+    if refine_pool is not None:
+        refine_pool.shutdown()
 
 
     
@@ -173,11 +256,20 @@ def main():
                         help="Path to the folder containing masks for morphological operations")
     parser.add_argument("--dilation_voxels", type=int, default=0, help="Number of voxels for dilation (default: 0)")
     parser.add_argument("--rename", action="store_true", help="Flag to rename the brain extracted image(s) by adding the '_masked' suffix. Otherwise, brain extracted images will keep the same name.")
+    parser.add_argument("--io_threads", type=int, default=2,
+                        help="Number of threads reading the next images and writing the results while the network runs (default: 2). The network is built and its weights are loaded once for all images.")
+    parser.add_argument("--np", type=int, default=1,
+                        help="Number of processes refining the brain masks in parallel (default: 1).")
+    parser.add_argument("--start_substring", type=str,
+                        help="With --mask_folder: substring that marks the beginning of the subject ID used to match masks and images (as in run_renaming).")
+    parser.add_argument("--end_substring", type=str,
+                        help="With --mask_folder: substring that marks the end of the subject ID used to match masks and images (as in run_renaming).")
 
     args = parser.parse_args()
 
     brain_extraction(args.input_dir, args.output_dir, args.modality, args.skip_morpho, args.mask_folder,
-                     args.dilation_voxels, args.rename)
+                     args.dilation_voxels, args.rename, args.io_threads, args.np,
+                     args.start_substring, args.end_substring)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------------#
+# Copyright 2025 [Marc-Antoine Fortin, MR Physics, NTNU]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#---------------------------------------------------------------------------------#
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# Bump when the conform output for the same input and parameters changes
+CACHE_VERSION = 1
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """Content hash of a file, read in chunks."""
+    file_hash = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class ConformCache:
+    """
+    On-disk cache of conformed images, keyed by the content hash of the input file and the conform parameters.
+
+    Cached images are copied to (or, with hardlink=True, hard-linked to) the requested output path. Hard links save
+    the copy and the disk space, but a program that later overwrites the output file in place also modifies the cached
+    image, so only use them if outputs are never modified in place. Entries are evicted by age (max_age_days) and,
+    least recently used first, by total size (max_size_gb) when evict() is called.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=None, max_age_days=None, hardlink=False):
+        self.cache_dir = cache_dir
+        self.max_size_gb = max_size_gb
+        self.max_age_days = max_age_days
+        self.hardlink = hardlink
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(input_path, **conform_params):
+        """Cache key for input_path conformed with conform_params (order, dtype, conform_vox_size, ...)."""
+        params = json.dumps({'version': CACHE_VERSION, **conform_params}, sort_keys=True, default=str)
+        key_hash = hashlib.blake2b(digest_size=20)
+        key_hash.update(hash_file(input_path).encode())
+        key_hash.update(params.encode())
+        return key_hash.hexdigest()
+
+    def _entry_path(self, key, file_ending):
+        return os.path.join(self.cache_dir, key + file_ending)
+
+    def fetch(self, key, output_path):
+        """Put the cached image for key at output_path. Returns False if there is no cached image."""
+        entry_path = self._entry_path(key, _file_ending(output_path))
+        if not os.path.isfile(entry_path):
+            return False
+        # mark as recently used for the size based eviction
+        os.utime(entry_path)
+        if os.path.isfile(output_path) and os.path.samefile(entry_path, output_path):
+            # output is already a hard link to the cached image, nothing to do
+            return True
+        self._place(entry_path, output_path)
+        return True
+
+    def store(self, key, output_path):
+        """Add the conformed image at output_path to the cache."""
+        entry_path = self._entry_path(key, _file_ending(output_path))
+        if os.path.isfile(entry_path):
+            return
+        self._place(output_path, entry_path)
+
+    def _place(self, source_path, destination_path):
+        # write next to the destination first and rename, so that concurrent workers never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(destination_path)),
+                                        suffix=_file_ending(destination_path))
+        os.close(fd)
+        os.remove(tmp_path)
+        try:
+            if self.hardlink:
+                try:
+                    os.link(source_path, tmp_path)
+                except OSError:
+                    # e.g. cache and outputs on different file systems
+                    shutil.copyfile(source_path, tmp_path)
+            else:
+                shutil.copyfile(source_path, tmp_path)
+            os.replace(tmp_path, destination_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def evict(self):
+        """Remove entries older than max_age_days, then the least recently used ones until below max_size_gb."""
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            entry_path = os.path.join(self.cache_dir, filename)
+            if os.path.isfile(entry_path):
+                stat = os.stat(entry_path)
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+        removed = 0
+        if self.max_age_days is not None:
+            oldest_allowed = time.time() - self.max_age_days * 24 * 3600
+            for entry in [e for e in entries if e[0] < oldest_allowed]:
+                os.remove(entry[2])
+                entries.remove(entry)
+                removed += 1
+
+        if self.max_size_gb is not None:
+            total_size = sum(e[1] for e in entries)
+            for mtime, size, entry_path in sorted(entries):
+                if total_size <= self.max_size_gb * 1024 ** 3:
+                    break
+                os.remove(entry_path)
+                total_size -= size
+                removed += 1
+        if removed > 0:
+            print(f"Removed {removed} images from the conform cache {self.cache_dir}.")
+
+
+def _file_ending(file_path):
+    return ".nii.gz" if file_path.endswith(".nii.gz") else os.path.splitext(file_path)[1]
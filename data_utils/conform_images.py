@@ -20,9 +20,68 @@
 
 import os
 import argparse
-import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import cast
 
-def conform_images(input_dir, output_dir, order, dtype, seg_input):
+import nibabel as nib
+
+from data_utils.conform_cache import ConformCache
+from data_utils.fastsurfer import logging_fsv
+from data_utils.fastsurfer.conform import DEFAULT_CRITERIA, check_affine_in_nifti, conform, is_conform
+from nnunetv2.configuration import default_gzip_compresslevel, default_gzip_threads
+from nnunetv2.imageio.parallel_gzip import gzip_threads_per_process, load_nifti, save_nifti
+
+
+def conform_file(input_path, output_path, order, dtype, seg_input, num_threads=None, cache=None,
+                 compresslevel=default_gzip_compresslevel, gzip_threads=default_gzip_threads):
+    """
+    Conform a single image to its minimal isotropic voxel size. Same as running
+    `python -m data_utils.fastsurfer.conform -i input_path -o output_path --conform_min --order order --dtype dtype`,
+    but without starting a new interpreter. num_threads is passed on to conform() (see map_image).
+    If a ConformCache is given, the conformed image is taken from it when the same input was already
+    conformed with the same parameters, and added to it otherwise. .nii.gz files are read and written with
+    the multithreaded gzip engine of nnunetv2.imageio.parallel_gzip with gzip_threads threads, using compresslevel
+    for the output.
+    Returns a message describing what was done.
+    """
+    target_dtype = "uint8" if seg_input else dtype
+    opt_kwargs = {"criteria": set(DEFAULT_CRITERIA), "conform_to_1mm_threshold": None}
+    if check_dtype := target_dtype != "any":
+        opt_kwargs["dtype"] = target_dtype
+
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.make_key(input_path, order=order, dtype=target_dtype, conform_vox_size="min",
+                                   conform_to_1mm_threshold=opt_kwargs["conform_to_1mm_threshold"],
+                                   criteria=sorted(c.value for c in opt_kwargs["criteria"]))
+        if cache.fetch(cache_key, output_path):
+            return f"Conformed {input_path} -> {output_path} (from cache)"
+
+    image = load_nifti(input_path, gzip_threads)
+
+    if not isinstance(image, nib.analyze.SpatialImage):
+        raise ValueError(f"ERROR: Input image is not a spatial image: {type(image).__name__}")
+    if len(image.shape) > 3 and image.shape[3] != 1:
+        raise ValueError(f"ERROR: Multiple input frames ({image.shape[3]}) not supported!")
+
+    if is_conform(image, conform_vox_size="min", check_dtype=check_dtype, verbose=False, **opt_kwargs):
+        return f"Input {input_path} is already conformed! Skipping."
+
+    if input_path.endswith(".nii.gz") or input_path.endswith(".nii"):
+        if not check_affine_in_nifti(cast(nib.Nifti1Image | nib.Nifti2Image, image)):
+            raise ValueError(f"ERROR: inconsistency in nifti-header of {input_path}.")
+
+    new_image = conform(image, order=order, conform_vox_size="min", num_threads=num_threads, **opt_kwargs)
+    save_nifti(new_image, output_path, compresslevel, gzip_threads)
+    if cache is not None:
+        cache.store(cache_key, output_path)
+    return f"Conformed {input_path} -> {output_path}"
+
+
+def conform_images(input_dir, output_dir, order, dtype, seg_input, num_processes=1, log_file="", num_threads=None,
+                   cache_dir=None, cache_max_size_gb=None, cache_max_age_days=None, cache_hardlink=False,
+                   compresslevel=default_gzip_compresslevel):
 
     # Ensure output directory exists
     if output_dir:
@@ -31,32 +90,42 @@ def conform_images(input_dir, output_dir, order, dtype, seg_input):
         output_dir = os.path.join(os.path.dirname(input_dir), 'inputs-cfm')
         os.makedirs(output_dir, exist_ok=True)
 
-    # Iterate over all files in the input directory
-    for filename in sorted(os.listdir(input_dir)):
-
-        if filename.endswith(".nii") or filename.endswith(".nii.gz"):
-            
-            input_path = os.path.join(input_dir, filename)
-            output_path = os.path.join(output_dir, filename)
-            
-            # Construct the command
-            conform_module = "data_utils.fastsurfer.conform"
-            command = [
-                "python3", "-m", conform_module,
-                "-i", input_path,
-                "-o", output_path,
-                "--conform_min",
-                "--order", str(order),
-                "--dtype", dtype
-            ]
-
-            # Add the --seg_input flag if specified
-            if seg_input:
-                command.append("--seg_input")
-
-            # Run the command
-            subprocess.run(command, check=True)
+    # One logging setup for this process and all workers
+    logging_fsv.setup_logging(log_file)
+
+    cache = None
+    if cache_dir:
+        cache = ConformCache(cache_dir, max_size_gb=cache_max_size_gb, max_age_days=cache_max_age_days,
+                             hardlink=cache_hardlink)
+
+    # Collect all NIfTI files in the input directory
+    filenames = [filename for filename in sorted(os.listdir(input_dir))
+                 if filename.endswith(".nii") or filename.endswith(".nii.gz")]
+
+    # The gzip threads are shared by the worker processes instead of every worker starting nnUNet_gzip_threads threads
+    gzip_threads = gzip_threads_per_process(num_processes)
+
+    start_time = time.time()
+    if num_processes <= 1:
+        for filename in filenames:
+            print(conform_file(os.path.join(input_dir, filename), os.path.join(output_dir, filename),
+                               order, dtype, seg_input, num_threads, cache, compresslevel, gzip_threads))
             print("--------------------------------------------------------------")
+    else:
+        # Every worker imports nibabel/numpy/scipy once and then conforms images one after the other
+        with ProcessPoolExecutor(max_workers=num_processes, initializer=logging_fsv.setup_logging,
+                                 initargs=(log_file,)) as executor:
+            futures = [executor.submit(conform_file, os.path.join(input_dir, filename),
+                                       os.path.join(output_dir, filename), order, dtype, seg_input, num_threads,
+                                       cache, compresslevel, gzip_threads)
+                       for filename in filenames]
+            for future in as_completed(futures):
+                print(future.result())
+                print("--------------------------------------------------------------")
+    print(f"Conformed {len(filenames)} images in {time.time() - start_time:.2f} seconds.")
+
+    if cache is not None:
+        cache.evict()
 
 
 def main():
@@ -70,10 +139,28 @@ def main():
                         help="Data type to use for the conformed images (default: float32. Other options: uint8, int16, int32).")
     parser.add_argument("--seg_input", action='store_true',
                         help="Indicate that the image to be conformed is a label map and nearest neighbor interpolation will be used instead of linear interpolation or spline.")
+    parser.add_argument("--np", type=int, default=1,
+                        help="Number of images conformed in parallel (default: 1).")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Number of threads used to resample each image (default: single-threaded, as in FastSurfer). Multiply by --np for the total number of threads.")
+    parser.add_argument("--cache_dir", default=None,
+                        help="Directory of a cache of conformed images. Inputs that were already conformed with the same parameters are taken from the cache instead of being conformed again.")
+    parser.add_argument("--cache_max_size_gb", type=float, default=None,
+                        help="Maximal size of the cache. The least recently used images are removed first (default: no limit).")
+    parser.add_argument("--cache_max_age_days", type=float, default=None,
+                        help="Images not used for this many days are removed from the cache (default: no limit).")
+    parser.add_argument("--cache_hardlink", action="store_true",
+                        help="Hard-link images from/to the cache instead of copying them. Only use this if the conformed images are never overwritten in place (e.g. by run_brain_extraction without -o).")
+    parser.add_argument("--compresslevel", type=int, default=default_gzip_compresslevel,
+                        help=f"gzip compression level (1-9) of .nii.gz outputs. Lower is faster, conformed images are usually intermediate files (default: {default_gzip_compresslevel}, or $nnUNet_gzip_compresslevel).")
+    parser.add_argument("--log", dest="log_file", default="",
+                        help="If specified, a log file that is written to (in addition to the console).")
 
     args = parser.parse_args()
     
-    conform_images(args.input_dir, args.output_dir, args.order, args.dtype, args.seg_input)
+    conform_images(args.input_dir, args.output_dir, args.order, args.dtype, args.seg_input, args.np, args.log_file,
+                   args.threads, args.cache_dir, args.cache_max_size_gb, args.cache_max_age_days, args.cache_hardlink,
+                   args.compresslevel)
 
 if __name__ == "__main__":
     main()
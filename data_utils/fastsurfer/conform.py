@@ -79,6 +79,9 @@ h_order = "order of interpolation (0=nearest, 1=linear(default), 2=quadratic, 3=
 
 LIA_AFFINE = np.array([[-1, 0, 0], [0, 0, 1], [0, -1, 0]])
 
+# number of voxels processed at once by getscale and scalecrop_to_dtype
+_CHUNK_SIZE = 2 ** 22
+
 
 class Criteria(Enum):
     FORCE_LIA_STRICT = "lia strict"
@@ -189,6 +192,14 @@ def make_parser() -> argparse.ArgumentParser:
         action="store_false",
         help="Ignore the forced image dimensions (depends on --conform_min).",
     )
+    advanced.add_argument(
+        "--threads",
+        dest="threads",
+        default=None,
+        type=int,
+        help="Number of threads for the resampling (default: single-threaded "
+             "scipy affine_transform on the whole image).",
+    )
     parser.add_argument(
         "--verbose",
         dest="verbose",
@@ -237,7 +248,8 @@ def map_image(
         out_shape: tuple[int, ...] | np.ndarray | Iterable[int],
         ras2ras: np.ndarray | None = None,
         order: int = 1,
-        dtype: type | None = None
+        dtype: type | None = None,
+        num_threads: int | None = None,
 ) -> np.ndarray:
     """
     Map image to new voxel space (RAS orientation).
@@ -257,6 +269,11 @@ def map_image(
     dtype : Type, optional
         Target dtype of the resulting image (relevant for reorientation,
         default=keep dtype of img).
+    num_threads : int, optional
+        If None (default), the image is mapped with a single call to
+        scipy.ndimage.affine_transform. Otherwise, the slab resampler is used with
+        num_threads threads (see map_image_data_threaded), which gives the same result
+        up to floating point rounding.
 
     Returns
     -------
@@ -306,11 +323,183 @@ def map_image(
         # this is a shortcut to reordering resampling
         order = 0
 
+    if num_threads is not None and image_data.ndim == 3:
+        return map_image_data_threaded(
+            image_data, inv(vox2vox), out_shape, order=order, num_threads=num_threads,
+        )
+
     return affine_transform(
         image_data, inv(vox2vox), output_shape=out_shape, order=order,
     )
 
 
+def _get_axis_aligned_mapping(
+        matrix: np.ndarray,
+        eps: float = 1e-9,
+) -> tuple[list[int], np.ndarray] | None:
+    """
+    Check whether an (inverse vox2vox) mapping only permutes, flips and scales the axes.
+
+    Parameters
+    ----------
+    matrix : np.ndarray
+        The 3x3 part of the mapping from target to source voxel coordinates.
+    eps : float, default=1e-9
+        Entries smaller than eps (relative to the largest entry) are considered 0.
+
+    Returns
+    -------
+    tuple[list[int], np.ndarray] or None
+        The source axis for each target axis and the (signed) scale per target axis, or
+        None if the mapping is not axis-aligned.
+    """
+    nonzero = np.abs(matrix) > eps * np.abs(matrix).max()
+    if not (np.all(nonzero.sum(0) == 1) and np.all(nonzero.sum(1) == 1)):
+        return None
+    src_axes = [int(np.argmax(nonzero[:, j])) for j in range(matrix.shape[1])]
+    scales = np.array([matrix[src_axes[j], j] for j in range(matrix.shape[1])])
+    return src_axes, scales
+
+
+def _run_threaded(function, jobs, num_threads: int) -> None:
+    """Run function(job) for all jobs with num_threads threads and re-raise errors."""
+    if num_threads <= 1:
+        for job in jobs:
+            function(job)
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(function, jobs))
+
+
+def _split(n: int, num_parts: int) -> list[slice]:
+    """Split range(n) into at most num_parts contiguous slices."""
+    bounds = np.linspace(0, n, min(num_parts, n) + 1).round().astype(int)
+    return [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:], strict=False) if b > a]
+
+
+def spline_filter_threaded(
+        data: np.ndarray,
+        order: int = 3,
+        mode: str = "constant",
+        num_threads: int = 1,
+) -> np.ndarray:
+    """
+    Same as scipy.ndimage.spline_filter(data, order, output=np.float64, mode=mode), but
+    each 1d filter pass is split into blocks along another axis that are filtered in
+    parallel. The 1d filters are independent across the other axes, so the result is
+    identical.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image data.
+    order : int, default=3
+        Spline order (2-5).
+    mode : str, default="constant"
+        Boundary mode of the spline filter.
+    num_threads : int, default=1
+        Number of threads.
+
+    Returns
+    -------
+    np.ndarray
+        Spline coefficients (float64).
+    """
+    from scipy.ndimage import spline_filter1d
+
+    output = np.empty(data.shape, dtype=np.float64)
+    source = data
+    for axis in range(data.ndim):
+        split_axis = (axis + 1) % data.ndim
+
+        def filter_block(block, _axis=axis, _split_axis=split_axis, _source=source):
+            index = tuple(block if d == _split_axis else slice(None) for d in range(data.ndim))
+            spline_filter1d(_source[index], order, axis=_axis, output=output[index], mode=mode)
+
+        _run_threaded(filter_block, _split(data.shape[split_axis], 4 * num_threads), num_threads)
+        source = output
+    return output
+
+
+def map_image_data_threaded(
+        image_data: np.ndarray,
+        matrix: np.ndarray,
+        out_shape: tuple[int, ...],
+        order: int = 1,
+        num_threads: int = 1,
+) -> np.ndarray:
+    """
+    Equivalent of scipy.ndimage.affine_transform(image_data, matrix, output_shape=out_shape,
+    order=order) for 3d images, but faster:
+
+    - the spline prefilter is computed once (in parallel, see spline_filter_threaded),
+    - the output is split into slabs along the first axis that are interpolated in
+      parallel (scipy.ndimage releases the GIL),
+    - if the mapping only permutes, flips and scales axes (e.g. conforming to a different
+      isotropic voxel size), the source axes are transposed to the target axes first so
+      that scipy's separable zoom/shift interpolation is used instead of the generic one.
+
+    Results match affine_transform up to floating point rounding of the coordinates. This
+    only shows where a target voxel maps exactly onto the first or last source voxel of an
+    axis (mode="constant" is cval right outside) or, for order=0, exactly halfway between
+    two source voxels.
+
+    Parameters
+    ----------
+    image_data : np.ndarray
+        The 3d source image data.
+    matrix : np.ndarray
+        4x4 (homogeneous) mapping from target to source voxel coordinates.
+    out_shape : tuple[int, ...]
+        The target shape.
+    order : int, default=1
+        Order of interpolation (0=nearest,1=linear,2=quadratic,3=cubic).
+    num_threads : int, default=1
+        Number of threads.
+
+    Returns
+    -------
+    np.ndarray
+        Mapped image data array (same dtype as image_data).
+    """
+    import warnings
+    from scipy.ndimage import affine_transform
+
+    out_shape = tuple(out_shape)
+    linear, offset = np.asarray(matrix[:3, :3], dtype=float), np.asarray(matrix[:3, 3], dtype=float)
+    output = np.empty(out_shape, dtype=image_data.dtype)
+
+    source = image_data
+    axis_aligned = _get_axis_aligned_mapping(linear)
+    if axis_aligned is not None:
+        # bring the source axes into target order, so that the mapping becomes
+        # source = scale * target + offset per axis. Flipped axes keep their negative scale:
+        # flipping the source instead would round ties of order=0 the other way
+        src_axes, scales = axis_aligned
+        source = np.transpose(image_data, src_axes)
+        offset = offset[src_axes]
+        linear = scales
+
+    if order > 1:
+        # same prefilter as in affine_transform (mode='constant' needs no padding)
+        source = spline_filter_threaded(source, order, mode="constant", num_threads=num_threads)
+
+    def map_slab(slab):
+        # offset of the first voxel of the slab in source coordinates
+        slab_offset = offset + (linear[:, 0] if linear.ndim == 2 else np.eye(3)[0] * linear) * slab.start
+        affine_transform(
+            source, linear, offset=slab_offset, output_shape=output[slab].shape,
+            output=output[slab], order=order, mode="constant", prefilter=False,
+        )
+
+    with warnings.catch_warnings():
+        # a 1d matrix selects the separable zoom/shift code path, which scipy warns about
+        warnings.filterwarnings("ignore", message="The behavior of affine_transform with a 1-D array")
+        _run_threaded(map_slab, _split(out_shape[0], 4 * num_threads), num_threads)
+    return output
+
+
 def getscale(
         data: np.ndarray,
         dst_min: float,
@@ -349,9 +538,20 @@ def getscale(
             "Invalid values for f_low or f_high, must be within 0 and 1."
         )
 
+    # all statistics are computed over chunks of the flattened data so that no full-size temporaries are needed.
+    # min and max are fused into one pass, the nonzero count and the histogram into a second one (the histogram
+    # range depends on min and max). Histograms with the same range and bins add up exactly
+    data_flat = _flat_view(data)
+
     # get min and max from source
-    data_min = np.min(data)
-    data_max = np.max(data)
+    data_min, data_max = None, None
+    for chunk in _iter_chunks(data_flat):
+        chunk_min, chunk_max = np.min(chunk), np.max(chunk)
+        if data_min is None:
+            data_min, data_max = chunk_min, chunk_max
+        else:
+            # np.minimum/np.maximum propagate NaNs like np.min/np.max on the full array
+            data_min, data_max = np.minimum(data_min, chunk_min), np.maximum(data_max, chunk_max)
 
     if data_min < 0.0:
         # logger. warning
@@ -363,12 +563,16 @@ def getscale(
         return data_min, 1.0
 
     # compute non-zeros and total vox num
-    num_nonzero_voxels = (np.abs(data) >= 1e-15).sum()
     num_total_voxels = data.shape[0] * data.shape[1] * data.shape[2]
 
     # compute histogram (number of samples)
     bins = 1000
-    hist, bin_edges = np.histogram(data, bins=bins, range=(data_min, data_max))
+    num_nonzero_voxels = 0
+    hist, bin_edges = None, None
+    for chunk in _iter_chunks(data_flat):
+        num_nonzero_voxels += np.count_nonzero(np.abs(chunk) >= 1e-15)
+        chunk_hist, bin_edges = np.histogram(chunk, bins=bins, range=(data_min, data_max))
+        hist = chunk_hist if hist is None else hist + chunk_hist
 
     # compute cumulative histogram
     cum_hist = np.concatenate(([0], np.cumsum(hist)))
@@ -418,6 +622,19 @@ def getscale(
     return src_min, scale
 
 
+def _flat_view(data: np.ndarray) -> np.ndarray:
+    """Flattened view of data (in memory order). Non-contiguous data is copied."""
+    if not (data.flags.c_contiguous or data.flags.f_contiguous):
+        data = np.ascontiguousarray(data)
+    return data.ravel(order="K")
+
+
+def _iter_chunks(data_flat: np.ndarray, chunk_size: int = _CHUNK_SIZE) -> Iterable[np.ndarray]:
+    """Consecutive views of at most chunk_size elements of a flat array."""
+    for start in range(0, max(data_flat.size, 1), chunk_size):
+        yield data_flat[start:start + chunk_size]
+
+
 def scalecrop(
         data: np.ndarray,
         dst_min: float,
@@ -457,6 +674,71 @@ def scalecrop(
     return data_new
 
 
+def scalecrop_to_dtype(
+        data: np.ndarray,
+        dst_min: float,
+        dst_max: float,
+        src_min: float,
+        scale: float,
+        dtype: npt.DTypeLike,
+        do_scale: bool = True,
+) -> np.ndarray:
+    """
+    Fused, chunked version of the intensity conversion at the end of conform().
+
+    Computes the same values as scalecrop (if do_scale), followed by setting voxels that are 0 in data back to 0,
+    rounding and clipping to 0..255 for uint8 and the final cast to dtype, but one chunk at a time and writing
+    directly into the output array. This avoids the full-size float64 temporaries.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image data (intensity values).
+    dst_min : float
+        Future minimal intensity value.
+    dst_max : float
+        Future maximal intensity value.
+    src_min : float
+        Minimal value to consider from source (crops below).
+    scale : float
+        Scale value by which source will be shifted.
+    dtype : npt.DTypeLike
+        Data type of the returned array.
+    do_scale : bool, default=True
+        Whether to apply scalecrop (otherwise only rounding/clipping for uint8 and the cast).
+
+    Returns
+    -------
+    np.ndarray
+        Scaled image data of type dtype.
+    """
+    target_dtype = np.dtype(dtype)
+    if not (data.flags.c_contiguous or data.flags.f_contiguous):
+        data = np.ascontiguousarray(data)
+    out = np.empty_like(data, dtype=target_dtype)
+    out_flat = out.ravel(order="K")
+    out_min, out_max = None, None
+    start = 0
+    for chunk in _iter_chunks(_flat_view(data)):
+        values = chunk
+        if do_scale:
+            # same operations as scalecrop, on a chunk
+            values = np.clip(dst_min + scale * (chunk - src_min), dst_min, dst_max)
+            if values.size > 0:
+                chunk_min, chunk_max = values.min(), values.max()
+                out_min = chunk_min if out_min is None else np.minimum(out_min, chunk_min)
+                out_max = chunk_max if out_max is None else np.maximum(out_max, chunk_max)
+            # map zero in input to zero in output (usually background)
+            values[chunk == 0] = 0
+        if target_dtype == np.dtype(np.uint8):
+            values = np.clip(np.rint(values), 0, 255)
+        np.copyto(out_flat[start:start + chunk.size], values, casting="unsafe")
+        start += chunk.size
+    if do_scale:
+        print("Output:   min: " + format(out_min) + "  max: " + format(out_max))
+    return out
+
+
 def rescale(
         data: np.ndarray,
         dst_min: float,
@@ -565,6 +847,7 @@ def conform(
         dtype: type | None = None,
         conform_to_1mm_threshold: float | None = None,
         criteria: set[Criteria] = DEFAULT_CRITERIA,
+        num_threads: int | None = None,
 ) -> nib.MGHImage:
     """Python version of mri_convert -c.
 
@@ -591,6 +874,9 @@ def conform(
     criteria : set[Criteria], default in DEFAULT_CRITERIA
         Whether to force the conforming to include a LIA data layout, an image size
         requirement and/or a voxel size requirement.
+    num_threads : int, optional
+        Number of threads for the resampling (see map_image). None (default) uses a
+        single call to scipy.ndimage.affine_transform.
 
     Returns
     -------
@@ -690,17 +976,12 @@ def conform(
     kwargs = {}
     if sctype != np.uint:
         kwargs["dtype"] = "float"
-    mapped_data = map_image(img, affine, h1.get_data_shape(), order=order, **kwargs)
-
-    if img_dtype != np.dtype(np.uint8) or (img_dtype != target_dtype and scale != 1.0):
-        scaled_data = scalecrop(mapped_data, 0, 255, src_min, scale)
-        # map zero in input to zero in output (usually background)
-        scaled_data[mapped_data == 0] = 0
-        mapped_data = scaled_data
+    mapped_data = map_image(img, affine, h1.get_data_shape(), order=order, num_threads=num_threads, **kwargs)
 
-    if target_dtype == np.dtype(np.uint8):
-        mapped_data = np.clip(np.rint(mapped_data), 0, 255)
-    new_img = nib.MGHImage(sctype(mapped_data), affine, h1)
+    # scale (and map zero in input to zero in output), round/clip for uint8 and cast in one chunked pass
+    do_scale = img_dtype != np.dtype(np.uint8) or (img_dtype != target_dtype and scale != 1.0)
+    mapped_data = scalecrop_to_dtype(mapped_data, 0, 255, src_min, scale, target_dtype, do_scale=do_scale)
+    new_img = nib.MGHImage(mapped_data, affine, h1)
 
     # make sure we store uchar
     from nibabel.freesurfer import mghformat
@@ -712,7 +993,7 @@ def conform(
         dtype_codes = mghformat.data_type_codes.code.keys()
         codes = set(k.name for k in dtype_codes if isinstance(k, np.dtype))
         print(
-            f"The data type '{options.dtype}' is not recognized for MGH images, "
+            f"The data type '{dtype}' is not recognized for MGH images, "
             f"switching to '{new_img.get_data_dtype()}' (supported: {tuple(codes)})."
         )
 
@@ -1069,6 +1350,7 @@ if __name__ == "__main__":
             image,
             order=options.order,
             conform_vox_size=_vox_size,
+            num_threads=options.threads,
             **opt_kwargs,
         )
     except ValueError as e:
@@ -10,12 +10,50 @@ def extract_sub_id(filename, start_substring=None, end_substring=None):
     start = base.find(start_substring) if start_substring else 0
     if start == -1:
         return None
-    start += len(start_substring)
+    if start_substring:
+        start += len(start_substring)
     end = base.find(end_substring, start) if end_substring else len(base)
     if end == -1:
         return None
     return base[start:end]
 
+def build_sub_id_index(filenames, start_substring=None, end_substring=None):
+    """Map each subject ID (see extract_sub_id) to the sorted list of filenames with that ID."""
+    index = {}
+    for filename in sorted(filenames):
+        sub_id = extract_sub_id(filename, start_substring, end_substring)
+        if sub_id is not None:
+            index.setdefault(sub_id, []).append(filename)
+    return index
+
+def match_mask_to_image(mask_filename, input_index, input_filenames, start_substring=None, end_substring=None):
+    """
+    Find the input image belonging to mask_filename. Returns None (and says why) if there is no unique match.
+
+    The subject ID of the mask is extracted like in run_renaming after removing 'mask' (and the separators around
+    it) from the filename, and looked up in input_index (see build_sub_id_index). Masks whose ID is not in the
+    index fall back to the previous behaviour of looking for an input filename that contains the mask filename
+    without 'mask'. This scans all input filenames, so each fallback is reported: if many masks need it,
+    start_substring/end_substring probably do not match the mask filenames.
+    """
+    mask_id = extract_sub_id(mask_filename.replace('mask', ''), start_substring, end_substring)
+    if mask_id is not None:
+        mask_id = mask_id.strip('_-.')
+    candidates = input_index.get(mask_id)
+    if candidates is None:
+        subject_id = mask_filename.replace('mask', '')
+        print(f"Subject ID {mask_id} of mask {mask_filename} is not among the input images, "
+              f"looking for input filenames containing {subject_id} instead.")
+        candidates = [f for f in input_filenames if subject_id in f]
+
+    if not candidates:
+        print(f"No matching image found for mask {mask_filename}")
+        return None
+    if len(candidates) > 1:
+        print(f"Several images match mask {mask_filename} ({', '.join(sorted(candidates))}). Skipping it.")
+        return None
+    return candidates[0]
+
 def rename_files_in_subfolder(input_dir, output_folder=None, start_substring=None, end_substring=None, segms=False):
     if output_folder is None:
         output_folder = input_dir
@@ -19,9 +19,13 @@
 
 import os
 import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import nibabel as nib
 import numpy as np
 
+from nnunetv2.configuration import default_gzip_threads
+from nnunetv2.imageio.parallel_gzip import gzip_threads_per_process, load_nifti, save_nifti
+
 def load_labels(label_file):
     """Reads a label text file and returns a dictionary mapping label IDs to label names."""
     labels = {}
@@ -38,48 +42,59 @@ def load_labels(label_file):
 
 def create_mapping(old_labels, new_labels):
     """Create a dictionary mapping old label IDs to new label IDs based on label names."""
-    mapping = {}
-    for old_id, old_name in old_labels.items():
-        # Find the corresponding new label ID based on name matching
-        for new_id, new_name in new_labels.items():
-            if old_name == new_name:
-                mapping[old_id] = new_id
-                break
-    return mapping
-
-def process_label_map(file_path, output_dir, mapping):
-    print(f"Processing file: {file_path}")
-    # Load the label map file
-    img = nib.load(file_path)
-    data = img.get_fdata()
-
-    # Ensure the data is handled as integer
-    unique_raw_labels = np.unique(data)
-    rounded_int_label_map = np.round(data).astype(np.int32)  # Round first, and then convert to integer
-
-    # Debug: print the shape and data type of the loaded image
-    print(f"Loaded {file_path}, shape: {rounded_int_label_map.shape}, dtype: {rounded_int_label_map.dtype}")
-
-    # Map the new labels back to the original labels
-    new_data = np.copy(rounded_int_label_map)
-    for old_label, new_label in mapping.items():
-        print(f"Switching label {old_label} to {new_label}")
-        new_data[rounded_int_label_map == old_label] = new_label
-
-    new_data_rd = np.round(new_data).astype(np.int32)
+    # Index the new labels by name once. If a name appears several times, the first ID is used (as before)
+    new_ids_by_name = {}
+    for new_id, new_name in new_labels.items():
+        new_ids_by_name.setdefault(new_name, new_id)
+    return {old_id: new_ids_by_name[old_name] for old_id, old_name in old_labels.items() if old_name in new_ids_by_name}
+
+def create_lookup_table(mapping, num_labels=None):
+    """Compile a mapping dictionary into a lookup table (lut[old_id] = new_id). Labels absent from the mapping keep their value."""
+    if num_labels is None:
+        num_labels = max(mapping.keys(), default=0) + 1
+    lut = np.arange(num_labels, dtype=np.int32)
+    for old_id, new_id in mapping.items():
+        if old_id < num_labels:
+            lut[old_id] = new_id
+    return lut
+
+def remap_labels(segmentation, lut):
+    """Remap a label map with a lookup table from create_lookup_table. Usable as an nnU-Net postprocessing function.
+    Labels outside of the lookup table (negative or too large) keep their value."""
+    if segmentation.size == 0 or (segmentation.min() >= 0 and segmentation.max() < len(lut)):
+        return lut[segmentation]
+    # Indexing with negative labels would read the lookup table from the end
+    in_range = (segmentation >= 0) & (segmentation < len(lut))
+    return np.where(in_range, lut[np.clip(segmentation, 0, len(lut) - 1)], segmentation)
+
+def process_label_map(file_path, output_dir, lut, gzip_threads=default_gzip_threads):
+    # Load the label map in its stored (integer) dtype instead of float64
+    img = load_nifti(file_path, gzip_threads)
+    data = np.asanyarray(img.dataobj)
+
+    # Label maps stored as floats (or with a scaling factor) are rounded first, as before
+    if not np.issubdtype(data.dtype, np.integer):
+        data = np.round(data).astype(np.int32)
+
+    # Map all labels in a single pass. Labels that are not in the old LUT keep their value
+    new_data = remap_labels(data, lut)
 
     # Save the modified label map
-    new_affine = img.affine
-    new_header = img.header
+    new_header = img.header.copy()
     new_header.set_data_dtype(np.int32)
-
-    # Save the new label map file
-    new_img = nib.Nifti1Image(new_data_rd, new_affine, new_header)
+    new_img = nib.Nifti1Image(new_data, img.affine, new_header)
     new_file_path = os.path.join(output_dir, os.path.basename(file_path))
-    nib.save(new_img, new_file_path)
+    save_nifti(new_img, new_file_path, threads=gzip_threads)
     print(f"Processed {file_path} -> {new_file_path}")
 
-def process_directory(input_dir, output_dir, old_labels_file, new_labels_file):
+def is_up_to_date(input_file, output_file, dependencies=()):
+    """True if output_file exists and is newer than input_file and all the dependencies (e.g. the LUT files)."""
+    if not os.path.isfile(output_file):
+        return False
+    output_mtime = os.path.getmtime(output_file)
+    return all(os.path.getmtime(f) <= output_mtime for f in (input_file, *dependencies))
+
+def process_directory(input_dir, output_dir, old_labels_file, new_labels_file, num_processes=1, incremental=False):
     # Ensure the output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
@@ -87,14 +102,43 @@ def process_directory(input_dir, output_dir, old_labels_file, new_labels_file):
     old_labels = load_labels(old_labels_file)
     new_labels = load_labels(new_labels_file)
 
-    # Create the mapping based on the label names
+    # Create the mapping based on the label names and compile it into a lookup table once for all files
     mapping = create_mapping(old_labels, new_labels)
-
-    # Process each .nii.gz file in the input directory
-    for filename in os.listdir(input_dir):
-        if filename.endswith('.nii.gz'):
-            file_path = os.path.join(input_dir, filename)
-            process_label_map(file_path, output_dir, mapping)
+    for old_label, new_label in sorted(mapping.items()):
+        print(f"Switching label {old_label} to {new_label}")
+    lut = create_lookup_table(mapping)
+
+    # Collect the .nii.gz files in the input directory
+    file_paths = [os.path.join(input_dir, filename) for filename in sorted(os.listdir(input_dir))
+                  if filename.endswith('.nii.gz')]
+    if incremental:
+        # Outputs newer than their input (and the LUT files) are kept as they are
+        todo = [f for f in file_paths if not is_up_to_date(f, os.path.join(output_dir, os.path.basename(f)),
+                                                          (old_labels_file, new_labels_file))]
+        print(f"Skipping {len(file_paths) - len(todo)} up-to-date label maps.")
+        file_paths = todo
+
+    if num_processes <= 1:
+        for file_path in file_paths:
+            process_label_map(file_path, output_dir, lut)
+        return
+
+    # The gzip threads are shared by the workers instead of every worker starting nnUNet_gzip_threads threads
+    gzip_threads = gzip_threads_per_process(num_processes)
+
+    # Each worker reads, remaps and writes whole files so that gzip decoding/encoding of different cases overlaps.
+    # At most 2 * num_processes files are in flight so that a directory of thousands of maps is not queued at once
+    max_in_flight = 2 * num_processes
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        in_flight = set()
+        for file_path in file_paths:
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            in_flight.add(executor.submit(process_label_map, file_path, output_dir, lut, gzip_threads))
+        for future in in_flight:
+            future.result()
 
 def main():
     # Argument parser
@@ -107,6 +151,10 @@ def main():
                         help="Path to the text file containing GOUHFI's label definitions (label IDs and names).")
     parser.add_argument('--new_labels_file', type=str, required=True, default=None,
                         help="Path to the text file containing FreeSurfer/new label definitions (label IDs and names).")
+    parser.add_argument('--np', type=int, default=1,
+                        help="Number of label maps processed in parallel (default: 1).")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Set flag to skip label maps whose output already exists and is newer than the input and the label files.")
     args = parser.parse_args()
 
     # Derive output_dir from input_dir if it is not provided
@@ -118,7 +166,8 @@ def main():
     print(f"Old labels file: {args.old_labels_file}")
     print(f"New labels file: {args.new_labels_file}")
 
-    process_directory(args.input_dir, args.output_dir, args.old_labels_file, args.new_labels_file)
+    process_directory(args.input_dir, args.output_dir, args.old_labels_file, args.new_labels_file,
+                      num_processes=args.np, incremental=args.incremental)
     print("Done reordering label values.")
 
 if __name__ == "__main__":
@@ -4,6 +4,11 @@ from nnunetv2.utilities.default_n_proc_DA import get_allowed_n_proc_DA
 
 default_num_processes = 8 if 'nnUNet_def_n_proc' not in os.environ else int(os.environ['nnUNet_def_n_proc'])
 
+# used by nnunetv2.imageio.parallel_gzip for .nii.gz files. nibabel itself writes with compression level 1
+default_gzip_threads = 4 if 'nnUNet_gzip_threads' not in os.environ else int(os.environ['nnUNet_gzip_threads'])
+default_gzip_compresslevel = 1 if 'nnUNet_gzip_compresslevel' not in os.environ else \
+    int(os.environ['nnUNet_gzip_compresslevel'])
+
 ANISO_THRESHOLD = 3  # determines when a sample is considered anisotropic (3 means that the spacing in the low
 # resolution axis must be 3x as large as the next largest spacing)
 
@@ -18,9 +18,21 @@ import numpy as np
 from nibabel import io_orientation
 
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
+from nnunetv2.imageio.parallel_gzip import load_nifti, save_nifti
 import nibabel
 
 
+def stack_as_float32(images: List[np.ndarray]) -> np.ndarray:
+    """
+    Stacks the (1, x, y, z) arrays in images (any dtype, may be non-contiguous views) into a single contiguous float32
+    array. Same result as np.vstack(images).astype(np.float32) but without the intermediate copies.
+    """
+    stacked_images = np.empty((len(images), *images[0].shape[1:]), dtype=np.float32)
+    for c, image in enumerate(images):
+        stacked_images[c] = image[0]
+    return stacked_images
+
+
 class NibabelIO(BaseReaderWriter):
     """
     Nibabel loads the images in a different order than sitk. We convert the axes to the sitk order to be
@@ -40,7 +52,7 @@ class NibabelIO(BaseReaderWriter):
 
         spacings_for_nnunet = []
         for f in image_fnames:
-            nib_image = nibabel.load(f)
+            nib_image = self.load_image(f)
             assert nib_image.ndim == 3, 'only 3d images are supported by NibabelIO'
             original_affine = nib_image.affine
 
@@ -52,7 +64,9 @@ class NibabelIO(BaseReaderWriter):
             )
 
             # transpose image to be consistent with the way SimpleITk reads images. Yeah. Annoying.
-            images.append(nib_image.get_fdata().transpose((2, 1, 0))[None])
+            # The data is read in its on-disk dtype (scaled data comes as float64, like get_fdata) and the transpose
+            # is a view. The only float32 copy is made in stack_as_float32
+            images.append(np.asanyarray(nib_image.dataobj).transpose((2, 1, 0))[None])
 
         if not self._check_all_same([i.shape for i in images]):
             print('ERROR! Not all input images have the same shape!')
@@ -78,23 +92,30 @@ class NibabelIO(BaseReaderWriter):
             print(image_fnames)
             raise RuntimeError()
 
-        stacked_images = np.vstack(images)
+        stacked_images = stack_as_float32(images)
+        del images
         dict = {
             'nibabel_stuff': {
                 'original_affine': original_affines[0],
             },
             'spacing': spacings_for_nnunet[0]
         }
-        return stacked_images.astype(np.float32), dict
+        return stacked_images, dict
 
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname, ))
 
+    def load_image(self, fname: str):
+        return nibabel.load(fname)
+
+    def save_image(self, image, output_fname: str) -> None:
+        nibabel.save(image, output_fname)
+
     def write_seg(self, seg: np.ndarray, output_fname: str, properties: dict) -> None:
         # revert transpose
         seg = seg.transpose((2, 1, 0)).astype(np.uint8)
         seg_nib = nibabel.Nifti1Image(seg, affine=properties['nibabel_stuff']['original_affine'])
-        nibabel.save(seg_nib, output_fname)
+        self.save_image(seg_nib, output_fname)
 
 
 class NibabelIOWithReorient(BaseReaderWriter):
@@ -119,7 +140,7 @@ class NibabelIOWithReorient(BaseReaderWriter):
 
         spacings_for_nnunet = []
         for f in image_fnames:
-            nib_image = nibabel.load(f)
+            nib_image = self.load_image(f)
             assert nib_image.ndim == 3, 'only 3d images are supported by NibabelIO'
             original_affine = nib_image.affine
             reoriented_image = nib_image.as_reoriented(io_orientation(original_affine))
@@ -134,7 +155,9 @@ class NibabelIOWithReorient(BaseReaderWriter):
             )
 
             # transpose image to be consistent with the way SimpleITk reads images. Yeah. Annoying.
-            images.append(reoriented_image.get_fdata().transpose((2, 1, 0))[None])
+            # as_reoriented only flips and swaps axes of the data in its on-disk dtype (scaled data comes as float64,
+            # like get_fdata), so this and the transpose are views. The only float32 copy is made in stack_as_float32
+            images.append(np.asanyarray(reoriented_image.dataobj).transpose((2, 1, 0))[None])
 
         if not self._check_all_same([i.shape for i in images]):
             print('ERROR! Not all input images have the same shape!')
@@ -160,7 +183,8 @@ class NibabelIOWithReorient(BaseReaderWriter):
             print(image_fnames)
             raise RuntimeError()
 
-        stacked_images = np.vstack(images)
+        stacked_images = stack_as_float32(images)
+        del images
         dict = {
             'nibabel_stuff': {
                 'original_affine': original_affines[0],
@@ -168,11 +192,17 @@ class NibabelIOWithReorient(BaseReaderWriter):
             },
             'spacing': spacings_for_nnunet[0]
         }
-        return stacked_images.astype(np.float32), dict
+        return stacked_images, dict
 
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname, ))
 
+    def load_image(self, fname: str):
+        return nibabel.load(fname)
+
+    def save_image(self, image, output_fname: str) -> None:
+        nibabel.save(image, output_fname)
+
     def write_seg(self, seg: np.ndarray, output_fname: str, properties: dict) -> None:
         # revert transpose
         seg = seg.transpose((2, 1, 0)).astype(np.uint8)
@@ -181,7 +211,32 @@ class NibabelIOWithReorient(BaseReaderWriter):
         seg_nib_reoriented = seg_nib.as_reoriented(io_orientation(properties['nibabel_stuff']['original_affine']))
         assert np.allclose(properties['nibabel_stuff']['original_affine'], seg_nib_reoriented.affine), \
             'restored affine does not match original affine'
-        nibabel.save(seg_nib_reoriented, output_fname)
+        self.save_image(seg_nib_reoriented, output_fname)
+
+
+class NibabelIOParallelGzip(NibabelIO):
+    """
+    NibabelIO that decompresses and compresses .nii.gz files with a multithreaded gzip engine (see
+    nnunetv2.imageio.parallel_gzip). Threads and compression level are set with the nnUNet_gzip_threads and
+    nnUNet_gzip_compresslevel environment variables. The files are standard .nii.gz files.
+    """
+    def load_image(self, fname: str):
+        return load_nifti(fname)
+
+    def save_image(self, image, output_fname: str) -> None:
+        save_nifti(image, output_fname)
+
+
+class NibabelIOWithReorientParallelGzip(NibabelIOWithReorient):
+    """
+    NibabelIOWithReorient that decompresses and compresses .nii.gz files with a multithreaded gzip engine (see
+    NibabelIOParallelGzip).
+    """
+    def load_image(self, fname: str):
+        return load_nifti(fname)
+
+    def save_image(self, image, output_fname: str) -> None:
+        save_nifti(image, output_fname)
 
 
 if __name__ == '__main__':
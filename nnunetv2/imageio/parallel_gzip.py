@@ -0,0 +1,91 @@
+import gzip
+import shutil
+import subprocess
+
+import nibabel
+
+from nnunetv2.configuration import default_gzip_compresslevel, default_gzip_threads
+
+# Multithreaded gzip engines, best first. All of them read and write standard gzip files (.nii.gz stays readable by
+# FreeSurfer, ITK, nibabel, ...). If none is installed we fall back to the (single threaded) gzip module
+try:
+    from zlib_ng import gzip_ng_threaded
+except ImportError:
+    gzip_ng_threaded = None
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+pigz_executable = shutil.which('pigz')
+
+
+def gzip_threads_per_process(num_processes: int, threads: int = default_gzip_threads) -> int:
+    """Threads per process if num_processes processes read/write files at the same time, threads in total"""
+    return max(1, threads // max(1, num_processes))
+
+
+def _isal_compresslevel(compresslevel: int) -> int:
+    # ISA-L only has the levels 0 (fastest) to 3 (best)
+    return min(3, max(0, (compresslevel - 1) // 2))
+
+
+def read_gzip_file(fname: str, threads: int = default_gzip_threads) -> bytes:
+    """Decompresses fname. Decompression runs in its own threads while the file is read."""
+    if gzip_ng_threaded is not None:
+        with gzip_ng_threaded.open(fname, 'rb', threads=threads) as f:
+            return f.read()
+    if igzip_threaded is not None:
+        with igzip_threaded.open(fname, 'rb', threads=threads) as f:
+            return f.read()
+    if pigz_executable is not None:
+        return subprocess.run([pigz_executable, '-d', '-c', fname], stdout=subprocess.PIPE, check=True).stdout
+    with gzip.open(fname, 'rb') as f:
+        return f.read()
+
+
+def write_gzip_file(fname: str, data: bytes, compresslevel: int = default_gzip_compresslevel,
+                    threads: int = default_gzip_threads) -> None:
+    """Compresses data into fname with compresslevel (1-9, like gzip) using up to threads threads."""
+    if gzip_ng_threaded is not None:
+        with gzip_ng_threaded.open(fname, 'wb', compresslevel=compresslevel, threads=threads) as f:
+            f.write(data)
+    elif igzip_threaded is not None:
+        with igzip_threaded.open(fname, 'wb', compresslevel=_isal_compresslevel(compresslevel),
+                                 threads=threads) as f:
+            f.write(data)
+    elif pigz_executable is not None:
+        with open(fname, 'wb') as f:
+            subprocess.run([pigz_executable, f'-{compresslevel}', '-p', str(threads), '-c'], input=data, stdout=f,
+                           check=True)
+    else:
+        with gzip.open(fname, 'wb', compresslevel=compresslevel) as f:
+            f.write(data)
+
+
+def load_nifti(fname: str, threads: int = default_gzip_threads):
+    """
+    nibabel.load, but .nii.gz files are decompressed with read_gzip_file. The whole decompressed file is held in memory
+    (by the file map of the returned image) on top of the array read from it, so peak memory is about twice the size
+    of the array
+    """
+    if not fname.endswith('.nii.gz'):
+        return nibabel.load(fname)
+    data = read_gzip_file(fname, threads)
+    # sizeof_hdr is 348 for NIfTI-1 and 540 for NIfTI-2 (in either byte order)
+    is_nifti2 = 540 in (int.from_bytes(data[:4], 'little'), int.from_bytes(data[:4], 'big'))
+    image_class = nibabel.Nifti2Image if is_nifti2 else nibabel.Nifti1Image
+    return image_class.from_bytes(data)
+
+
+def save_nifti(image, fname: str, compresslevel: int = default_gzip_compresslevel,
+               threads: int = default_gzip_threads) -> None:
+    """
+    nibabel.save, but .nii.gz files are compressed with write_gzip_file. The whole uncompressed file is built in memory
+    before it is compressed, on top of the image data, so peak memory is about twice the size of the array
+    """
+    if not fname.endswith('.nii.gz'):
+        nibabel.save(image, fname)
+        return
+    if not isinstance(image, (nibabel.Nifti1Image, nibabel.Nifti2Image)):
+        image = nibabel.Nifti1Image.from_image(image)
+    write_gzip_file(fname, image.to_bytes(), compresslevel, threads)
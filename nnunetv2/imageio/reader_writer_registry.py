@@ -5,7 +5,8 @@ from batchgenerators.utilities.file_and_folder_operations import join
 
 import nnunetv2
 from nnunetv2.imageio.natural_image_reader_writer import NaturalImage2DIO
-from nnunetv2.imageio.nibabel_reader_writer import NibabelIO, NibabelIOWithReorient
+from nnunetv2.imageio.nibabel_reader_writer import NibabelIO, NibabelIOWithReorient, NibabelIOParallelGzip, \
+    NibabelIOWithReorientParallelGzip
 from nnunetv2.imageio.simpleitk_reader_writer import SimpleITKIO
 from nnunetv2.imageio.tif_reader_writer import Tiff3DIO
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
@@ -16,7 +17,9 @@ LIST_OF_IO_CLASSES = [
     SimpleITKIO,
     Tiff3DIO,
     NibabelIO,
-    NibabelIOWithReorient
+    NibabelIOWithReorient,
+    NibabelIOParallelGzip,
+    NibabelIOWithReorientParallelGzip
 ]
 
 
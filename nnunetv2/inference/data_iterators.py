@@ -1,8 +1,8 @@
 import multiprocessing
 import queue
+import shutil
 from torch.multiprocessing import Event, Process, Queue, Manager
 
-from time import sleep
 from typing import Union, List
 
 import numpy as np
@@ -12,45 +12,39 @@ from batchgenerators.dataloading.data_loader import DataLoader
 from nnunetv2.preprocessing.preprocessors.default_preprocessor import DefaultPreprocessor
 from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.shared_data import make_shared_data_dir, share_data, receive_data
 
 
-def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
-                                       list_of_segs_from_prev_stage_files: Union[None, List[str]],
-                                       output_filenames_truncated: Union[None, List[str]],
+def preprocess_fromfiles_save_to_queue(task_queue: Queue,
                                        plans_manager: PlansManager,
                                        dataset_json: dict,
                                        configuration_manager: ConfigurationManager,
                                        target_queue: Queue,
                                        done_event: Event,
                                        abort_event: Event,
-                                       verbose: bool = False):
+                                       verbose: bool = False,
+                                       shared_dir: Union[str, None] = None):
+    """
+    Takes (idx, (input_files, seg_from_prev_stage_file, output_filename_truncated)) tasks from task_queue until it
+    gets None and puts (idx, item) into target_queue.
+    """
     try:
         label_manager = plans_manager.get_label_manager(dataset_json)
         preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
-        for idx in range(len(list_of_lists)):
-            data, seg, data_properties = preprocessor.run_case(list_of_lists[idx],
-                                                               list_of_segs_from_prev_stage_files[
-                                                                   idx] if list_of_segs_from_prev_stage_files is not None else None,
+        for idx, (input_files, seg_prev_stage_file, ofile) in iter(task_queue.get, None):
+            if abort_event.is_set():
+                return
+            data, seg, data_properties = preprocessor.run_case(input_files,
+                                                               seg_prev_stage_file,
                                                                plans_manager,
                                                                configuration_manager,
                                                                dataset_json)
-            if list_of_segs_from_prev_stage_files is not None and list_of_segs_from_prev_stage_files[idx] is not None:
+            if seg_prev_stage_file is not None:
                 seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
                 data = np.vstack((data, seg_onehot))
 
-            data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
-
-            item = {'data': data, 'data_properties': data_properties,
-                    'ofile': output_filenames_truncated[idx] if output_filenames_truncated is not None else None}
-            success = False
-            while not success:
-                try:
-                    if abort_event.is_set():
-                        return
-                    target_queue.put(item, timeout=0.01)
-                    success = True
-                except queue.Full:
-                    pass
+            item = {'data': share_data(data, shared_dir), 'data_properties': data_properties, 'ofile': ofile}
+            target_queue.put((idx, item))
         done_event.set()
     except Exception as e:
         # print(Exception, e)
@@ -58,65 +52,128 @@ def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
         raise e
 
 
-def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
-                                     list_of_segs_from_prev_stage_files: Union[None, List[str]],
-                                     output_filenames_truncated: Union[None, List[str]],
-                                     plans_manager: PlansManager,
-                                     dataset_json: dict,
-                                     configuration_manager: ConfigurationManager,
-                                     num_processes: int,
-                                     pin_memory: bool = False,
-                                     verbose: bool = False):
+def preprocessing_iterator_from_tasks(worker_fn,
+                                      tasks: List[tuple],
+                                      plans_manager: PlansManager,
+                                      dataset_json: dict,
+                                      configuration_manager: ConfigurationManager,
+                                      num_processes: int,
+                                      preserve_order: bool,
+                                      pin_memory: bool = False,
+                                      verbose: bool = False,
+                                      share_task_arrays: bool = False):
+    """
+    Runs worker_fn (see preprocess_fromfiles_save_to_queue) in num_processes processes that all take their cases
+    from one task queue, so a large case only occupies the worker that processes it. Cases are yielded as soon as they
+    are ready unless preserve_order is set (needed when the results are returned instead of written to files).
+    The main process hands out at most 2 * num_processes cases ahead of the ones that were consumed so that the
+    preprocessed data does not pile up.
+    If share_task_arrays is set, the arrays in the tasks are handed to the workers as files in the shared directory
+    (see share_data), so only small messages go through the manager's queues. worker_fn must receive_data them.
+    """
     context = multiprocessing.get_context('spawn')
     manager = Manager()
-    num_processes = min(len(list_of_lists), num_processes)
+    num_processes = min(len(tasks), num_processes)
     assert num_processes >= 1
     processes = []
     done_events = []
-    target_queues = []
     abort_event = manager.Event()
+    task_queue = manager.Queue()
+    target_queue = manager.Queue()
+    shared_dir = make_shared_data_dir()
     for i in range(num_processes):
         event = manager.Event()
-        queue = Manager().Queue(maxsize=1)
-        pr = context.Process(target=preprocess_fromfiles_save_to_queue,
-                     args=(
-                         list_of_lists[i::num_processes],
-                         list_of_segs_from_prev_stage_files[
-                         i::num_processes] if list_of_segs_from_prev_stage_files is not None else None,
-                         output_filenames_truncated[
-                         i::num_processes] if output_filenames_truncated is not None else None,
-                         plans_manager,
-                         dataset_json,
-                         configuration_manager,
-                         queue,
-                         event,
-                         abort_event,
-                         verbose
-                     ), daemon=True)
+        pr = context.Process(target=worker_fn,
+                             args=(
+                                 task_queue,
+                                 plans_manager,
+                                 dataset_json,
+                                 configuration_manager,
+                                 target_queue,
+                                 event,
+                                 abort_event,
+                                 verbose,
+                                 shared_dir
+                             ), daemon=True)
         pr.start()
-        target_queues.append(queue)
         done_events.append(event)
         processes.append(pr)
 
-    worker_ctr = 0
-    while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
-        # import IPython;IPython.embed()
-        if not target_queues[worker_ctr].empty():
-            item = target_queues[worker_ctr].get()
-            worker_ctr = (worker_ctr + 1) % num_processes
-        else:
-            all_ok = all(
-                [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
-            if not all_ok:
-                raise RuntimeError('Background workers died. Look for the error message further up! If there is '
-                                   'none then your RAM was full and the worker was killed by the OS. Use fewer '
-                                   'workers or get more RAM in that case!')
-            sleep(0.01)
-            continue
-        if pin_memory:
-            [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
-        yield item
-    [p.join() for p in processes]
+    next_task = 0
+
+    def hand_out_tasks(num_tasks: int):
+        nonlocal next_task
+        for _ in range(min(num_tasks, len(tasks) - next_task)):
+            task = tasks[next_task]
+            if share_task_arrays:
+                task = tuple(share_data(i, shared_dir, dtype=None) if isinstance(i, np.ndarray) else i for i in task)
+            task_queue.put((next_task, task))
+            next_task += 1
+            if next_task == len(tasks):
+                # no more work, let the workers finish
+                [task_queue.put(None) for _ in range(num_processes)]
+
+    finished = False
+    try:
+        hand_out_tasks(2 * num_processes)
+        ready = {}
+        next_to_yield = 0
+        for _ in range(len(tasks)):
+            while True:
+                try:
+                    # wakes up as soon as any worker delivers. The timeout is only there to notice dead workers
+                    idx, item = target_queue.get(timeout=1)
+                    break
+                except queue.Empty:
+                    all_ok = all(
+                        [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
+                    if not all_ok:
+                        raise RuntimeError('Background workers died. Look for the error message further up! If there '
+                                           'is none then your RAM was full and the worker was killed by the OS. Use '
+                                           'fewer workers or get more RAM in that case!')
+            if preserve_order:
+                ready[idx] = item
+                items = []
+                while next_to_yield in ready:
+                    items.append(ready.pop(next_to_yield))
+                    next_to_yield += 1
+            else:
+                items = [item]
+            for item in items:
+                item['data'] = receive_data(item['data'])
+                if pin_memory:
+                    [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
+                yield item
+                hand_out_tasks(1)
+        [p.join() for p in processes]
+        finished = True
+    finally:
+        if not finished:
+            # error or the consumer stopped early
+            abort_event.set()
+            [p.terminate() for p in processes if p.is_alive()]
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+
+def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
+                                     list_of_segs_from_prev_stage_files: Union[None, List[str]],
+                                     output_filenames_truncated: Union[None, List[str]],
+                                     plans_manager: PlansManager,
+                                     dataset_json: dict,
+                                     configuration_manager: ConfigurationManager,
+                                     num_processes: int,
+                                     pin_memory: bool = False,
+                                     verbose: bool = False):
+    if list_of_segs_from_prev_stage_files is None:
+        list_of_segs_from_prev_stage_files = [None] * len(list_of_lists)
+    if output_filenames_truncated is None:
+        output_filenames_truncated = [None] * len(list_of_lists)
+    tasks = list(zip(list_of_lists, list_of_segs_from_prev_stage_files, output_filenames_truncated))
+    # results that are returned (no output file) must come back in the order of the inputs
+    preserve_order = any(ofile is None for ofile in output_filenames_truncated)
+    return preprocessing_iterator_from_tasks(preprocess_fromfiles_save_to_queue, tasks, plans_manager, dataset_json,
+                                             configuration_manager, num_processes, preserve_order, pin_memory,
+                                             verbose)
 
 class PreprocessAdapter(DataLoader):
     def __init__(self, list_of_lists: List[List[str]],
@@ -207,45 +264,40 @@ class PreprocessAdapterFromNpy(DataLoader):
         return {'data': data, 'data_properties': props, 'ofile': ofname}
 
 
-def preprocess_fromnpy_save_to_queue(list_of_images: List[np.ndarray],
-                                     list_of_segs_from_prev_stage: Union[List[np.ndarray], None],
-                                     list_of_image_properties: List[dict],
-                                     truncated_ofnames: Union[List[str], None],
+def preprocess_fromnpy_save_to_queue(task_queue: Queue,
                                      plans_manager: PlansManager,
                                      dataset_json: dict,
                                      configuration_manager: ConfigurationManager,
                                      target_queue: Queue,
                                      done_event: Event,
                                      abort_event: Event,
-                                     verbose: bool = False):
+                                     verbose: bool = False,
+                                     shared_dir: Union[str, None] = None):
+    """
+    Takes (idx, (image, seg_from_prev_stage, image_properties, truncated_ofname)) tasks from task_queue until it gets
+    None and puts (idx, item) into target_queue. image and seg_from_prev_stage come as shared files (see share_data).
+    """
     try:
         label_manager = plans_manager.get_label_manager(dataset_json)
         preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
-        for idx in range(len(list_of_images)):
-            data, seg = preprocessor.run_case_npy(list_of_images[idx],
-                                                  list_of_segs_from_prev_stage[
-                                                      idx] if list_of_segs_from_prev_stage is not None else None,
-                                                  list_of_image_properties[idx],
+        for idx, (image, seg_prev_stage, image_properties, ofname) in iter(task_queue.get, None):
+            if abort_event.is_set():
+                return
+            image = receive_data(image).numpy()
+            if seg_prev_stage is not None:
+                seg_prev_stage = receive_data(seg_prev_stage).numpy()
+            data, seg = preprocessor.run_case_npy(image,
+                                                  seg_prev_stage,
+                                                  image_properties,
                                                   plans_manager,
                                                   configuration_manager,
                                                   dataset_json)
-            if list_of_segs_from_prev_stage is not None and list_of_segs_from_prev_stage[idx] is not None:
+            if seg_prev_stage is not None:
                 seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
                 data = np.vstack((data, seg_onehot))
 
-            data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
-
-            item = {'data': data, 'data_properties': list_of_image_properties[idx],
-                    'ofile': truncated_ofnames[idx] if truncated_ofnames is not None else None}
-            success = False
-            while not success:
-                try:
-                    if abort_event.is_set():
-                        return
-                    target_queue.put(item, timeout=0.01)
-                    success = True
-                except queue.Full:
-                    pass
+            item = {'data': share_data(data, shared_dir), 'data_properties': image_properties, 'ofile': ofname}
+            target_queue.put((idx, item))
         done_event.set()
     except Exception as e:
         abort_event.set()
@@ -262,52 +314,14 @@ def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
                                    num_processes: int,
                                    pin_memory: bool = False,
                                    verbose: bool = False):
-    context = multiprocessing.get_context('spawn')
-    manager = Manager()
-    num_processes = min(len(list_of_images), num_processes)
-    assert num_processes >= 1
-    target_queues = []
-    processes = []
-    done_events = []
-    abort_event = manager.Event()
-    for i in range(num_processes):
-        event = manager.Event()
-        queue = manager.Queue(maxsize=1)
-        pr = context.Process(target=preprocess_fromnpy_save_to_queue,
-                     args=(
-                         list_of_images[i::num_processes],
-                         list_of_segs_from_prev_stage[
-                         i::num_processes] if list_of_segs_from_prev_stage is not None else None,
-                         list_of_image_properties[i::num_processes],
-                         truncated_ofnames[i::num_processes] if truncated_ofnames is not None else None,
-                         plans_manager,
-                         dataset_json,
-                         configuration_manager,
-                         queue,
-                         event,
-                         abort_event,
-                         verbose
-                     ), daemon=True)
-        pr.start()
-        done_events.append(event)
-        processes.append(pr)
-        target_queues.append(queue)
-
-    worker_ctr = 0
-    while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
-        if not target_queues[worker_ctr].empty():
-            item = target_queues[worker_ctr].get()
-            worker_ctr = (worker_ctr + 1) % num_processes
-        else:
-            all_ok = all(
-                [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
-            if not all_ok:
-                raise RuntimeError('Background workers died. Look for the error message further up! If there is '
-                                   'none then your RAM was full and the worker was killed by the OS. Use fewer '
-                                   'workers or get more RAM in that case!')
-            sleep(0.01)
-            continue
-        if pin_memory:
-            [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
-        yield item
-    [p.join() for p in processes]
+    if list_of_segs_from_prev_stage is None:
+        list_of_segs_from_prev_stage = [None] * len(list_of_images)
+    if truncated_ofnames is None:
+        truncated_ofnames = [None] * len(list_of_images)
+    # the images are written to the shared directory when their task is handed out, the task only carries the file name
+    tasks = list(zip(list_of_images, list_of_segs_from_prev_stage, list_of_image_properties, truncated_ofnames))
+    # results that are returned (no output file) must come back in the order of the inputs
+    preserve_order = any(ofname is None for ofname in truncated_ofnames)
+    return preprocessing_iterator_from_tasks(preprocess_fromnpy_save_to_queue, tasks, plans_manager, dataset_json,
+                                             configuration_manager, num_processes, preserve_order, pin_memory,
+                                             verbose, share_task_arrays=True)
@@ -1,6 +1,6 @@
 import os
 from copy import deepcopy
-from typing import Union, List
+from typing import Union, List, Callable, Tuple
 
 import numpy as np
 import torch
@@ -8,8 +8,125 @@ from acvl_utils.cropping_and_padding.bounding_boxes import bounding_box_to_slice
 from batchgenerators.utilities.file_and_folder_operations import load_json, isfile, save_pickle
 
 from nnunetv2.configuration import default_num_processes
+from nnunetv2.postprocessing.remove_connected_components import apply_postprocessing
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.shared_data import receive_data
+
+# Everything an export worker needs besides the logits of a case. Set once per worker by init_export_worker so that
+# the managers and dataset_json are not pickled again for every case
+_export_worker_context = {}
+
+
+def resample_logits_to_segmentation_channelwise(predicted_logits: Union[torch.Tensor, np.ndarray],
+                                                new_shape: Union[List[int], Tuple[int, ...]],
+                                                current_spacing: List[float],
+                                                new_spacing: List[float],
+                                                configuration_manager: ConfigurationManager,
+                                                label_manager: LabelManager) -> np.ndarray:
+    """
+    Same segmentation as resampling all logits, applying the inference nonlinearity and converting the probabilities
+    to a segmentation, but without ever holding more than one resampled channel at a time. The resampling is done
+    independently per channel anyway, so we can resample one channel after the other and reduce on the fly:
+    argmax(softmax(x)) == argmax(x) and sigmoid(x) > 0.5 <=> x > 0.
+
+    Only use this if the probabilities are not needed!
+    """
+    assert predicted_logits.shape[0] == label_manager.num_segmentation_heads, \
+        f'unexpected number of channels in predicted_logits. Expected {label_manager.num_segmentation_heads}, ' \
+        f'got {predicted_logits.shape[0]}'
+    if label_manager.has_regions:
+        assert label_manager.regions_class_order is not None, 'if region-based training is requested then you need ' \
+                                                              'to define regions_class_order!'
+    segmentation = np.zeros(new_shape, dtype=np.uint8 if len(label_manager.foreground_labels) < 255 else np.uint16)
+    best_logits = None
+    for c in range(predicted_logits.shape[0]):
+        logits_c = configuration_manager.resampling_fn_probabilities(predicted_logits[c:c + 1], new_shape,
+                                                                     current_spacing, new_spacing)[0]
+        if isinstance(logits_c, torch.Tensor):
+            logits_c = logits_c.cpu().numpy()
+        if label_manager.has_regions:
+            # later regions overwrite earlier ones, same as convert_probabilities_to_segmentation
+            segmentation[logits_c > 0] = label_manager.regions_class_order[c]
+        elif best_logits is None:
+            # the resampling returns its input if the shape does not change, don't modify the caller's logits
+            best_logits = logits_c.copy()
+        else:
+            # strictly larger: on ties argmax keeps the first channel
+            better = logits_c > best_logits
+            segmentation[better] = c
+            best_logits[better] = logits_c[better]
+            del better
+        del logits_c
+    return segmentation
+
+
+def convert_predicted_logits_to_segmentation_torch(predicted_logits: torch.Tensor,
+                                                   plans_manager: PlansManager,
+                                                   configuration_manager: ConfigurationManager,
+                                                   label_manager: LabelManager,
+                                                   properties_dict: dict,
+                                                   device: torch.device,
+                                                   channels_per_chunk: int = 8) -> np.ndarray:
+    """
+    Alternative to convert_predicted_logits_to_segmentation_with_correct_shape (without probabilities) that does
+    everything in torch on the given device: the logits are resampled with (bi/tri)linear interpolation in chunks of
+    channels_per_chunk channels and reduced to the segmentation right away. Only the final segmentation (uint8 unless
+    there are too many labels) is moved back to the CPU.
+
+    Linear interpolation is not the same as the resampling_fn_probabilities of the configuration (usually a cubic
+    spline), so results may differ slightly at label borders if the logits have to be resampled.
+    """
+    assert predicted_logits.shape[0] == label_manager.num_segmentation_heads, \
+        f'unexpected number of channels in predicted_logits. Expected {label_manager.num_segmentation_heads}, ' \
+        f'got {predicted_logits.shape[0]}'
+    if isinstance(predicted_logits, np.ndarray):
+        predicted_logits = torch.from_numpy(predicted_logits)
+    new_shape = [int(i) for i in properties_dict['shape_after_cropping_and_before_resampling']]
+    needs_resampling = list(predicted_logits.shape[1:]) != new_shape
+    interpolation_mode = 'trilinear' if len(new_shape) == 3 else 'bilinear'
+
+    with torch.no_grad():
+        # no uint16 in torch
+        segmentation_dtype = torch.uint8 if len(label_manager.foreground_labels) < 255 else torch.int16
+        if label_manager.has_regions:
+            segmentation = torch.zeros(new_shape, dtype=segmentation_dtype, device=device)
+        best_logits = None
+        for start in range(0, predicted_logits.shape[0], channels_per_chunk):
+            logits = predicted_logits[start:start + channels_per_chunk].to(device)
+            if needs_resampling:
+                # interpolation is not implemented for half on all devices
+                logits = torch.nn.functional.interpolate(logits[None].float(), size=new_shape,
+                                                         mode=interpolation_mode, align_corners=False)[0]
+            if label_manager.has_regions:
+                # sigmoid(x) > 0.5 <=> x > 0. Later regions overwrite earlier ones
+                for i in range(logits.shape[0]):
+                    segmentation[logits[i] > 0] = label_manager.regions_class_order[start + i]
+            else:
+                # argmax(softmax(x)) == argmax(x)
+                chunk_max, chunk_argmax = torch.max(logits, 0)
+                if best_logits is None:
+                    best_logits = chunk_max
+                    segmentation = chunk_argmax.to(segmentation_dtype)
+                else:
+                    better = chunk_max > best_logits
+                    segmentation[better] = (chunk_argmax[better] + start).to(segmentation_dtype)
+                    best_logits[better] = chunk_max[better]
+                    del better
+                del chunk_max, chunk_argmax
+            del logits
+        del best_logits
+        segmentation = segmentation.cpu().numpy()
+
+    # put segmentation in bbox (revert cropping)
+    segmentation_reverted_cropping = np.zeros(properties_dict['shape_before_cropping'],
+                                              dtype=np.uint8 if len(label_manager.foreground_labels) < 255 else np.uint16)
+    slicer = bounding_box_to_slice(properties_dict['bbox_used_for_cropping'])
+    segmentation_reverted_cropping[slicer] = segmentation
+    del segmentation
+
+    # revert transpose
+    return segmentation_reverted_cropping.transpose(plans_manager.transpose_backward)
 
 
 def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits: Union[torch.Tensor, np.ndarray],
@@ -27,15 +144,23 @@ def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits
         len(configuration_manager.spacing) == \
         len(properties_dict['shape_after_cropping_and_before_resampling']) else \
         [properties_dict['spacing'][0], *configuration_manager.spacing]
-    predicted_logits = configuration_manager.resampling_fn_probabilities(predicted_logits,
-                                            properties_dict['shape_after_cropping_and_before_resampling'],
-                                            current_spacing,
-                                            properties_dict['spacing'])
-    # return value of resampling_fn_probabilities can be ndarray or Tensor but that does not matter because
-    # apply_inference_nonlin will convert to torch
-    predicted_probabilities = label_manager.apply_inference_nonlin(predicted_logits)
-    del predicted_logits
-    segmentation = label_manager.convert_probabilities_to_segmentation(predicted_probabilities)
+    if not return_probabilities:
+        # resample and reduce one channel at a time so that the full resolution logits/probabilities of all classes
+        # never have to be in memory at once
+        segmentation = resample_logits_to_segmentation_channelwise(
+            predicted_logits, properties_dict['shape_after_cropping_and_before_resampling'], current_spacing,
+            properties_dict['spacing'], configuration_manager, label_manager)
+        del predicted_logits
+    else:
+        predicted_logits = configuration_manager.resampling_fn_probabilities(predicted_logits,
+                                                properties_dict['shape_after_cropping_and_before_resampling'],
+                                                current_spacing,
+                                                properties_dict['spacing'])
+        # return value of resampling_fn_probabilities can be ndarray or Tensor but that does not matter because
+        # apply_inference_nonlin will convert to torch
+        predicted_probabilities = label_manager.apply_inference_nonlin(predicted_logits)
+        del predicted_logits
+        segmentation = label_manager.convert_probabilities_to_segmentation(predicted_probabilities)
 
     # segmentation may be torch.Tensor but we continue with numpy
     if isinstance(segmentation, torch.Tensor):
@@ -72,7 +197,14 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
                                   configuration_manager: ConfigurationManager,
                                   plans_manager: PlansManager,
                                   dataset_json_dict_or_file: Union[dict, str], output_file_truncated: str,
-                                  save_probabilities: bool = False):
+                                  save_probabilities: bool = False,
+                                  pp_fns: List[Callable] = None,
+                                  pp_fn_kwargs: List[dict] = None):
+    """
+    pp_fns and pp_fn_kwargs (see nnunetv2.postprocessing.remove_connected_components.apply_postprocessing) are
+    optional. If given, they are applied to the segmentation in memory right before it is written, so that there is
+    no need for a separate read-postprocess-write pass over the output folder.
+    """
     # if isinstance(predicted_array_or_file, str):
     #     tmp = deepcopy(predicted_array_or_file)
     #     if predicted_array_or_file.endswith('.npy'):
@@ -101,11 +233,32 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
         segmentation_final = ret
         del ret
 
+    if pp_fns is not None:
+        segmentation_final = apply_postprocessing(segmentation_final, pp_fns, pp_fn_kwargs)
+
     rw = plans_manager.image_reader_writer_class()
     rw.write_seg(segmentation_final, output_file_truncated + dataset_json_dict_or_file['file_ending'],
                  properties_dict)
 
 
+def export_segmentation(segmentation: np.ndarray, properties_dict: dict, plans_manager: PlansManager,
+                        dataset_json_dict_or_file: Union[dict, str], output_file_truncated: str,
+                        pp_fns: List[Callable] = None,
+                        pp_fn_kwargs: List[dict] = None):
+    """
+    Writes a segmentation that is already in the original image geometry (see
+    convert_predicted_logits_to_segmentation_torch), optionally applying pp_fns/pp_fn_kwargs first.
+    """
+    if isinstance(dataset_json_dict_or_file, str):
+        dataset_json_dict_or_file = load_json(dataset_json_dict_or_file)
+
+    if pp_fns is not None:
+        segmentation = apply_postprocessing(segmentation, pp_fns, pp_fn_kwargs)
+
+    rw = plans_manager.image_reader_writer_class()
+    rw.write_seg(segmentation, output_file_truncated + dataset_json_dict_or_file['file_ending'], properties_dict)
+
+
 def resample_and_save(predicted: Union[torch.Tensor, np.ndarray], target_shape: List[int], output_file: str,
                       plans_manager: PlansManager, configuration_manager: ConfigurationManager, properties_dict: dict,
                       dataset_json_dict_or_file: Union[dict, str], num_threads_torch: int = default_num_processes) \
@@ -143,3 +296,44 @@ def resample_and_save(predicted: Union[torch.Tensor, np.ndarray], target_shape:
         segmentation = segmentation.cpu().numpy()
     np.savez_compressed(output_file, seg=segmentation.astype(np.uint8))
     torch.set_num_threads(old_threads)
+
+
+def init_export_worker(plans_manager: PlansManager, configuration_manager: ConfigurationManager,
+                       dataset_json_dict_or_file: Union[dict, str], pp_fns: List[Callable] = None,
+                       pp_fn_kwargs: List[dict] = None):
+    """
+    Pool initializer for the export workers of nnUNetPredictor.predict_from_data_iterator. The tasks then only carry
+    the (shared, see nnunetv2.utilities.shared_data) logits, the properties and the output file.
+    """
+    if isinstance(dataset_json_dict_or_file, str):
+        dataset_json_dict_or_file = load_json(dataset_json_dict_or_file)
+    _export_worker_context.update(plans_manager=plans_manager, configuration_manager=configuration_manager,
+                                  dataset_json=dataset_json_dict_or_file,
+                                  label_manager=plans_manager.get_label_manager(dataset_json_dict_or_file),
+                                  pp_fns=pp_fns, pp_fn_kwargs=pp_fn_kwargs)
+
+
+def export_shared_prediction_from_logits(predicted_logits_or_file: Union[str, torch.Tensor], properties_dict: dict,
+                                         output_file_truncated: str, save_probabilities: bool = False):
+    """export_prediction_from_logits in a worker set up with init_export_worker"""
+    ctx = _export_worker_context
+    export_prediction_from_logits(receive_data(predicted_logits_or_file), properties_dict,
+                                  ctx['configuration_manager'], ctx['plans_manager'], ctx['dataset_json'],
+                                  output_file_truncated, save_probabilities, ctx['pp_fns'], ctx['pp_fn_kwargs'])
+
+
+def convert_shared_logits_to_segmentation_with_correct_shape(predicted_logits_or_file: Union[str, torch.Tensor],
+                                                             properties_dict: dict,
+                                                             return_probabilities: bool = False):
+    """convert_predicted_logits_to_segmentation_with_correct_shape in a worker set up with init_export_worker"""
+    ctx = _export_worker_context
+    return convert_predicted_logits_to_segmentation_with_correct_shape(
+        receive_data(predicted_logits_or_file), ctx['plans_manager'], ctx['configuration_manager'],
+        ctx['label_manager'], properties_dict, return_probabilities)
+
+
+def export_shared_segmentation(segmentation: np.ndarray, properties_dict: dict, output_file_truncated: str):
+    """export_segmentation in a worker set up with init_export_worker"""
+    ctx = _export_worker_context
+    export_segmentation(segmentation, properties_dict, ctx['plans_manager'], ctx['dataset_json'],
+                        output_file_truncated, ctx['pp_fns'], ctx['pp_fn_kwargs'])
@@ -0,0 +1,61 @@
+import warnings
+from typing import List
+
+import torch
+from torch import nn
+from torch.func import functional_call, vmap
+
+
+def _is_unsupported_by_vmap(e: Exception) -> bool:
+    """
+    Whether e was raised because vmap cannot batch an operation of the network (as opposed to e.g. running out of
+    memory, which must not be hidden by a slower fallback).
+    """
+    if isinstance(e, torch.cuda.OutOfMemoryError):
+        return False
+    if isinstance(e, NotImplementedError):
+        return True
+    message = str(e).lower()
+    return 'vmap' in message or 'batching rule' in message or 'functorch' in message
+
+
+class FoldEnsembleNetwork(nn.Module):
+    """
+    Evaluates all folds on the same input in a single call and returns their mean logits. The parameters (and
+    buffers) of the folds are stacked along a new first axis and the network is vectorized over that axis with
+    torch.func.vmap, so the sliding window only has to be run once per case instead of once per fold.
+
+    Averaging the folds per tile is the same as averaging the per-fold sliding window results (the gaussian weighting
+    is linear), up to floating point rounding.
+    """
+    def __init__(self, network: nn.Module, list_of_parameters: List[dict], device: torch.device):
+        super().__init__()
+        self.network = network
+        self.num_folds = len(list_of_parameters)
+        self.stacked_parameters = {k: torch.stack([p[k] for p in list_of_parameters]).to(device)
+                                   for k in list_of_parameters[0].keys()}
+        self.use_vmap = True
+
+    def _forward_one_fold(self, parameters: dict, x: torch.Tensor) -> torch.Tensor:
+        return functional_call(self.network, parameters, (x,))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.use_vmap:
+            try:
+                return vmap(self._forward_one_fold, in_dims=(0, None))(self.stacked_parameters, x).mean(0)
+            except (RuntimeError, NotImplementedError) as e:
+                # not all operations have batching rules. Evaluating the folds one after the other still only needs a
+                # single sliding window pass. Other errors (out of memory in particular) are raised as usual
+                if not _is_unsupported_by_vmap(e):
+                    raise
+                warnings.warn(f'Vectorized fold ensemble failed ({e}). Evaluating the folds one after the other '
+                              f'instead.')
+                self.use_vmap = False
+        prediction = None
+        for i in range(self.num_folds):
+            fold_prediction = self._forward_one_fold({k: v[i] for k, v in self.stacked_parameters.items()}, x)
+            if prediction is None:
+                prediction = fold_prediction
+            else:
+                prediction += fold_prediction
+        return prediction / self.num_folds
@@ -2,9 +2,11 @@ import inspect
 import itertools
 import multiprocessing
 import os
+import shutil
+from collections import OrderedDict
 from copy import deepcopy
 from time import sleep
-from typing import Tuple, Union, List, Optional
+from typing import Tuple, Union, List, Optional, Callable
 
 import numpy as np
 import torch
@@ -22,15 +24,20 @@ from nnunetv2.configuration import default_num_processes
 from nnunetv2.inference.data_iterators import PreprocessAdapterFromNpy, preprocessing_iterator_fromfiles, \
     preprocessing_iterator_fromnpy
 from nnunetv2.inference.export_prediction import export_prediction_from_logits, \
-    convert_predicted_logits_to_segmentation_with_correct_shape
+    convert_predicted_logits_to_segmentation_with_correct_shape, convert_predicted_logits_to_segmentation_torch, \
+    export_segmentation, init_export_worker, export_shared_prediction_from_logits, \
+    convert_shared_logits_to_segmentation_with_correct_shape, export_shared_segmentation
+from nnunetv2.inference.fold_ensemble import FoldEnsembleNetwork
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian, \
     compute_steps_for_sliding_window
+from nnunetv2.postprocessing.remove_connected_components import apply_postprocessing
 from nnunetv2.utilities.file_path_utilities import get_output_folder, check_workers_alive_and_busy
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
 from nnunetv2.utilities.helpers import empty_cache, dummy_context
 from nnunetv2.utilities.json_export import recursive_fix_for_json_export
 from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.shared_data import make_shared_data_dir, share_data
 from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
 
 
@@ -43,7 +50,45 @@ class nnUNetPredictor(object):
                  device: torch.device = torch.device('cuda'),
                  verbose: bool = False,
                  verbose_preprocessing: bool = False,
-                 allow_tqdm: bool = True):
+                 allow_tqdm: bool = True,
+                 cache_fold_networks: bool = False,
+                 tile_batch_size: int = 1,
+                 ensemble_folds_per_tile: bool = False,
+                 empty_tiles: str = 'predict',
+                 sliding_window_cache_size: int = 4,
+                 export_on_device: bool = False,
+                 linear_resampling_on_device: bool = False):
+        """
+        cache_fold_networks: if True, one network instance per fold is kept on the device (weights loaded once)
+        instead of calling load_state_dict for every fold on every case. Faster when predicting many cases with
+        several folds, but the device needs to hold the weights of all folds at once.
+        tile_batch_size: number of sliding window tiles that are stacked into one forward pass. Larger values keep
+        big GPUs busy but need proportionally more memory for the activations.
+        ensemble_folds_per_tile: if True, every tile is evaluated by all folds at once (see FoldEnsembleNetwork) and
+        the sliding window runs only once per case instead of once per fold. Needs more memory on the device.
+        Takes precedence over cache_fold_networks.
+        empty_tiles: what to do with sliding window tiles whose input is all zeros in every channel. 'predict'
+        (default) runs them through the network like any other tile. 'reuse' predicts a single all-zero tile per
+        sliding window pass and accumulates that prediction for every empty tile. This is numerically equivalent to
+        'predict' up to floating-point nondeterminism (the reference tile is predicted on its own, not inside a batch
+        with other tiles, so cuDNN may pick different kernels), which can flip a few voxels where two labels are close.
+        'fill' skips empty tiles altogether. Voxels that are only covered by empty tiles get background logits, voxels
+        that are also covered by a non-empty tile are averaged over those tiles only.
+        'reuse' and 'fill' only take effect if the normalization keeps the background at exactly 0 (e.g. skull
+        stripped images with a normalization that is not applied to the background). If the background is shifted
+        (e.g. z-scoring of the whole image), no tile is all zeros and both behave like 'predict'.
+        sliding_window_cache_size: number of (padded) image shapes for which the sliding window slicers and the
+        accumulated gaussian weights (n_predictions) are kept on the predictor, so that cases with the same shape
+        reuse them instead of rebuilding them.
+        export_on_device: if True and no probabilities are requested, the logits are converted to a segmentation with
+        torch on self.device (falls back to the CPU if the device runs out of memory) right where they were
+        predicted, and the export workers only need to write the segmentation. This gives the same segmentation as the
+        default export as long as the logits do not need to be resampled. Cases whose logits need resampling are
+        exported as usual, unless linear_resampling_on_device is set.
+        linear_resampling_on_device: with export_on_device, also resample the logits on the device, with (tri)linear
+        interpolation instead of the configured resampling function (usually a cubic spline). Faster, but changes the
+        segmentations slightly at label borders.
+        """
         self.verbose = verbose
         self.verbose_preprocessing = verbose_preprocessing
         self.allow_tqdm = allow_tqdm
@@ -51,7 +96,11 @@ class nnUNetPredictor(object):
         self.plans_manager, self.configuration_manager, self.list_of_parameters, self.network, self.dataset_json, \
         self.trainer_name, self.allowed_mirroring_axes, self.label_manager = None, None, None, None, None, None, None, None
 
+        assert tile_batch_size >= 1, 'tile_batch_size must be at least 1'
+        assert empty_tiles in ('predict', 'reuse', 'fill'), \
+            f"empty_tiles must be 'predict', 'reuse' or 'fill', got {empty_tiles}"
         self.tile_step_size = tile_step_size
+        self.tile_batch_size = tile_batch_size
         self.use_gaussian = use_gaussian
         self.use_mirroring = use_mirroring
         if device.type == 'cuda':
@@ -61,6 +110,19 @@ class nnUNetPredictor(object):
             perform_everything_on_device = False
         self.device = device
         self.perform_everything_on_device = perform_everything_on_device
+        self.cache_fold_networks = cache_fold_networks
+        self.ensemble_folds_per_tile = ensemble_folds_per_tile
+        self.empty_tiles = empty_tiles
+        self.sliding_window_cache_size = sliding_window_cache_size
+        self.export_on_device = export_on_device
+        self.linear_resampling_on_device = linear_resampling_on_device
+        self._fold_networks = None
+        self._fold_ensemble_network = None
+        self._reset_sliding_window_cache()
+
+        # optional postprocessing that is applied to the segmentations in memory before they are exported. See
+        # initialize_postprocessing
+        self.pp_fns, self.pp_fn_kwargs = None, None
 
     def initialize_from_trained_model_folder(self, model_training_output_dir: str,
                                              use_folds: Union[Tuple[Union[int, str]], None],
@@ -110,6 +172,9 @@ class nnUNetPredictor(object):
         self.configuration_manager = configuration_manager
         self.list_of_parameters = parameters
         self.network = network
+        self._fold_networks = None
+        self._fold_ensemble_network = None
+        self._reset_sliding_window_cache()
         self.dataset_json = dataset_json
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
@@ -130,6 +195,9 @@ class nnUNetPredictor(object):
         self.configuration_manager = configuration_manager
         self.list_of_parameters = parameters
         self.network = network
+        self._fold_networks = None
+        self._fold_ensemble_network = None
+        self._reset_sliding_window_cache()
         self.dataset_json = dataset_json
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
@@ -144,6 +212,19 @@ class nnUNetPredictor(object):
             print('Using torch.compile')
             self.network = torch.compile(self.network)
 
+    def initialize_postprocessing(self, pp_fns: Optional[List[Callable]], pp_fn_kwargs: Optional[List[dict]]):
+        """
+        pp_fns and pp_fn_kwargs are what nnUNetv2_determine_postprocessing saves in postprocessing.pkl (you can append
+        your own functions as long as they take the segmentation as first argument and return the modified
+        segmentation). They are applied to every exported segmentation before write_seg, so that
+        nnUNetv2_apply_postprocessing does not need to be run afterwards. Set both to None to disable.
+        """
+        assert (pp_fns is None) == (pp_fn_kwargs is None), 'pp_fns and pp_fn_kwargs must either both be None or not'
+        if pp_fns is not None:
+            assert len(pp_fns) == len(pp_fn_kwargs), 'pp_fns and pp_fn_kwargs must have the same length'
+        self.pp_fns = pp_fns
+        self.pp_fn_kwargs = pp_fn_kwargs
+
     @staticmethod
     def auto_detect_available_folds(model_training_output_dir, checkpoint_name):
         print('use_folds is None, attempting to auto detect available folds')
@@ -343,69 +424,90 @@ class nnUNetPredictor(object):
         each element returned by data_iterator must be a dict with 'data', 'ofile' and 'data_properties' keys!
         If 'ofile' is None, the result will be returned instead of written to a file
         """
-        with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export) as export_pool:
-            worker_list = [i for i in export_pool._pool]
-            r = []
-            for preprocessed in data_iterator:
-                data = preprocessed['data']
-                if isinstance(data, str):
-                    delfile = data
-                    data = torch.from_numpy(np.load(data))
-                    os.remove(delfile)
-
-                ofile = preprocessed['ofile']
-                if ofile is not None:
-                    print(f'\nPredicting {os.path.basename(ofile)}:')
-                else:
-                    print(f'\nPredicting image of shape {data.shape}:')
-
-                print(f'perform_everything_on_device: {self.perform_everything_on_device}')
-
-                properties = preprocessed['data_properties']
-
-                # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
-                # npy files
-                proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-                while not proceed:
-                    sleep(0.1)
+        # The managers, dataset_json and postprocessing are sent to the export workers once. Per case, the logits are
+        # handed over through a RAM-backed file (see nnunetv2.utilities.shared_data) instead of being pickled
+        shared_dir = make_shared_data_dir()
+        try:
+            with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export,
+                                                           initializer=init_export_worker,
+                                                           initargs=(self.plans_manager, self.configuration_manager,
+                                                                     self.dataset_json, self.pp_fns,
+                                                                     self.pp_fn_kwargs)) as export_pool:
+                worker_list = [i for i in export_pool._pool]
+                r = []
+                for preprocessed in data_iterator:
+                    data = preprocessed['data']
+                    if isinstance(data, str):
+                        delfile = data
+                        data = torch.from_numpy(np.load(data))
+                        os.remove(delfile)
+
+                    ofile = preprocessed['ofile']
+                    if ofile is not None:
+                        print(f'\nPredicting {os.path.basename(ofile)}:')
+                    else:
+                        print(f'\nPredicting image of shape {data.shape}:')
+
+                    print(f'perform_everything_on_device: {self.perform_everything_on_device}')
+
+                    properties = preprocessed['data_properties']
+
+                    # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
+                    # npy files
                     proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-
-                prediction = self.predict_logits_from_preprocessed_data(data).cpu()
-
-                if ofile is not None:
-                    # this needs to go into background processes
-                    # export_prediction_from_logits(prediction, properties, self.configuration_manager, self.plans_manager,
-                    #                               self.dataset_json, ofile, save_probabilities)
-                    print('sending off prediction to background worker for resampling and export')
-                    r.append(
-                        export_pool.starmap_async(
-                            export_prediction_from_logits,
-                            ((prediction, properties, self.configuration_manager, self.plans_manager,
-                              self.dataset_json, ofile, save_probabilities),)
+                    while not proceed:
+                        sleep(0.1)
+                        proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
+
+                    on_device = ofile is not None and self._use_export_on_device(data, properties, save_probabilities)
+                    # logits that are converted on the device stay there if possible
+                    prediction = self.predict_logits_from_preprocessed_data(data, keep_on_device=on_device)
+
+                    if on_device:
+                        segmentation = self._convert_logits_to_segmentation_on_device(prediction, properties)
+                        del prediction
+                        print('sending off segmentation to background worker for export')
+                        r.append(
+                            export_pool.starmap_async(
+                                export_shared_segmentation,
+                                ((segmentation, properties, ofile),)
+                            )
                         )
-                    )
-                else:
-                    # convert_predicted_logits_to_segmentation_with_correct_shape(
-                    #             prediction, self.plans_manager,
-                    #              self.configuration_manager, self.label_manager,
-                    #              properties,
-                    #              save_probabilities)
-
-                    print('sending off prediction to background worker for resampling')
-                    r.append(
-                        export_pool.starmap_async(
-                            convert_predicted_logits_to_segmentation_with_correct_shape, (
-                                (prediction, self.plans_manager,
-                                 self.configuration_manager, self.label_manager,
-                                 properties,
-                                 save_probabilities),)
+                    elif ofile is not None:
+                        # this needs to go into background processes
+                        # export_prediction_from_logits(prediction, properties, self.configuration_manager, self.plans_manager,
+                        #                               self.dataset_json, ofile, save_probabilities)
+                        print('sending off prediction to background worker for resampling and export')
+                        r.append(
+                            export_pool.starmap_async(
+                                export_shared_prediction_from_logits,
+                                ((share_data(prediction, shared_dir, dtype=None), properties, ofile,
+                                  save_probabilities),)
+                            )
                         )
-                    )
-                if ofile is not None:
-                    print(f'done with {os.path.basename(ofile)}')
-                else:
-                    print(f'\nDone with image of shape {data.shape}:')
-            ret = [i.get()[0] for i in r]
+                    else:
+                        # convert_predicted_logits_to_segmentation_with_correct_shape(
+                        #             prediction, self.plans_manager,
+                        #              self.configuration_manager, self.label_manager,
+                        #              properties,
+                        #              save_probabilities)
+
+                        print('sending off prediction to background worker for resampling')
+                        r.append(
+                            export_pool.starmap_async(
+                                convert_shared_logits_to_segmentation_with_correct_shape, (
+                                    (share_data(prediction, shared_dir, dtype=None),
+                                     properties,
+                                     save_probabilities),)
+                            )
+                        )
+                    if ofile is not None:
+                        print(f'done with {os.path.basename(ofile)}')
+                    else:
+                        print(f'\nDone with image of shape {data.shape}:')
+                ret = [self._maybe_apply_postprocessing(i.get()[0], save_probabilities) for i in r]
+        finally:
+            shutil.rmtree(shared_dir, ignore_errors=True)
 
         if isinstance(data_iterator, MultiThreadedAugmenter):
             data_iterator._finish()
@@ -443,14 +545,23 @@ class nnUNetPredictor(object):
 
         if self.verbose:
             print('predicting')
-        predicted_logits = self.predict_logits_from_preprocessed_data(dct['data']).cpu()
+        on_device = self._use_export_on_device(dct['data'], dct['data_properties'], save_or_return_probabilities)
+        predicted_logits = self.predict_logits_from_preprocessed_data(dct['data'], keep_on_device=on_device)
 
         if self.verbose:
             print('resampling to original shape')
-        if output_file_truncated is not None:
+        if on_device:
+            segmentation = self._convert_logits_to_segmentation_on_device(predicted_logits, dct['data_properties'])
+            del predicted_logits
+            if output_file_truncated is not None:
+                export_segmentation(segmentation, dct['data_properties'], self.plans_manager, self.dataset_json,
+                                    output_file_truncated, self.pp_fns, self.pp_fn_kwargs)
+            else:
+                return self._maybe_apply_postprocessing(segmentation, False)
+        elif output_file_truncated is not None:
             export_prediction_from_logits(predicted_logits, dct['data_properties'], self.configuration_manager,
                                           self.plans_manager, self.dataset_json, output_file_truncated,
-                                          save_or_return_probabilities)
+                                          save_or_return_probabilities, self.pp_fns, self.pp_fn_kwargs)
         else:
             ret = convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits, self.plans_manager,
                                                                               self.configuration_manager,
@@ -458,38 +569,115 @@ class nnUNetPredictor(object):
                                                                               dct['data_properties'],
                                                                               return_probabilities=
                                                                               save_or_return_probabilities)
+            ret = self._maybe_apply_postprocessing(ret, save_or_return_probabilities)
             if save_or_return_probabilities:
                 return ret[0], ret[1]
             else:
                 return ret
 
-    def predict_logits_from_preprocessed_data(self, data: torch.Tensor) -> torch.Tensor:
+    def _use_export_on_device(self, data: torch.Tensor, properties: dict, save_probabilities: bool) -> bool:
+        """
+        Whether the logits predicted for data are converted to a segmentation on the device, see export_on_device and
+        linear_resampling_on_device. The logits have the spatial shape of data.
+        """
+        if not self.export_on_device or save_probabilities:
+            return False
+        needs_resampling = list(data.shape[1:]) != \
+            [int(i) for i in properties['shape_after_cropping_and_before_resampling']]
+        return self.linear_resampling_on_device or not needs_resampling
+
+    def _convert_logits_to_segmentation_on_device(self, predicted_logits: torch.Tensor, properties: dict) \
+            -> np.ndarray:
+        """
+        See export_on_device. Returns the segmentation in the geometry of the original image.
+        """
+        try:
+            segmentation = convert_predicted_logits_to_segmentation_torch(predicted_logits, self.plans_manager,
+                                                                          self.configuration_manager,
+                                                                          self.label_manager, properties,
+                                                                          self.device)
+        except RuntimeError:
+            if self.device.type == 'cpu':
+                raise
+            print('Conversion to segmentation on device was unsuccessful, probably due to a lack of memory. '
+                  'Continuing on CPU')
+            empty_cache(self.device)
+            segmentation = convert_predicted_logits_to_segmentation_torch(predicted_logits, self.plans_manager,
+                                                                          self.configuration_manager,
+                                                                          self.label_manager, properties,
+                                                                          torch.device('cpu'))
+        empty_cache(self.device)
+        return segmentation
+
+    def _maybe_apply_postprocessing(self, segmentation_or_tuple, has_probabilities: bool):
+        """
+        Applies self.pp_fns to segmentations that are returned instead of written to a file. Results that were
+        exported to a file by export_prediction_from_logits were already postprocessed there (and are None here).
+        """
+        if self.pp_fns is None or segmentation_or_tuple is None:
+            return segmentation_or_tuple
+        if has_probabilities:
+            return apply_postprocessing(segmentation_or_tuple[0], self.pp_fns, self.pp_fn_kwargs), \
+                segmentation_or_tuple[1]
+        return apply_postprocessing(segmentation_or_tuple, self.pp_fns, self.pp_fn_kwargs)
+
+    def predict_logits_from_preprocessed_data(self, data: torch.Tensor, keep_on_device: bool = False) -> torch.Tensor:
         """
         IMPORTANT! IF YOU ARE RUNNING THE CASCADE, THE SEGMENTATION FROM THE PREVIOUS STAGE MUST ALREADY BE STACKED ON
         TOP OF THE IMAGE AS ONE-HOT REPRESENTATION! SEE PreprocessAdapter ON HOW THIS SHOULD BE DONE!
 
         RETURNED LOGITS HAVE THE SHAPE OF THE INPUT. THEY MUST BE CONVERTED BACK TO THE ORIGINAL IMAGE SIZE.
         SEE convert_predicted_logits_to_segmentation_with_correct_shape
+
+        keep_on_device: return the logits where the sliding window left them (self.device with
+        perform_everything_on_device) instead of on the CPU, if they are predicted in a single pass (one fold or
+        ensemble_folds_per_tile). Logits of several folds are always summed up on the CPU.
         """
         n_threads = torch.get_num_threads()
         torch.set_num_threads(default_num_processes if default_num_processes < n_threads else n_threads)
         prediction = None
 
-        for params in self.list_of_parameters:
-
-            # messing with state dict names...
-            if not isinstance(self.network, OptimizedModule):
-                self.network.load_state_dict(params)
-            else:
-                self.network._orig_mod.load_state_dict(params)
-
-            # why not leave prediction on device if perform_everything_on_device? Because this may cause the
-            # second iteration to crash due to OOM. Grabbing that with try except cause way more bloated code than
-            # this actually saves computation time
-            if prediction is None:
-                prediction = self.predict_sliding_window_return_logits(data).to('cpu')
-            else:
-                prediction += self.predict_sliding_window_return_logits(data).to('cpu')
+        if self.ensemble_folds_per_tile and len(self.list_of_parameters) > 1:
+            # all folds are evaluated on each tile, so a single sliding window pass is enough
+            network = self.network
+            self.network = self._get_fold_ensemble_network()
+            try:
+                prediction = self.predict_sliding_window_return_logits(data)
+            finally:
+                self.network = network
+            if not keep_on_device:
+                prediction = prediction.to('cpu')
+            if self.verbose: print('Prediction done')
+            torch.set_num_threads(n_threads)
+            return prediction
+
+        fold_networks = self._get_fold_networks() if self.cache_fold_networks else None
+
+        # the fold networks only replace self.network for this call
+        network = self.network
+        try:
+            for i, params in enumerate(self.list_of_parameters):
+
+                if fold_networks is not None:
+                    # weights of this fold are already loaded and on the device, just switch the network
+                    self.network = fold_networks[i]
+                # messing with state dict names...
+                elif not isinstance(self.network, OptimizedModule):
+                    self.network.load_state_dict(params)
+                else:
+                    self.network._orig_mod.load_state_dict(params)
+
+                # why not leave prediction on device if perform_everything_on_device? Because this may cause the
+                # second iteration to crash due to OOM. Grabbing that with try except cause way more bloated code than
+                # this actually saves computation time
+                if prediction is None:
+                    prediction = self.predict_sliding_window_return_logits(data)
+                    if not (keep_on_device and len(self.list_of_parameters) == 1):
+                        prediction = prediction.to('cpu')
+                else:
+                    prediction += self.predict_sliding_window_return_logits(data).to('cpu')
+        finally:
+            self.network = network
 
         if len(self.list_of_parameters) > 1:
             prediction /= len(self.list_of_parameters)
@@ -498,7 +686,82 @@ class nnUNetPredictor(object):
         torch.set_num_threads(n_threads)
         return prediction
 
+    def _get_fold_networks(self) -> List[nn.Module]:
+        """
+        One copy of self.network per entry in self.list_of_parameters, with the weights loaded and moved to
+        self.device. Built on first use and reused for all following cases (see cache_fold_networks).
+        """
+        if self._fold_networks is None:
+            is_compiled = isinstance(self.network, OptimizedModule)
+            base_network = self.network._orig_mod if is_compiled else self.network
+            fold_networks = []
+            for params in self.list_of_parameters:
+                network = deepcopy(base_network)
+                network.load_state_dict(params)
+                network = network.to(self.device)
+                network.eval()
+                if is_compiled:
+                    network = torch.compile(network)
+                fold_networks.append(network)
+            self._fold_networks = fold_networks
+            empty_cache(self.device)
+        return self._fold_networks
+
+    def _get_fold_ensemble_network(self) -> FoldEnsembleNetwork:
+        """
+        Wraps self.network into a FoldEnsembleNetwork holding the stacked weights of all folds on self.device. Built
+        on first use and reused for all following cases (see ensemble_folds_per_tile).
+        """
+        if self._fold_ensemble_network is None:
+            # torch.compile and vmap don't mix well, so the ensemble uses the uncompiled network
+            base_network = self.network._orig_mod if isinstance(self.network, OptimizedModule) else self.network
+            self._fold_ensemble_network = FoldEnsembleNetwork(base_network, self.list_of_parameters, self.device)
+            empty_cache(self.device)
+        return self._fold_ensemble_network
+
+    def _reset_sliding_window_cache(self):
+        # slicers and n_predictions are keyed by padded image shape (and device), gaussians by device. See
+        # sliding_window_cache_size
+        self._slicer_cache = OrderedDict()
+        self._n_predictions_cache = OrderedDict()
+        self._gaussian_cache = {}
+
+    def _add_to_sliding_window_cache(self, cache: OrderedDict, key, value):
+        cache[key] = value
+        while len(cache) > self.sliding_window_cache_size:
+            cache.popitem(last=False)
+
+    def _get_gaussian(self, device: torch.device) -> torch.Tensor:
+        key = (tuple(self.configuration_manager.patch_size), str(device))
+        if key not in self._gaussian_cache:
+            self._gaussian_cache[key] = compute_gaussian(tuple(self.configuration_manager.patch_size),
+                                                         sigma_scale=1. / 8, value_scaling_factor=10, device=device)
+        return self._gaussian_cache[key]
+
+    def _get_n_predictions(self, image_size: Tuple[int, ...], slicers, gaussian, device: torch.device) \
+            -> torch.Tensor:
+        """
+        Sum of the (gaussian) weights of all tiles for every voxel. Only depends on the image shape, so it is built
+        once per shape and reused. Must not be modified by the caller!
+        """
+        key = (tuple(image_size), tuple(self.configuration_manager.patch_size), self.tile_step_size,
+               self.use_gaussian, str(device))
+        if key in self._n_predictions_cache:
+            self._n_predictions_cache.move_to_end(key)
+            return self._n_predictions_cache[key]
+        n_predictions = torch.zeros(image_size, dtype=torch.half, device=device)
+        # same accumulation order as in the sliding window, so the result is identical
+        for sl in slicers:
+            n_predictions[sl[1:]] += gaussian
+        self._add_to_sliding_window_cache(self._n_predictions_cache, key, n_predictions)
+        return n_predictions
+
     def _internal_get_sliding_window_slicers(self, image_size: Tuple[int, ...]):
+        key = (tuple(image_size), tuple(self.configuration_manager.patch_size), self.tile_step_size)
+        if key in self._slicer_cache:
+            self._slicer_cache.move_to_end(key)
+            return self._slicer_cache[key]
+
         slicers = []
         if len(self.configuration_manager.patch_size) < len(image_size):
             assert len(self.configuration_manager.patch_size) == len(
@@ -530,8 +793,17 @@ class nnUNetPredictor(object):
                         slicers.append(
                             tuple([slice(None), *[slice(si, si + ti) for si, ti in
                                                   zip((sx, sy, sz), self.configuration_manager.patch_size)]]))
+        self._add_to_sliding_window_cache(self._slicer_cache, key, slicers)
         return slicers
 
+    @staticmethod
+    def _internal_get_empty_tiles(data: torch.Tensor, slicers) -> List[bool]:
+        """
+        For each slicer, whether the tile contains only zeros in all input channels (see empty_tiles)
+        """
+        nonzero = torch.any(data != 0, dim=0)
+        return [not torch.any(nonzero[sl[1:]]).item() for sl in slicers]
+
     def _internal_maybe_mirror_and_predict(self, x: torch.Tensor) -> torch.Tensor:
         mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
         prediction = self.network(x)
@@ -554,8 +826,13 @@ class nnUNetPredictor(object):
                                                        data: torch.Tensor,
                                                        slicers,
                                                        do_on_device: bool = True,
+                                                       empty_tiles: List[bool] = None
                                                        ):
-        predicted_logits = n_predictions = prediction = gaussian = workon = None
+        """
+        empty_tiles: optional, one entry per slicer. Tiles marked as empty are not run through the network, the
+        prediction of the first empty tile is accumulated for all of them instead (empty_tiles='reuse')
+        """
+        predicted_logits = n_predictions = prediction = gaussian = workon = empty_prediction = None
         results_device = self.device if do_on_device else torch.device('cpu')
 
         try:
@@ -572,36 +849,74 @@ class nnUNetPredictor(object):
             predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
                                            dtype=torch.half,
                                            device=results_device)
-            n_predictions = torch.zeros(data.shape[1:], dtype=torch.half, device=results_device)
 
             if self.use_gaussian:
-                gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
-                                            value_scaling_factor=10,
-                                            device=results_device)
+                gaussian = self._get_gaussian(results_device)
             else:
                 gaussian = 1
 
-            if not self.allow_tqdm and self.verbose:
-                print(f'running prediction: {len(slicers)} steps')
-            for sl in tqdm(slicers, disable=not self.allow_tqdm):
-                workon = data[sl][None]
-                workon = workon.to(self.device)
-
-                prediction = self._internal_maybe_mirror_and_predict(workon)[0].to(results_device)
+            # with empty_tiles='fill' the slicers depend on the image content, so the weights are accumulated here.
+            # Otherwise they only depend on the shape and are taken from the cache
+            accumulate_n_predictions = self.empty_tiles == 'fill'
+            if accumulate_n_predictions:
+                n_predictions = torch.zeros(data.shape[1:], dtype=torch.half, device=results_device)
+            else:
+                n_predictions = self._get_n_predictions(data.shape[1:], slicers, gaussian, results_device)
 
+            if not self.allow_tqdm and self.verbose:
+                print(f'running prediction: {len(slicers)} steps in batches of {self.tile_batch_size}')
+            if empty_tiles is None:
+                empty_tiles = [False] * len(slicers)
+            elif any(empty_tiles):
+                # all empty tiles have the same (all zero) content and thus the same prediction
+                workon = data[slicers[empty_tiles.index(True)]][None].to(self.device)
+                empty_prediction = self._internal_maybe_mirror_and_predict(workon)[0].to(results_device)
                 if self.use_gaussian:
-                    prediction *= gaussian
-                predicted_logits[sl] += prediction
-                n_predictions[sl[1:]] += gaussian
-
-            predicted_logits /= n_predictions
+                    empty_prediction *= gaussian
+
+            with tqdm(total=len(slicers), disable=not self.allow_tqdm) as pbar:
+                for batch_start in range(0, len(slicers), self.tile_batch_size):
+                    batch_slicers = slicers[batch_start:batch_start + self.tile_batch_size]
+                    batch_empty = empty_tiles[batch_start:batch_start + self.tile_batch_size]
+                    tile_predictions = iter(())
+                    if not all(batch_empty):
+                        workon = torch.stack([data[sl] for sl, e in zip(batch_slicers, batch_empty) if not e])
+                        workon = workon.to(self.device)
+
+                        prediction = self._internal_maybe_mirror_and_predict(workon).to(results_device)
+
+                        if self.use_gaussian:
+                            prediction *= gaussian
+                        tile_predictions = iter(prediction)
+                    # tiles overlap, so they have to be accumulated one after the other (and in the original order,
+                    # so that reusing the empty prediction gives the same sums as predicting every tile)
+                    for sl, e in zip(batch_slicers, batch_empty):
+                        predicted_logits[sl] += empty_prediction if e else next(tile_predictions)
+                        if accumulate_n_predictions:
+                            n_predictions[sl[1:]] += gaussian
+                    pbar.update(len(batch_slicers))
+
+            if self.empty_tiles == 'fill':
+                # voxels that were only covered by skipped empty tiles get confident background logits
+                uncovered = n_predictions == 0
+                n_predictions[uncovered] = 1
+                predicted_logits /= n_predictions
+                background_logits = torch.zeros(predicted_logits.shape[0], dtype=predicted_logits.dtype,
+                                                device=results_device)
+                if self.label_manager.has_regions:
+                    background_logits -= 10
+                else:
+                    background_logits[0] = 10
+                predicted_logits.permute(*range(1, predicted_logits.ndim), 0)[uncovered] = background_logits
+            else:
+                predicted_logits /= n_predictions
             # check for infs
             if torch.any(torch.isinf(predicted_logits)):
                 raise RuntimeError('Encountered inf in predicted array. Aborting... If this problem persists, '
                                    'reduce value_scaling_factor in compute_gaussian or increase the dtype of '
                                    'predicted_logits to fp32')
         except Exception as e:
-            del predicted_logits, n_predictions, prediction, gaussian, workon
+            del predicted_logits, n_predictions, prediction, gaussian, workon, empty_prediction
             empty_cache(self.device)
             empty_cache(results_device)
             raise e
@@ -637,19 +952,30 @@ class nnUNetPredictor(object):
 
             slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
 
+            empty_tiles = None
+            if self.empty_tiles != 'predict':
+                empty_tiles = self._internal_get_empty_tiles(data, slicers)
+                if self.verbose: print(f'{sum(empty_tiles)} of {len(slicers)} tiles are empty ({self.empty_tiles})')
+                if self.empty_tiles == 'fill':
+                    slicers = [sl for sl, e in zip(slicers, empty_tiles) if not e]
+                    empty_tiles = None
+
             if self.perform_everything_on_device and self.device != 'cpu':
                 # we need to try except here because we can run OOM in which case we need to fall back to CPU as a results device
                 try:
                     predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers,
-                                                                                           self.perform_everything_on_device)
+                                                                                           self.perform_everything_on_device,
+                                                                                           empty_tiles)
                 except RuntimeError:
                     print(
                         'Prediction on device was unsuccessful, probably due to a lack of memory. Moving results arrays to CPU')
                     empty_cache(self.device)
-                    predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, False)
+                    predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, False,
+                                                                                           empty_tiles)
             else:
                 predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers,
-                                                                                       self.perform_everything_on_device)
+                                                                                       self.perform_everything_on_device,
+                                                                                       empty_tiles)
 
             empty_cache(self.device)
             # revert padding
@@ -705,6 +1031,33 @@ def predict_entry_point_modelfolder():
     parser.add_argument('--disable_progress_bar', action='store_true', required=False, default=False,
                         help='Set this flag to disable progress bar. Recommended for HPC environments (non interactive '
                              'jobs)')
+    parser.add_argument('--cache_fold_networks', action='store_true', required=False, default=False,
+                        help='Set this flag to keep one network per fold on the device instead of reloading the '
+                             'weights of every fold for every case. Faster for many cases, but needs enough (GPU) '
+                             'memory for the weights of all folds.')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=1,
+                        help='Number of sliding window tiles predicted together in one forward pass. Higher values '
+                             'can speed up inference on large GPUs but need more GPU memory. Default: 1')
+    parser.add_argument('--ensemble_folds_per_tile', action='store_true', required=False, default=False,
+                        help='Set this flag to evaluate all folds on each tile in one vectorized call, so that the '
+                             'sliding window only runs once per case instead of once per fold. Needs more GPU '
+                             'memory.')
+    parser.add_argument('-empty_tiles', type=str, required=False, default='predict',
+                        choices=['predict', 'reuse', 'fill'],
+                        help="How to handle sliding window tiles whose input is all zeros (e.g. background of skull "
+                             "stripped images). 'predict': run them through the network (default). 'reuse': predict "
+                             "one empty tile and reuse its prediction for all others, equivalent to 'predict' up "
+                             "to floating-point nondeterminism. 'fill': skip them and assign background to voxels "
+                             "that are only covered by empty tiles. 'reuse' and 'fill' only apply if the "
+                             "normalization keeps the background at exactly 0.")
+    parser.add_argument('--export_on_device', action='store_true', required=False, default=False,
+                        help='Set this flag to compute the segmentation with torch on the prediction device instead '
+                             'of in the export workers. Cases whose logits need resampling are still exported as '
+                             'usual unless --linear_resampling_on_device is set. Not used with --save_probabilities.')
+    parser.add_argument('--linear_resampling_on_device', action='store_true', required=False, default=False,
+                        help='With --export_on_device, also resample the logits on the device with linear '
+                             'interpolation instead of the configured resampling. Faster, but segmentations can differ '
+                             'slightly at label borders.')
 
     print(
         "\n#######################################################################\nPlease cite the following paper "
@@ -741,7 +1094,13 @@ def predict_entry_point_modelfolder():
                                 device=device,
                                 verbose=args.verbose,
                                 allow_tqdm=not args.disable_progress_bar,
-                                verbose_preprocessing=args.verbose)
+                                verbose_preprocessing=args.verbose,
+                                cache_fold_networks=args.cache_fold_networks,
+                                tile_batch_size=args.tile_batch_size,
+                                ensemble_folds_per_tile=args.ensemble_folds_per_tile,
+                                empty_tiles=args.empty_tiles,
+                                export_on_device=args.export_on_device,
+                                linear_resampling_on_device=args.linear_resampling_on_device)
     predictor.initialize_from_trained_model_folder(args.m, args.f, args.chk)
     predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
                                  overwrite=not args.continue_prediction,
@@ -814,6 +1173,33 @@ def predict_entry_point():
     parser.add_argument('--disable_progress_bar', action='store_true', required=False, default=False,
                         help='Set this flag to disable progress bar. Recommended for HPC environments (non interactive '
                              'jobs)')
+    parser.add_argument('--cache_fold_networks', action='store_true', required=False, default=False,
+                        help='Set this flag to keep one network per fold on the device instead of reloading the '
+                             'weights of every fold for every case. Faster for many cases, but needs enough (GPU) '
+                             'memory for the weights of all folds.')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=1,
+                        help='Number of sliding window tiles predicted together in one forward pass. Higher values '
+                             'can speed up inference on large GPUs but need more GPU memory. Default: 1')
+    parser.add_argument('--ensemble_folds_per_tile', action='store_true', required=False, default=False,
+                        help='Set this flag to evaluate all folds on each tile in one vectorized call, so that the '
+                             'sliding window only runs once per case instead of once per fold. Needs more GPU '
+                             'memory.')
+    parser.add_argument('-empty_tiles', type=str, required=False, default='predict',
+                        choices=['predict', 'reuse', 'fill'],
+                        help="How to handle sliding window tiles whose input is all zeros (e.g. background of skull "
+                             "stripped images). 'predict': run them through the network (default). 'reuse': predict "
+                             "one empty tile and reuse its prediction for all others, equivalent to 'predict' up "
+                             "to floating-point nondeterminism. 'fill': skip them and assign background to voxels "
+                             "that are only covered by empty tiles. 'reuse' and 'fill' only apply if the "
+                             "normalization keeps the background at exactly 0.")
+    parser.add_argument('--export_on_device', action='store_true', required=False, default=False,
+                        help='Set this flag to compute the segmentation with torch on the prediction device instead '
+                             'of in the export workers. Cases whose logits need resampling are still exported as '
+                             'usual unless --linear_resampling_on_device is set. Not used with --save_probabilities.')
+    parser.add_argument('--linear_resampling_on_device', action='store_true', required=False, default=False,
+                        help='With --export_on_device, also resample the logits on the device with linear '
+                             'interpolation instead of the configured resampling. Faster, but segmentations can differ '
+                             'slightly at label borders.')
 
     print(
         "\n#######################################################################\nPlease cite the following paper "
@@ -855,7 +1241,13 @@ def predict_entry_point():
                                 device=device,
                                 verbose=args.verbose,
                                 verbose_preprocessing=args.verbose,
-                                allow_tqdm=not args.disable_progress_bar)
+                                allow_tqdm=not args.disable_progress_bar,
+                                cache_fold_networks=args.cache_fold_networks,
+                                tile_batch_size=args.tile_batch_size,
+                                ensemble_folds_per_tile=args.ensemble_folds_per_tile,
+                                empty_tiles=args.empty_tiles,
+                                export_on_device=args.export_on_device,
+                                linear_resampling_on_device=args.linear_resampling_on_device)
     predictor.initialize_from_trained_model_folder(
         model_folder,
         args.f,
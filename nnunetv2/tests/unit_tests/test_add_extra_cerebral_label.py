@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from scipy.ndimage import binary_dilation, binary_fill_holes
+
+pytest.importorskip('nibabel')
+
+from data_utils.add_extra_cerebral_label import add_extra_label, mask_image, process_mask, to_label_map
+
+
+def reference_process_mask(mask_data, fill_holes=True, dilation_iterations=None):
+    """process_mask as it was before it was cropped to the bounding box of the mask."""
+    closed_mask = binary_fill_holes(mask_data) if fill_holes else mask_data
+    return binary_dilation(closed_mask, iterations=dilation_iterations) if dilation_iterations else closed_mask
+
+
+def reference_add_extra_label(label_map, mask, extra_label=np.int32(257)):
+    """add_extra_label as it was before it worked in place on the bounding box of the mask."""
+    new_label_map = label_map.copy()
+    new_label_map[(mask > 0) & (label_map == 0)] = extra_label
+    return np.round(new_label_map).astype(np.int32)
+
+
+def uncrop(shape, bbox, crop):
+    full = np.zeros(shape, dtype=crop.dtype)
+    full[bbox] = crop
+    return full
+
+
+def hollow_blob(shape, center, radius, seed):
+    """A noisy ball with an enclosed cavity and a few disconnected voxels."""
+    rng = np.random.RandomState(seed)
+    grid = np.indices(shape)
+    distance = np.sqrt(sum((g - c) ** 2 for g, c in zip(grid, center)))
+    mask = (distance + rng.uniform(-1, 1, size=shape) < radius) & (distance > radius / 3)
+    mask &= rng.uniform(size=shape) > 0.05
+    mask |= rng.uniform(size=shape) > 0.999
+    return mask
+
+
+@pytest.mark.parametrize('fill_holes', [False, True])
+@pytest.mark.parametrize('dilation_iterations', [None, 1, 3])
+@pytest.mark.parametrize('center', [(16, 18, 15), (0, 18, 15), (2, 33, 29)])
+def test_process_mask_matches_reference(center, fill_holes, dilation_iterations):
+    # the last two blobs are cut by the border of the volume, where cavities open to the outside are not filled
+    mask = hollow_blob((32, 36, 30), center, 9, seed=sum(center))
+    bbox, processed_mask = process_mask(mask, fill_holes=fill_holes, dilation_iterations=dilation_iterations)
+    np.testing.assert_array_equal(uncrop(mask.shape, bbox, processed_mask),
+                                  reference_process_mask(mask, fill_holes, dilation_iterations))
+
+
+@pytest.mark.parametrize('dilation_iterations', [None, 2])
+def test_process_mask_empty(dilation_iterations):
+    mask = np.zeros((12, 10, 8), dtype=bool)
+    bbox, processed_mask = process_mask(mask, fill_holes=True, dilation_iterations=dilation_iterations)
+    assert processed_mask.size == 0
+    np.testing.assert_array_equal(uncrop(mask.shape, bbox, processed_mask),
+                                  reference_process_mask(mask, True, dilation_iterations))
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.int16, np.uint8])
+def test_mask_image_matches_reference(dtype):
+    rng = np.random.RandomState(0)
+    image_data = (rng.uniform(0, 200, size=(20, 22, 18)) - (0 if dtype == np.uint8 else 50)).astype(dtype)
+    bbox, processed_mask = process_mask(hollow_blob(image_data.shape, (10, 11, 9), 6, seed=1), dilation_iterations=1)
+    result = mask_image(image_data, bbox, processed_mask)
+    # the masked image used to be image_data * mask, stored as float32
+    expected = image_data * uncrop(image_data.shape, bbox, processed_mask)
+    assert result.dtype == (np.float32 if dtype == np.float64 else dtype)
+    np.testing.assert_array_equal(result.astype(np.float32), expected.astype(np.float32))
+
+
+def test_mask_image_empty_mask():
+    image_data = np.ones((6, 5, 4), dtype=np.float32)
+    bbox, processed_mask = process_mask(np.zeros(image_data.shape, dtype=bool))
+    np.testing.assert_array_equal(mask_image(image_data, bbox, processed_mask), 0)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.int16, np.int32])
+def test_add_extra_label_in_place_matches_reference(dtype):
+    rng = np.random.RandomState(2)
+    label_data = rng.choice([0, 0, 0, 2, 3, 41, 42], size=(24, 20, 22)).astype(dtype)
+    if np.issubdtype(dtype, np.floating):
+        # labels saved as floats are rounded
+        label_data += rng.uniform(-0.2, 0.2, size=label_data.shape).astype(dtype)
+    mask = hollow_blob(label_data.shape, (12, 10, 11), 8, seed=3)
+    expected = reference_add_extra_label(np.round(label_data).astype(np.int32), mask)
+
+    label_map = to_label_map(label_data)
+    assert label_map.dtype == np.int32
+    bbox, processed_mask = process_mask(mask, fill_holes=False)
+    result = add_extra_label(label_map, processed_mask, extra_label=np.int32(257), bbox=bbox)
+    assert result is label_map
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_to_label_map_keeps_writable_int32():
+    label_data = np.arange(24, dtype=np.int32).reshape(2, 3, 4)
+    assert to_label_map(label_data) is label_data
+    label_data.flags.writeable = False
+    label_map = to_label_map(label_data)
+    assert label_map is not label_data and label_map.flags.writeable
+    np.testing.assert_array_equal(label_map, label_data)
+
+
+def test_add_extra_label_without_bbox():
+    label_map = np.array([[0, 1], [0, 2]], dtype=np.int32)
+    mask = np.array([[True, True], [False, False]])
+    add_extra_label(label_map, mask, extra_label=np.int32(300))
+    np.testing.assert_array_equal(label_map, [[300, 1], [0, 2]])
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from scipy.ndimage import label
+
+morphology = pytest.importorskip('skimage.morphology')
+
+from data_utils.mask_refinement import refine_mask
+
+
+def reference_refine_mask(binary_mask, dilation_voxels=0):
+    """The full-volume implementation refine_mask replaces."""
+    labeled_mask, num_features = label(binary_mask)
+    sizes = np.bincount(labeled_mask.ravel())
+    sizes[0] = 0  # Ignore background
+    largest_component_mask = labeled_mask == sizes.argmax()
+    closed_mask = morphology.binary_closing(largest_component_mask, morphology.ball(5))
+    if dilation_voxels > 0:
+        return morphology.binary_dilation(closed_mask, morphology.ball(dilation_voxels))
+    return closed_mask
+
+
+def random_blobs(shape, seed, center=None, radius=9):
+    """A noisy ball with holes and a few small disconnected components."""
+    rng = np.random.RandomState(seed)
+    if center is None:
+        center = [s // 2 for s in shape]
+    grid = np.indices(shape)
+    distance = np.sqrt(sum((g - c) ** 2 for g, c in zip(grid, center)))
+    mask = distance + rng.uniform(-2, 2, size=shape) < radius
+    mask &= rng.uniform(size=shape) > 0.05
+    mask |= rng.uniform(size=shape) > 0.998
+    return mask
+
+
+@pytest.mark.parametrize('dilation_voxels', [0, 1, 3])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_refine_mask_matches_reference(seed, dilation_voxels):
+    mask = random_blobs((48, 44, 40), seed)
+    np.testing.assert_array_equal(refine_mask(mask, dilation_voxels), reference_refine_mask(mask, dilation_voxels))
+
+
+@pytest.mark.parametrize('dilation_voxels', [0, 2])
+@pytest.mark.parametrize('center', [(0, 20, 20), (3, 3, 3), (35, 20, 38)])
+def test_refine_mask_matches_reference_at_border(center, dilation_voxels):
+    # the mask touches the border of the volume, where erosion treats the outside as set
+    mask = random_blobs((36, 40, 40), 2, center=center)
+    np.testing.assert_array_equal(refine_mask(mask, dilation_voxels), reference_refine_mask(mask, dilation_voxels))
+
+
+@pytest.mark.parametrize('dilation_voxels', [0, 2])
+def test_refine_mask_empty(dilation_voxels):
+    mask = np.zeros((20, 24, 16), dtype=bool)
+    np.testing.assert_array_equal(refine_mask(mask, dilation_voxels), reference_refine_mask(mask, dilation_voxels))
+
+
+def test_refine_mask_full():
+    mask = np.ones((20, 24, 16), dtype=bool)
+    np.testing.assert_array_equal(refine_mask(mask), reference_refine_mask(mask))
@@ -0,0 +1,189 @@
+import os
+import time
+
+import pytest
+
+from data_utils import conform_cache
+from data_utils.conform_cache import ConformCache
+
+# the parameters conform_images keys the cache with
+PARAMS = dict(order=1, dtype='uint8', conform_vox_size='min', conform_to_1mm_threshold=None, criteria=['min'])
+
+
+def write_file(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def input_path(tmp_path):
+    return write_file(os.path.join(tmp_path, 'sub-01_T1w.nii.gz'), b'input image')
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ConformCache(os.path.join(tmp_path, 'cache'))
+
+
+def test_make_key_is_deterministic(tmp_path, input_path):
+    # the key depends on the content of the input, not on its path
+    copy_path = write_file(os.path.join(tmp_path, 'copy.nii.gz'), read_file(input_path))
+    assert ConformCache.make_key(input_path, **PARAMS) == ConformCache.make_key(copy_path, **PARAMS)
+
+
+@pytest.mark.parametrize('name, value', [
+    ('order', 3),
+    ('dtype', 'float32'),
+    ('conform_vox_size', 0.7),
+    ('conform_to_1mm_threshold', 0.95),
+    ('criteria', ['force_lia', 'min']),
+])
+def test_make_key_changes_with_each_param(input_path, name, value):
+    assert ConformCache.make_key(input_path, **PARAMS) != ConformCache.make_key(input_path, **{**PARAMS, name: value})
+
+
+def test_make_key_changes_with_input_content(tmp_path, input_path):
+    other_path = write_file(os.path.join(tmp_path, 'other.nii.gz'), b'other image')
+    assert ConformCache.make_key(input_path, **PARAMS) != ConformCache.make_key(other_path, **PARAMS)
+
+
+def test_make_key_changes_with_cache_version(monkeypatch, input_path):
+    key = ConformCache.make_key(input_path, **PARAMS)
+    monkeypatch.setattr(conform_cache, 'CACHE_VERSION', conform_cache.CACHE_VERSION + 1)
+    assert ConformCache.make_key(input_path, **PARAMS) != key
+
+
+def test_fetch_missing(tmp_path, cache, input_path):
+    output_path = os.path.join(tmp_path, 'out.nii.gz')
+    assert not cache.fetch(ConformCache.make_key(input_path, **PARAMS), output_path)
+    assert not os.path.exists(output_path)
+
+
+@pytest.mark.parametrize('hardlink', [False, True])
+def test_store_fetch_round_trip(tmp_path, input_path, hardlink):
+    cache = ConformCache(os.path.join(tmp_path, 'cache'), hardlink=hardlink)
+    key = ConformCache.make_key(input_path, **PARAMS)
+    conformed_path = write_file(os.path.join(tmp_path, 'conformed.nii.gz'), b'conformed image')
+    cache.store(key, conformed_path)
+
+    output_path = os.path.join(tmp_path, 'out.nii.gz')
+    assert cache.fetch(key, output_path)
+    assert read_file(output_path) == b'conformed image'
+    entry_path = os.path.join(cache.cache_dir, key + '.nii.gz')
+    assert os.path.samefile(output_path, entry_path) == hardlink
+    # no temporary files are left behind
+    assert os.listdir(cache.cache_dir) == [key + '.nii.gz']
+
+
+def test_store_keeps_existing_entry(tmp_path, cache, input_path):
+    key = ConformCache.make_key(input_path, **PARAMS)
+    cache.store(key, write_file(os.path.join(tmp_path, 'first.nii.gz'), b'first'))
+    cache.store(key, write_file(os.path.join(tmp_path, 'second.nii.gz'), b'second'))
+    assert cache.fetch(key, os.path.join(tmp_path, 'out.nii.gz'))
+    assert read_file(os.path.join(tmp_path, 'out.nii.gz')) == b'first'
+
+
+def test_hardlink_falls_back_to_copy(monkeypatch, tmp_path, input_path):
+    def link(source, destination):
+        raise OSError("Invalid cross-device link")
+
+    monkeypatch.setattr(conform_cache.os, 'link', link)
+    cache = ConformCache(os.path.join(tmp_path, 'cache'), hardlink=True)
+    key = ConformCache.make_key(input_path, **PARAMS)
+    conformed_path = write_file(os.path.join(tmp_path, 'conformed.nii.gz'), b'conformed image')
+    cache.store(key, conformed_path)
+
+    output_path = os.path.join(tmp_path, 'out.nii.gz')
+    assert cache.fetch(key, output_path)
+    assert read_file(output_path) == b'conformed image'
+    assert not os.path.samefile(output_path, os.path.join(cache.cache_dir, key + '.nii.gz'))
+
+
+def test_fetch_output_already_is_cached_file(monkeypatch, tmp_path, input_path):
+    cache = ConformCache(os.path.join(tmp_path, 'cache'), hardlink=True)
+    key = ConformCache.make_key(input_path, **PARAMS)
+    output_path = write_file(os.path.join(tmp_path, 'out.nii.gz'), b'conformed image')
+    cache.store(key, output_path)
+    entry_path = os.path.join(cache.cache_dir, key + '.nii.gz')
+    assert os.path.samefile(output_path, entry_path)
+
+    def place(source_path, destination_path):
+        raise AssertionError("the output must not be replaced")
+
+    monkeypatch.setattr(cache, '_place', place)
+    os.utime(entry_path, (0, 0))
+    assert cache.fetch(key, output_path)
+    assert read_file(output_path) == b'conformed image'
+    # the entry is still marked as recently used
+    assert os.stat(entry_path).st_mtime > time.time() - 3600
+
+
+def test_fetch_uses_output_file_ending(tmp_path, cache, input_path):
+    key = ConformCache.make_key(input_path, **PARAMS)
+    cache.store(key, write_file(os.path.join(tmp_path, 'conformed.nii.gz'), b'gzipped'))
+    assert not cache.fetch(key, os.path.join(tmp_path, 'out.nii'))
+
+
+def make_entries(cache, ages_days, size=100):
+    """Cache entries of size bytes, last used ages_days ago."""
+    now = time.time()
+    paths = []
+    for i, age in enumerate(ages_days):
+        path = write_file(os.path.join(cache.cache_dir, f'{i:02d}.nii.gz'), b'x' * size)
+        os.utime(path, (now - age * 24 * 3600, now - age * 24 * 3600))
+        paths.append(path)
+    return paths
+
+
+def remaining(cache):
+    return sorted(os.listdir(cache.cache_dir))
+
+
+def test_evict_nothing_without_limits(cache):
+    make_entries(cache, [100, 10, 1])
+    cache.evict()
+    assert remaining(cache) == ['00.nii.gz', '01.nii.gz', '02.nii.gz']
+
+
+def test_evict_by_age(cache):
+    cache.max_age_days = 7
+    make_entries(cache, [30, 1, 8, 0.5])
+    cache.evict()
+    assert remaining(cache) == ['01.nii.gz', '03.nii.gz']
+
+
+def test_evict_least_recently_used_by_size(cache):
+    cache.max_size_gb = 250 / 1024 ** 3
+    make_entries(cache, [3, 1, 5, 2, 4])
+    cache.evict()
+    # the two most recently used entries fit
+    assert remaining(cache) == ['01.nii.gz', '03.nii.gz']
+
+
+def test_evict_by_age_then_size(cache):
+    # after the entries older than 7 days are removed, the remaining 400 bytes are over the 300 bytes limit and
+    # only the least recently used of them is removed
+    cache.max_age_days = 7
+    cache.max_size_gb = 300 / 1024 ** 3
+    make_entries(cache, [10, 3, 20, 1, 2, 6])
+    cache.evict()
+    assert remaining(cache) == ['01.nii.gz', '03.nii.gz', '04.nii.gz']
+
+
+def test_evict_fetch_refreshes_entry(tmp_path, cache, input_path):
+    cache.max_size_gb = 150 / 1024 ** 3
+    key = ConformCache.make_key(input_path, **PARAMS)
+    old_paths = make_entries(cache, [2])
+    cache.store(key, write_file(os.path.join(tmp_path, 'conformed.nii.gz'), b'y' * 100))
+    entry_path = os.path.join(cache.cache_dir, key + '.nii.gz')
+    os.utime(entry_path, (time.time() - 5 * 24 * 3600,) * 2)
+    assert cache.fetch(key, os.path.join(tmp_path, 'out.nii.gz'))
+    cache.evict()
+    assert os.path.isfile(entry_path)
+    assert not os.path.exists(old_paths[0])
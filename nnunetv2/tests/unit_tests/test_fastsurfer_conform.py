@@ -0,0 +1,182 @@
+import numpy as np
+import pytest
+from scipy.ndimage import affine_transform
+
+nib = pytest.importorskip('nibabel')
+
+from data_utils.fastsurfer import conform
+
+
+def reference_getscale(data, dst_min, dst_max, f_low=0.0, f_high=0.999):
+    """getscale as it was before the statistics were chunked."""
+    data_min = np.min(data)
+    data_max = np.max(data)
+    if f_low == 0.0 and f_high == 1.0:
+        return data_min, 1.0
+    num_nonzero_voxels = (np.abs(data) >= 1e-15).sum()
+    num_total_voxels = data.shape[0] * data.shape[1] * data.shape[2]
+    hist, bin_edges = np.histogram(data, bins=1000, range=(data_min, data_max))
+    cum_hist = np.concatenate(([0], np.cumsum(hist)))
+    lower_cutoff = int(f_low * num_total_voxels)
+    binindex_lt_low_cutoff = np.flatnonzero(cum_hist < lower_cutoff)
+    lower_binedge_index = 0
+    if len(binindex_lt_low_cutoff) > 0:
+        lower_binedge_index = binindex_lt_low_cutoff[-1] + 1
+    src_min = bin_edges[lower_binedge_index].item()
+    upper_cutoff = num_total_voxels - int((1.0 - f_high) * num_nonzero_voxels)
+    binindex_ge_up_cutoff = np.flatnonzero(cum_hist >= upper_cutoff)
+    if len(binindex_ge_up_cutoff) > 0:
+        upper_binedge_index = binindex_ge_up_cutoff[0] - 2
+    else:
+        upper_binedge_index = -1
+    src_max = bin_edges[upper_binedge_index].item()
+    scale = 1.0 if src_min == src_max else (dst_max - dst_min) / (src_max - src_min)
+    return src_min, scale
+
+
+def reference_scalecrop_to_dtype(data, dst_min, dst_max, src_min, scale, dtype, do_scale=True):
+    """The intensity conversion at the end of conform() before it was fused into scalecrop_to_dtype."""
+    if do_scale:
+        scaled_data = np.clip(dst_min + scale * (data - src_min), dst_min, dst_max)
+        scaled_data[data == 0] = 0
+        data = scaled_data
+    if np.dtype(dtype) == np.dtype(np.uint8):
+        data = np.clip(np.rint(data), 0, 255)
+    return np.dtype(dtype).type(data)
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # make the chunked code paths process several chunks (and a partial last one) on small test images
+    iter_chunks = conform._iter_chunks
+    monkeypatch.setattr(conform, '_iter_chunks', lambda data_flat, chunk_size=997: iter_chunks(data_flat, chunk_size))
+
+
+def make_image(shape, dtype, seed=0, negative=False):
+    rng = np.random.RandomState(seed)
+    data = rng.gamma(2.0, 200.0, size=shape)
+    data[rng.uniform(size=shape) < 0.3] = 0  # background
+    if negative:
+        data -= 50
+    return data.astype(dtype)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.int16, np.uint8])
+@pytest.mark.parametrize('f_low, f_high', [(0.0, 0.999), (0.01, 0.99), (0.0, 1.0)])
+def test_getscale_matches_reference(small_chunks, dtype, f_low, f_high):
+    data = make_image((23, 19, 17), dtype)
+    assert conform.getscale(data, 0, 255, f_low, f_high) == reference_getscale(data, 0, 255, f_low, f_high)
+
+
+def test_getscale_matches_reference_negative_and_non_contiguous(small_chunks):
+    data = make_image((30, 24, 20), np.float32, seed=1, negative=True)
+    for view in (data.transpose(2, 0, 1), data[::2, :, 3:], np.asfortranarray(data)):
+        assert conform.getscale(view, 0, 255) == reference_getscale(view, 0, 255)
+
+
+def test_getscale_single_chunk():
+    data = make_image((16, 16, 16), np.float32, seed=2)
+    assert conform.getscale(data, 0, 255) == reference_getscale(data, 0, 255)
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.float32, np.int16])
+@pytest.mark.parametrize('do_scale', [True, False])
+def test_scalecrop_to_dtype_matches_reference(small_chunks, dtype, do_scale):
+    data = make_image((21, 18, 15), np.float64, seed=3)
+    src_min, scale = reference_getscale(data, 0, 255)
+    result = conform.scalecrop_to_dtype(data, 0, 255, src_min, scale, dtype, do_scale=do_scale)
+    expected = reference_scalecrop_to_dtype(data, 0, 255, src_min, scale, dtype, do_scale=do_scale)
+    assert result.dtype == expected.dtype
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_scalecrop_to_dtype_non_contiguous(small_chunks):
+    data = make_image((21, 18, 15), np.float64, seed=4).transpose(1, 2, 0)[:, ::2]
+    src_min, scale = reference_getscale(data, 0, 255)
+    np.testing.assert_array_equal(conform.scalecrop_to_dtype(data, 0, 255, src_min, scale, np.uint8),
+                                  reference_scalecrop_to_dtype(data, 0, 255, src_min, scale, np.uint8))
+
+
+def rotation(angles):
+    a, b, c = angles
+    rx = np.array([[1, 0, 0], [0, np.cos(a), -np.sin(a)], [0, np.sin(a), np.cos(a)]])
+    ry = np.array([[np.cos(b), 0, np.sin(b)], [0, 1, 0], [-np.sin(b), 0, np.cos(b)]])
+    rz = np.array([[np.cos(c), -np.sin(c), 0], [np.sin(c), np.cos(c), 0], [0, 0, 1]])
+    return rx @ ry @ rz
+
+
+def homogeneous(linear, offset):
+    matrix = np.eye(4)
+    matrix[:3, :3] = linear
+    matrix[:3, 3] = offset
+    return matrix
+
+
+def unambiguous_voxels(matrix, source_shape, out_shape, order):
+    """
+    Target voxels whose source coordinates are not within rounding distance of a discontinuity of affine_transform:
+    the first and last source voxel of each axis (with mode='constant' the value drops to 0 right outside) and, for
+    order 0, the points halfway between two source voxels.
+    """
+    target = np.indices(out_shape).reshape(3, -1).astype(float)
+    coordinates = matrix[:3, :3] @ target + matrix[:3, 3:]
+    tolerance = 1e-6
+    ambiguous = np.zeros(target.shape[1], dtype=bool)
+    for axis, size in enumerate(source_shape):
+        ambiguous |= np.abs(coordinates[axis]) < tolerance
+        ambiguous |= np.abs(coordinates[axis] - (size - 1)) < tolerance
+        if order == 0:
+            ambiguous |= np.abs(coordinates[axis] - np.floor(coordinates[axis]) - 0.5) < tolerance
+    return ~ambiguous.reshape(out_shape)
+
+
+# mappings from target to source voxel coordinates
+MAPPINGS = {
+    # isotropic resampling to a smaller voxel size
+    'zoom': homogeneous(np.diag([0.7, 0.7, 0.7]), [0.15, 0.15, 0.15]),
+    # reorientation to LIA with resampling (permuted and flipped axes)
+    'axis_aligned': homogeneous(np.array([[-0.8, 0, 0], [0, 0, 0.9], [0, -0.75, 0]]), [24.13, 0.31, 19.23]),
+    # oblique acquisition
+    'oblique': homogeneous(rotation((0.2, -0.15, 0.1)) * 0.85, [2.3, -1.7, 3.1]),
+    # downsampling by 2 with a flipped axis. All coordinates are exactly halfway between two source voxels
+    'half_voxel_ties': homogeneous(np.array([[0, -2, 0], [2, 0, 0], [0, 0, 2]]), [21.5, 0.5, 0.5]),
+}
+
+
+@pytest.mark.parametrize('order', [0, 1, 3])
+@pytest.mark.parametrize('mapping', sorted(MAPPINGS))
+@pytest.mark.parametrize('num_threads', [1, 3])
+def test_map_image_data_threaded_matches_affine_transform(order, mapping, num_threads):
+    image_data = make_image((26, 22, 24), np.float64, seed=5)
+    matrix = MAPPINGS[mapping]
+    out_shape = (29, 27, 31)
+    expected = affine_transform(image_data, matrix, output_shape=out_shape, order=order)
+    result = conform.map_image_data_threaded(image_data, matrix, out_shape, order=order, num_threads=num_threads)
+    assert result.dtype == expected.dtype
+    # the half voxel ties are exact in floating point and must be rounded like affine_transform does
+    mask = unambiguous_voxels(matrix, image_data.shape, out_shape, order) if mapping != 'half_voxel_ties' else \
+        np.ones(out_shape, dtype=bool)
+    assert mask.mean() > 0.9
+    np.testing.assert_allclose(result[mask], expected[mask], rtol=0, atol=1e-9 * np.abs(image_data).max())
+
+
+@pytest.mark.parametrize('order', [0, 1, 3])
+@pytest.mark.parametrize('mapping', sorted(MAPPINGS))
+def test_map_image_num_threads_matches_single_call(order, mapping):
+    image_data = make_image((26, 22, 24), np.float32, seed=6)
+    img = nib.Nifti1Image(image_data, np.eye(4))
+    # map_image pulls the target back with inv(inv(out_affine) @ img.affine), so out_affine is the mapping from target
+    # to source voxel coordinates
+    out_affine = MAPPINGS[mapping]
+    out_shape = (29, 27, 31)
+    expected = conform.map_image(img, out_affine, out_shape, order=order, dtype=float)
+    result = conform.map_image(img, out_affine, out_shape, order=order, dtype=float, num_threads=2)
+    mask = unambiguous_voxels(MAPPINGS[mapping], image_data.shape, out_shape, order)
+    np.testing.assert_allclose(result[mask], expected[mask], rtol=0, atol=1e-9 * np.abs(image_data).max())
+
+
+def test_spline_filter_threaded_matches_spline_filter():
+    from scipy.ndimage import spline_filter
+    image_data = make_image((20, 17, 13), np.float32, seed=7)
+    np.testing.assert_array_equal(conform.spline_filter_threaded(image_data, 3, num_threads=3),
+                                  spline_filter(image_data, 3, output=np.float64, mode='constant'))
@@ -0,0 +1,89 @@
+import pytest
+
+from data_utils.rename_files_nnunet_convention import build_sub_id_index, extract_sub_id, match_mask_to_image
+
+
+@pytest.mark.parametrize('filename, start_substring, end_substring, expected', [
+    ('sub-01_T1w.nii.gz', None, None, 'sub-01_T1w'),
+    ('sub-01_T1w.nii', None, None, 'sub-01_T1w'),
+    ('sub-01_T1w.nii.gz', 'sub-', None, '01_T1w'),
+    ('sub-01_T1w.nii.gz', None, '_T1w', 'sub-01'),
+    ('sub-01_T1w.nii.gz', 'sub-', '_T1w', '01'),
+    ('sub-01_T1w.nii.gz', 'ses-', None, None),
+    ('sub-01_T1w.nii.gz', None, '_T2w', None),
+])
+def test_extract_sub_id(filename, start_substring, end_substring, expected):
+    assert extract_sub_id(filename, start_substring, end_substring) == expected
+
+
+def test_build_sub_id_index():
+    filenames = ['sub-02_T1w.nii.gz', 'sub-01_T1w.nii.gz', 'sub-01_run-2_T1w.nii.gz', 'other.nii.gz']
+    assert build_sub_id_index(filenames, 'sub-', '_') == {
+        '01': ['sub-01_T1w.nii.gz', 'sub-01_run-2_T1w.nii.gz'],
+        '02': ['sub-02_T1w.nii.gz'],
+    }
+
+
+def match(mask_filename, input_filenames, start_substring=None, end_substring=None):
+    input_index = build_sub_id_index(input_filenames, start_substring, end_substring)
+    return match_mask_to_image(mask_filename, input_index, input_filenames, start_substring, end_substring)
+
+
+def test_match_mask_to_image_default_mask_name():
+    # run_brain_extraction saves the masks as mask_<input filename>
+    input_filenames = ['sub-01_T1w.nii.gz', 'sub-02_T1w.nii.gz']
+    assert match('mask_sub-01_T1w.nii.gz', input_filenames) == 'sub-01_T1w.nii.gz'
+    assert match('mask_sub-02_T1w.nii', input_filenames) == 'sub-02_T1w.nii.gz'
+
+
+@pytest.mark.parametrize('mask_filename, start_substring, end_substring', [
+    ('sub-01_T1w_mask.nii.gz', None, None),
+    ('sub-01_T1w-mask.nii.gz', None, None),
+    ('mask.sub-01_T1w.nii.gz', None, None),
+    ('sub-01_mask_T1w.nii.gz', 'sub-', '_T1w'),
+    ('sub-01_T1w_mask.nii.gz', 'sub-', '_T1w'),
+    ('sub-01-mask_T1w.nii.gz', 'sub-', '_T1w'),
+])
+def test_match_mask_to_image_strips_mask_and_separators(capsys, mask_filename, start_substring, end_substring):
+    input_filenames = ['sub-01_T1w.nii.gz', 'sub-02_T1w.nii.gz']
+    assert match(mask_filename, input_filenames, start_substring, end_substring) == 'sub-01_T1w.nii.gz'
+    # found through the index, not the fallback
+    assert capsys.readouterr().out == ''
+
+
+def test_match_mask_to_image_prefix_ids(capsys):
+    # a substring search for sub-1 would also find sub-10
+    input_filenames = ['sub-1_T1w.nii.gz', 'sub-10_T1w.nii.gz', 'sub-11_T1w.nii.gz']
+    assert match('mask_sub-1_T1w.nii.gz', input_filenames, 'sub-', '_') == 'sub-1_T1w.nii.gz'
+    assert match('mask_sub-10_T1w.nii.gz', input_filenames, 'sub-', '_') == 'sub-10_T1w.nii.gz'
+    assert match('sub-1_mask.nii.gz', input_filenames, 'sub-', '_') == 'sub-1_T1w.nii.gz'
+    assert capsys.readouterr().out == ''
+
+
+def test_match_mask_to_image_rejects_ambiguous_ids(capsys):
+    input_filenames = ['sub-01_run-1_T1w.nii.gz', 'sub-01_run-2_T1w.nii.gz', 'sub-02_run-1_T1w.nii.gz']
+    assert match('mask_sub-01_T1w.nii.gz', input_filenames, 'sub-', '_') is None
+    assert 'Several images match mask mask_sub-01_T1w.nii.gz' in capsys.readouterr().out
+    assert match('mask_sub-02_T1w.nii.gz', input_filenames, 'sub-', '_') == 'sub-02_run-1_T1w.nii.gz'
+
+
+def test_match_mask_to_image_substring_fallback(capsys):
+    # the ID of the mask is not in the index, the input filename containing the mask filename without 'mask' is used
+    input_filenames = ['scan_sub-01_T1w.nii.gz', 'scan_sub-02_T1w.nii.gz']
+    assert match('masksub-01_T1w.nii.gz', input_filenames) == 'scan_sub-01_T1w.nii.gz'
+    assert 'looking for input filenames containing sub-01_T1w.nii.gz instead' in capsys.readouterr().out
+
+
+def test_match_mask_to_image_fallback_without_start_substring(capsys):
+    # the mask filenames do not contain start_substring, so they have no ID
+    input_filenames = ['sub-01_T1w.nii.gz', 'sub-02_T1w.nii.gz']
+    assert match('01_T1wmask.nii.gz', input_filenames, 'sub-', '_T1w') == 'sub-01_T1w.nii.gz'
+    assert 'Subject ID None of mask 01_T1wmask.nii.gz' in capsys.readouterr().out
+    assert match('03_T1wmask.nii.gz', input_filenames, 'sub-', '_T1w') is None
+    assert 'No matching image found for mask 03_T1wmask.nii.gz' in capsys.readouterr().out
+
+
+def test_match_mask_to_image_ambiguous_fallback(capsys):
+    input_filenames = ['a_sub-01.nii.gz', 'b_sub-01.nii.gz']
+    assert match('sub-01mask.nii.gz', input_filenames) is None
+    assert 'Several images match mask sub-01mask.nii.gz' in capsys.readouterr().out
@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import pytest
+
+nib = pytest.importorskip('nibabel')
+
+from data_utils.reorder_labels_freesurfer_lut import create_lookup_table, process_label_map, remap_labels
+
+
+@pytest.fixture
+def lut():
+    return create_lookup_table({1: 10, 2: 20, 3: 3})
+
+
+def test_remap_labels_in_range(lut):
+    segmentation = np.array([[0, 1], [2, 3]], dtype=np.int16)
+    np.testing.assert_array_equal(remap_labels(segmentation, lut), [[0, 10], [20, 3]])
+
+
+def test_remap_labels_out_of_range_keeps_value(lut):
+    segmentation = np.array([0, 1, 2, 3, 4, 1000], dtype=np.int32)
+    np.testing.assert_array_equal(remap_labels(segmentation, lut), [0, 10, 20, 3, 4, 1000])
+
+
+def test_remap_labels_negative_keeps_value(lut):
+    # -1 must not be mapped to lut[-1]
+    segmentation = np.array([-1, -4, 1, 2, 5], dtype=np.int32)
+    np.testing.assert_array_equal(remap_labels(segmentation, lut), [-1, -4, 10, 20, 5])
+
+
+def test_remap_labels_empty(lut):
+    assert remap_labels(np.zeros((0, 3), dtype=np.int32), lut).shape == (0, 3)
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.float32])
+def test_process_label_map(tmp_path, lut, dtype):
+    data = np.array([[[-2, 0], [1, 2]], [[3, 7], [1, -1]]], dtype=dtype)
+    input_file = os.path.join(tmp_path, 'seg.nii.gz')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), input_file)
+    output_dir = os.path.join(tmp_path, 'out')
+    os.makedirs(output_dir)
+
+    process_label_map(input_file, output_dir, lut)
+
+    result = nib.load(os.path.join(output_dir, 'seg.nii.gz'))
+    assert result.get_data_dtype() == np.int32
+    np.testing.assert_array_equal(np.asanyarray(result.dataobj), [[[-2, 0], [10, 20]], [[3, 7], [10, -1]]])
@@ -176,6 +176,10 @@ class LabelManager(object):
 
     def convert_logits_to_segmentation(self, predicted_logits: Union[np.ndarray, torch.Tensor]) -> \
             Union[np.ndarray, torch.Tensor]:
+        if not self.has_regions:
+            # softmax does not change the argmax, so there is no need to compute it (and the float32 copy of the
+            # logits that comes with it) if only the segmentation is wanted
+            return self.convert_probabilities_to_segmentation(predicted_logits)
         input_is_numpy = isinstance(predicted_logits, np.ndarray)
         probabilities = self.apply_inference_nonlin(predicted_logits)
         if input_is_numpy and isinstance(probabilities, torch.Tensor):
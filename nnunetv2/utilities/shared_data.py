@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+from typing import Union
+
+import numpy as np
+import torch
+
+
+# shared directories that ran full in this process. share_data does not try to write to them again
+_full_shared_dirs = set()
+
+
+def make_shared_data_dir() -> str:
+    """
+    Creates a directory through which processes hand arrays to each other (see share_data). Uses /dev/shm (RAM) if
+    available.
+    """
+    base_dir = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+    return tempfile.mkdtemp(prefix='nnunet_shared_', dir=base_dir)
+
+
+def share_data(data: Union[np.ndarray, torch.Tensor], shared_dir: Union[str, None],
+               dtype: Union[type, None] = np.float32) -> Union[str, torch.Tensor]:
+    """
+    Writes a copy of data (converted to dtype unless dtype is None) to a .npy file in shared_dir and returns the file
+    name, so that only the name has to go through a queue or to a pool worker instead of the pickled array. Returns
+    the data as tensor if there is no shared_dir or it does not have enough free space. Once writing to shared_dir
+    has failed, it is not tried again in this process.
+    """
+    if isinstance(data, torch.Tensor):
+        data = data.numpy()
+    data = np.ascontiguousarray(data, dtype=dtype)
+    if shared_dir is not None and shared_dir not in _full_shared_dirs and \
+            shutil.disk_usage(shared_dir).free > data.nbytes:
+        fd, data_file = tempfile.mkstemp(suffix='.npy', dir=shared_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, data)
+            return data_file
+        except OSError:
+            # e.g. a small /dev/shm in docker containers. Fall back to sending the data itself
+            os.remove(data_file)
+            _full_shared_dirs.add(shared_dir)
+    return torch.from_numpy(data)
+
+
+def receive_data(data: Union[str, torch.Tensor]) -> torch.Tensor:
+    """
+    Counterpart of share_data. Memory maps the file (copy-on-write, so the tensor may be modified) instead of reading
+    it and removes it right away, the memory is freed once the tensor is gone.
+    """
+    if not isinstance(data, str):
+        return data
+    data_array = np.load(data, mmap_mode='c')
+    try:
+        os.remove(data)
+    except OSError:
+        # Windows cannot remove files that are mapped. The whole directory is removed at the end
+        pass
+    return torch.from_numpy(data_array)
@@ -23,7 +23,9 @@ import os
 import time
 
 
-def run_inference(dataset_id, input_dir, output_dir, config, trainer, plan, folds, num_pr, cpu):
+def run_inference(dataset_id, input_dir, output_dir, config, trainer, plan, folds, num_pr, cpu, tile_batch_size=1,
+                  ensemble_folds_per_tile=False, empty_tiles="predict", export_on_device=False,
+                  linear_resampling_on_device=False, cache_fold_networks=False):
     start_time = time.time()
     # Command for inference
     inference_command = [
@@ -38,8 +40,18 @@ def run_inference(dataset_id, input_dir, output_dir, config, trainer, plan, fold
                         ] + folds + [
                             "-chk", "checkpoint_best.pth",
                             "-npp", str(num_pr),
-                            "-nps", str(num_pr)
+                            "-nps", str(num_pr),
+                            "-tile_batch_size", str(tile_batch_size),
+                            "-empty_tiles", empty_tiles
                         ]
+    if ensemble_folds_per_tile:
+        inference_command.append("--ensemble_folds_per_tile")
+    if export_on_device:
+        inference_command.append("--export_on_device")
+    if linear_resampling_on_device:
+        inference_command.append("--linear_resampling_on_device")
+    if cache_fold_networks:
+        inference_command.append("--cache_fold_networks")
     # Add '-device cpu' if cpu is True
     if cpu:
         print("CPU will be used to run the inference. Expect a considerable increase in inference time.")
@@ -72,7 +84,7 @@ def apply_post_processing(input_dir, output_dir, pp_pkl_file, np, plans_json):
     return duration
 
 
-def apply_reordering(input_dir, output_dir, in_lut, out_lut):
+def apply_reordering(input_dir, output_dir, in_lut, out_lut, np=1):
     start_time = time.time()
     # Command for reordering labels
     reorder_command = [
@@ -80,7 +92,8 @@ def apply_reordering(input_dir, output_dir, in_lut, out_lut):
         "--input_dir", input_dir,
         "--output_dir", output_dir,
         "--old_labels_file", in_lut,
-        "--new_labels_file", out_lut
+        "--new_labels_file", out_lut,
+        "--np", str(np)
     ]
     print(f"Reordering labels with the following command: {' '.join(reorder_command)}")
     subprocess.run(reorder_command)
@@ -89,6 +102,105 @@ def apply_reordering(input_dir, output_dir, in_lut, out_lut):
     print(f"Label reordering completed in {duration:.2f} seconds.")
     return duration
 
+def get_trained_model_paths(gouhfi_home):
+    """Return the trained model folder and the postprocessing.pkl file of the GOUHFI installation."""
+    plans_dir = os.path.join(gouhfi_home, "trained_model/Dataset014_gouhfi/nnUNetTrainer_NoDA_500epochs_AdamW__nnUNetResEncL__3d_fullres")
+    pp_dir = os.path.join(plans_dir, "crossval_results_folds_0_1_2_3_4")
+    pp_pkl_file = os.path.join(pp_dir, "postprocessing.pkl")
+    return plans_dir, pp_pkl_file
+
+
+def build_predictor(model_dir, folds, cpu, pp_pkl_file, reorder_labels=False, in_lut=None, out_lut=None,
+                    tile_batch_size=1, ensemble_folds_per_tile=False, empty_tiles="predict", export_on_device=False,
+                    linear_resampling_on_device=False, parallel_gzip=False, cache_fold_networks=False):
+    """Load the trained folds once and attach the post-processing (and optional LUT remap) to the predictor."""
+    # Heavy imports are kept local so that the subprocess mode (and --help) stays lightweight
+    import multiprocessing
+    import torch
+    from batchgenerators.utilities.file_and_folder_operations import load_pickle
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+    from data_utils.reorder_labels_freesurfer_lut import load_labels, create_mapping, create_lookup_table, remap_labels
+
+    if cpu:
+        print("CPU will be used to run the inference. Expect a considerable increase in inference time.")
+        torch.set_num_threads(multiprocessing.cpu_count())
+        device = torch.device('cpu')
+    else:
+        # multithreading in torch doesn't help nnU-Net if run on GPU
+        torch.set_num_threads(1)
+        torch.set_num_interop_threads(1)
+        device = torch.device('cuda')
+
+    # cache_fold_networks keeps every fold loaded on the device, so consecutive subjects skip load_state_dict (but the
+    # device has to hold the weights of all folds at once)
+    predictor = nnUNetPredictor(tile_step_size=0.5,
+                                use_gaussian=True,
+                                use_mirroring=True,
+                                perform_everything_on_device=True,
+                                device=device,
+                                verbose=False,
+                                verbose_preprocessing=False,
+                                allow_tqdm=True,
+                                cache_fold_networks=cache_fold_networks,
+                                tile_batch_size=tile_batch_size,
+                                ensemble_folds_per_tile=ensemble_folds_per_tile,
+                                empty_tiles=empty_tiles,
+                                export_on_device=export_on_device,
+                                linear_resampling_on_device=linear_resampling_on_device)
+    predictor.initialize_from_trained_model_folder(model_dir, [int(f) for f in folds],
+                                                   checkpoint_name="checkpoint_best.pth")
+
+    if parallel_gzip:
+        # Same files, but .nii.gz files are (de)compressed with a multithreaded gzip engine
+        reader_writer = predictor.plans_manager.plans["image_reader_writer"]
+        parallel_reader_writer = {"NibabelIO": "NibabelIOParallelGzip",
+                                  "NibabelIOWithReorient": "NibabelIOWithReorientParallelGzip"}.get(reader_writer)
+        if parallel_reader_writer is None:
+            print(f"Warning: --parallel_gzip only applies to models that read images with NibabelIO or NibabelIOWithReorient, this one uses {reader_writer}. Ignoring it.")
+        else:
+            predictor.plans_manager.plans["image_reader_writer"] = parallel_reader_writer
+
+    # Post-processing (and the optional LUT remap) is applied to the segmentation in memory before it is written
+    pp_fns, pp_fn_kwargs = load_pickle(pp_pkl_file)
+    pp_fns, pp_fn_kwargs = list(pp_fns), list(pp_fn_kwargs)
+    if reorder_labels:
+        mapping = create_mapping(load_labels(in_lut), load_labels(out_lut))
+        lut = create_lookup_table(mapping, num_labels=predictor.label_manager.num_segmentation_heads)
+        if lut.max() > 255:
+            # the nnU-Net reader/writers export segmentations as uint8
+            print(f"Error: the label values of {out_lut} do not fit in uint8 and cannot be reordered in memory. Run run_labels_reordering on the outputs instead.")
+            exit(1)
+        pp_fns.append(remap_labels)
+        pp_fn_kwargs.append({'lut': lut})
+    predictor.initialize_postprocessing(pp_fns, pp_fn_kwargs)
+    return predictor
+
+
+def run_in_process(input_dir, output_dir, model_dir, folds, num_pr, cpu, pp_pkl_file, reorder_labels=False,
+                   in_lut=None, out_lut=None, tile_batch_size=1, ensemble_folds_per_tile=False,
+                   empty_tiles="predict", export_on_device=False, linear_resampling_on_device=False,
+                   parallel_gzip=False, cache_fold_networks=False):
+    start_time = time.time()
+    if parallel_gzip and "nnUNet_gzip_threads" not in os.environ:
+        # The num_pr preprocessing and export workers share the gzip threads. They are spawned and read this on import
+        from nnunetv2.imageio.parallel_gzip import gzip_threads_per_process
+        os.environ["nnUNet_gzip_threads"] = str(gzip_threads_per_process(num_pr))
+    predictor = build_predictor(model_dir, folds, cpu, pp_pkl_file, reorder_labels, in_lut, out_lut, tile_batch_size,
+                                ensemble_folds_per_tile, empty_tiles, export_on_device, linear_resampling_on_device,
+                                parallel_gzip, cache_fold_networks)
+
+    print(f"Running in-process inference, post-processing{' and label reordering' if reorder_labels else ''}. Outputs: {output_dir}")
+    predictor.predict_from_files(input_dir, output_dir,
+                                 save_probabilities=False,
+                                 overwrite=True,
+                                 num_processes_preprocessing=num_pr,
+                                 num_processes_segmentation_export=num_pr)
+    end_time = time.time()
+    duration = end_time - start_time
+    print(f"In-process inference and post-processing completed in {duration:.2f} seconds.")
+    return duration
+
+
 def run_all(dataset_id='014', 
             input_dir=None, 
             output_dir=None, 
@@ -99,6 +211,14 @@ def run_all(dataset_id='014',
             folds="0 1 2 3 4", 
             reorder_labels=False,
             cpu=False,
+            in_process=False,
+            tile_batch_size=1,
+            ensemble_folds_per_tile=False,
+            empty_tiles="predict",
+            export_on_device=False,
+            linear_resampling_on_device=False,
+            parallel_gzip=False,
+            cache_fold_networks=False,
             in_lut="/home/marcantf/Code/GOUHFI/misc/gouhfi-label-list-lut.txt",
             out_lut="/home/marcantf/Code/GOUHFI/misc/freesurfer-label-list-lut.txt"):
 
@@ -124,14 +244,27 @@ def run_all(dataset_id='014',
         output_pp_dir = os.path.join(base_out_dir, "outputs_postprocessed")
         output_pp_reo_dir = os.path.join(base_out_dir, "outputs_postprocessed_reordered")
 
-    pp_dir = os.path.join(gouhfi_home, "trained_model/Dataset014_gouhfi/nnUNetTrainer_NoDA_500epochs_AdamW__nnUNetResEncL__3d_fullres/crossval_results_folds_0_1_2_3_4")
-    pp_pkl_file = os.path.join(pp_dir, "postprocessing.pkl")
-    plans_dir = os.path.join(gouhfi_home, "trained_model/Dataset014_gouhfi/nnUNetTrainer_NoDA_500epochs_AdamW__nnUNetResEncL__3d_fullres")
+    plans_dir, pp_pkl_file = get_trained_model_paths(gouhfi_home)
     plans_json_file = os.path.join(plans_dir, "plans.json")
 
+    if in_process:
+        # Single pass: one predictor, post-processing and reordering in memory, one write per subject
+        final_output_dir = output_pp_reo_dir if reorder_labels else output_pp_dir
+        run_in_process(input_dir, final_output_dir, plans_dir, folds_list, np, cpu, pp_pkl_file,
+                       reorder_labels=reorder_labels, in_lut=in_lut, out_lut=out_lut,
+                       tile_batch_size=tile_batch_size, ensemble_folds_per_tile=ensemble_folds_per_tile,
+                       empty_tiles=empty_tiles, export_on_device=export_on_device,
+                       linear_resampling_on_device=linear_resampling_on_device, parallel_gzip=parallel_gzip,
+                       cache_fold_networks=cache_fold_networks)
+        return
+
+    if parallel_gzip:
+        print("Warning: --parallel_gzip is only used with --in_process. Ignoring it.")
 
     # Run inference
-    inference_duration = run_inference(dataset_id, input_dir, output_dir, config, trainer, plan, folds_list, np, cpu)
+    inference_duration = run_inference(dataset_id, input_dir, output_dir, config, trainer, plan, folds_list, np, cpu,
+                                       tile_batch_size, ensemble_folds_per_tile, empty_tiles, export_on_device,
+                                       linear_resampling_on_device, cache_fold_networks)
 
     # Apply post-processing
     post_processing_duration = apply_post_processing(output_dir, output_pp_dir, pp_pkl_file, np, plans_json_file)
@@ -139,7 +272,7 @@ def run_all(dataset_id='014',
     # Reorder label maps to Freesurfer's lookuptable
     if reorder_labels:
         print("Reordering label maps to Freesurfer's lookuptable...")
-        reordering_duration = apply_reordering(input_dir=output_pp_dir, output_dir=output_pp_reo_dir, in_lut=in_lut, out_lut=out_lut)
+        reordering_duration = apply_reordering(input_dir=output_pp_dir, output_dir=output_pp_reo_dir, in_lut=in_lut, out_lut=out_lut, np=np)
 
 
 
@@ -152,6 +285,14 @@ def main():
     parser.add_argument("--folds", default="0 1 2 3 4", help="Folds to use for inference. By default all folds are used and combined together.")
     parser.add_argument("--reorder_labels", action="store_true", help="Set flag if you want to reorder the label values from GOUHFI's values to the FreeSurfer lookuptable after post-processing.")
     parser.add_argument("--cpu", action="store_true", help="Set flag to use the CPU to run the inference. Expect a considerable increase in inference time.")
+    parser.add_argument("--tile_batch_size", type=int, default=1, help="Number of sliding window tiles predicted together in one forward pass. Higher values can speed up the inference on large GPUs but need more GPU memory (default: 1).")
+    parser.add_argument("--ensemble_folds_per_tile", action="store_true", help="Set flag to evaluate all folds on each sliding window tile at once, so the image is only traversed once instead of once per fold. Faster, but needs more GPU memory.")
+    parser.add_argument("--empty_tiles", default="predict", choices=["predict", "reuse", "fill"], help="How to handle sliding window tiles that only contain background (zeros) after brain extraction. 'predict' runs them through the network (default), 'reuse' predicts one of them and reuses the result for the others (equivalent to 'predict' up to floating-point nondeterminism), 'fill' skips them and labels the voxels only they cover as background (fastest). 'reuse' and 'fill' only apply if the normalization keeps the background at exactly 0.")
+    parser.add_argument("--export_on_device", action="store_true", help="Set flag to compute the label maps from the network outputs on the GPU (or with all CPU threads if --cpu is set) instead of in the export workers. Gives the same label maps as the default export, cases whose network outputs need resampling are exported as usual unless --linear_resampling_on_device is set.")
+    parser.add_argument("--linear_resampling_on_device", action="store_true", help="With --export_on_device, also resample the network outputs on the GPU with linear interpolation instead of nnU-Net's resampling. Faster, but label borders can differ slightly from the default export.")
+    parser.add_argument("--parallel_gzip", action="store_true", help="Set flag to read and write the .nii.gz files with a multithreaded gzip engine (see nnUNet_gzip_threads) if the model uses nibabel to read images. Only used with --in_process.")
+    parser.add_argument("--cache_fold_networks", action="store_true", help="Set flag to keep one network per fold on the GPU (or in memory if --cpu is set) instead of reloading the weights of every fold for every subject. Faster for many subjects, but needs enough GPU memory for the weights of all folds.")
+    parser.add_argument("--in_process", action="store_true", help="Set flag to run inference, post-processing and (optionally) label reordering in a single process, without writing the intermediate outputs to disk. Only the final label maps are saved.")
 
     # Parse arguments
     args = parser.parse_args()
@@ -162,7 +303,15 @@ def main():
         np=args.np,
         folds=args.folds,
         reorder_labels=args.reorder_labels,
-        cpu=args.cpu
+        cpu=args.cpu,
+        in_process=args.in_process,
+        tile_batch_size=args.tile_batch_size,
+        ensemble_folds_per_tile=args.ensemble_folds_per_tile,
+        empty_tiles=args.empty_tiles,
+        export_on_device=args.export_on_device,
+        linear_resampling_on_device=args.linear_resampling_on_device,
+        parallel_gzip=args.parallel_gzip,
+        cache_fold_networks=args.cache_fold_networks
     )
 
 
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------------#
+# Copyright 2025 [Marc-Antoine Fortin, MR Physics, NTNU]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This file is based from the nnUNet v2 framework (https://github.com/MIC-DKFZ/nnUNet)
+# under the terms of the Apache License, Version 2.0.
+#---------------------------------------------------------------------------------#
+import argparse
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from run_inference.gouhfi_inference_postpro_reo import build_predictor, get_trained_model_paths
+
+
+class SegmentationJob:
+    """One segmentation request. The HTTP thread waits on `done` while the worker thread runs the prediction."""
+
+    def __init__(self, input_file, output_file):
+        self.input_file = input_file
+        self.output_file = output_file
+        self.done = threading.Event()
+        self.error = None
+        self.duration = None
+
+
+def segment_file(predictor, input_file, output_file):
+    """Segment a single image with an already initialized predictor and write the (post-processed) label map."""
+    rw = predictor.plans_manager.image_reader_writer_class()
+    img, props = rw.read_images([input_file])
+    seg = predictor.predict_single_npy_array(img, props, None, None, False)
+    rw.write_seg(seg, output_file, props)
+
+
+def segmentation_worker(predictor, job_queue):
+    # The GPU is used by one job at a time, so a single worker consumes the queue in order
+    while True:
+        job = job_queue.get()
+        start_time = time.time()
+        try:
+            segment_file(predictor, job.input_file, job.output_file)
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+        job.duration = time.time() - start_time
+        job.done.set()
+        job_queue.task_done()
+
+
+def make_handler(job_queue, file_ending):
+
+    class GouhfiRequestHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, content):
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _submit_and_wait(self, job):
+            try:
+                job_queue.put_nowait(job)
+            except queue.Full:
+                self._send_json(503, {"error": "Too many queued jobs, try again later."})
+                return False
+            job.done.wait()
+            if job.error is not None:
+                self._send_json(500, {"error": job.error})
+                return False
+            return True
+
+        def do_GET(self):
+            if self.path != "/health":
+                self._send_json(404, {"error": f"Unknown endpoint {self.path}"})
+                return
+            self._send_json(200, {"status": "ok", "queued": job_queue.qsize()})
+
+        def do_POST(self):
+            if self.path != "/segment":
+                self._send_json(404, {"error": f"Unknown endpoint {self.path}"})
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                # Paths on the local file system: {"input": "/path/sub_0000.nii.gz", "output": "/path/sub.nii.gz"}
+                try:
+                    request = json.loads(body)
+                    job = SegmentationJob(request["input"], request["output"])
+                except (ValueError, KeyError, TypeError):
+                    self._send_json(400, {"error": "Expected a JSON body with 'input' and 'output' paths."})
+                    return
+                if not os.path.isfile(job.input_file):
+                    self._send_json(400, {"error": f"Input file not found: {job.input_file}"})
+                    return
+                os.makedirs(os.path.dirname(os.path.abspath(job.output_file)), exist_ok=True)
+                if self._submit_and_wait(job):
+                    self._send_json(200, {"output": job.output_file, "duration": round(job.duration, 2)})
+            else:
+                # Raw NIfTI bytes in, label map bytes out
+                input_ending = ".nii.gz" if body[:2] == b"\x1f\x8b" else ".nii"
+                with tempfile.TemporaryDirectory(prefix="gouhfi_") as tmp_dir:
+                    job = SegmentationJob(os.path.join(tmp_dir, "input_0000" + input_ending),
+                                          os.path.join(tmp_dir, "seg" + file_ending))
+                    with open(job.input_file, "wb") as f:
+                        f.write(body)
+                    if not self._submit_and_wait(job):
+                        return
+                    with open(job.output_file, "rb") as f:
+                        seg_bytes = f.read()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(seg_bytes)))
+                self.send_header("X-Duration", f"{job.duration:.2f}")
+                self.end_headers()
+                self.wfile.write(seg_bytes)
+
+        def log_message(self, format, *args):
+            print(f"[{self.log_date_time_string()}] {self.address_string()} {format % args}")
+
+    return GouhfiRequestHandler
+
+
+def run_server(host="127.0.0.1", port=8765, folds="0 1 2 3 4", cpu=False, reorder_labels=False, max_queue=32,
+               in_lut=None, out_lut=None, tile_batch_size=1, ensemble_folds_per_tile=False, empty_tiles="predict",
+               export_on_device=False, linear_resampling_on_device=False, parallel_gzip=False,
+               cache_fold_networks=False):
+
+    # Fetch the GOUHFI_HOME environment variable
+    gouhfi_home = os.getenv('GOUHFI_HOME')
+    if gouhfi_home is None:
+        print("Error: GOUHFI_HOME is not set. Please set the GOUHFI_HOME environment variable as explained in the installation steps.")
+        exit(1)
+
+    if in_lut is None:
+        in_lut = os.path.join(gouhfi_home, "misc", "gouhfi-label-list-lut.txt")
+    if out_lut is None:
+        out_lut = os.path.join(gouhfi_home, "misc", "freesurfer-label-list-lut.txt")
+
+    plans_dir, pp_pkl_file = get_trained_model_paths(gouhfi_home)
+
+    start_time = time.time()
+    predictor = build_predictor(plans_dir, folds.split(), cpu, pp_pkl_file, reorder_labels, in_lut, out_lut,
+                                tile_batch_size, ensemble_folds_per_tile, empty_tiles, export_on_device,
+                                linear_resampling_on_device, parallel_gzip, cache_fold_networks)
+    # progress bars are not useful in a server log
+    predictor.allow_tqdm = False
+    print(f"Models loaded in {time.time() - start_time:.2f} seconds.")
+
+    job_queue = queue.Queue(maxsize=max_queue)
+    worker = threading.Thread(target=segmentation_worker, args=(predictor, job_queue), daemon=True)
+    worker.start()
+
+    server = ThreadingHTTPServer((host, port), make_handler(job_queue, predictor.dataset_json['file_ending']))
+    print(f"GOUHFI segmentation server listening on http://{host}:{port} (POST /segment, GET /health). Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down the GOUHFI segmentation server.")
+    finally:
+        server.server_close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Run a persistent GOUHFI segmentation server that keeps the trained model in memory.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to bind to. Keep the default (localhost) unless you know what you are doing.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765).")
+    parser.add_argument("--folds", default="0 1 2 3 4", help="Folds to use for inference. By default all folds are used and combined together.")
+    parser.add_argument("--reorder_labels", action="store_true", help="Set flag if you want the label maps returned with the FreeSurfer lookuptable values instead of GOUHFI's.")
+    parser.add_argument("--cpu", action="store_true", help="Set flag to use the CPU to run the inference. Expect a considerable increase in inference time.")
+    parser.add_argument("--tile_batch_size", type=int, default=1, help="Number of sliding window tiles predicted together in one forward pass. Higher values can speed up the inference on large GPUs but need more GPU memory (default: 1).")
+    parser.add_argument("--ensemble_folds_per_tile", action="store_true", help="Set flag to evaluate all folds on each sliding window tile at once, so the image is only traversed once instead of once per fold. Faster, but needs more GPU memory.")
+    parser.add_argument("--empty_tiles", default="predict", choices=["predict", "reuse", "fill"], help="How to handle sliding window tiles that only contain background (zeros) after brain extraction. 'predict' runs them through the network (default), 'reuse' predicts one of them and reuses the result for the others (equivalent to 'predict' up to floating-point nondeterminism), 'fill' skips them and labels the voxels only they cover as background (fastest). 'reuse' and 'fill' only apply if the normalization keeps the background at exactly 0.")
+    parser.add_argument("--export_on_device", action="store_true", help="Set flag to compute the label maps from the network outputs on the GPU (or with all CPU threads if --cpu is set). Gives the same label maps as the default export, cases whose network outputs need resampling are exported as usual unless --linear_resampling_on_device is set.")
+    parser.add_argument("--linear_resampling_on_device", action="store_true", help="With --export_on_device, also resample the network outputs on the GPU with linear interpolation instead of nnU-Net's resampling. Faster, but label borders can differ slightly from the default export.")
+    parser.add_argument("--parallel_gzip", action="store_true", help="Set flag to read and write the .nii.gz files with a multithreaded gzip engine (see nnUNet_gzip_threads) if the model uses nibabel to read images.")
+    parser.add_argument("--cache_fold_networks", action="store_true", help="Set flag to keep one network per fold on the GPU (or in memory if --cpu is set) instead of reloading the weights of every fold for every request. Faster, but needs enough GPU memory for the weights of all folds.")
+    parser.add_argument("--max_queue", type=int, default=32, help="Maximum number of queued requests before new ones are rejected (default: 32).")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    run_server(
+        host=args.host,
+        port=args.port,
+        folds=args.folds,
+        cpu=args.cpu,
+        reorder_labels=args.reorder_labels,
+        max_queue=args.max_queue,
+        tile_batch_size=args.tile_batch_size,
+        ensemble_folds_per_tile=args.ensemble_folds_per_tile,
+        empty_tiles=args.empty_tiles,
+        export_on_device=args.export_on_device,
+        linear_resampling_on_device=args.linear_resampling_on_device,
+        parallel_gzip=args.parallel_gzip,
+        cache_fold_networks=args.cache_fold_networks
+    )
+
+
+if __name__ == "__main__":
+    main()